@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Gunicorn configuration for Presidio.
+#
+# The application is preloaded in the gunicorn master, so that the
+# immutable state that Presidio sets up at import time (configuration,
+# CA store, presidio principal, label mechanism configuration) is loaded
+# once, and shared copy-on-write with every worker. Per-worker state that
+# must not be shared is re-initialized by the hooks registered with
+# impact_presidio.Lifecycle.
+#
+# ** USAGE:
+# $ gunicorn -c ./gunicorn_config.py impact_presidio:app
+#
+# ** ENVIRONMENT:
+# GUNICORN_WORKER_CLASS    - worker class to use (default: gevent)
+# PRESIDIO_PRELOAD         - set to 0 to disable preloading (default: 1)
+# MAX_REQUESTS_PER_WORKER  - recycle workers after this many requests
+#                            (default: 0, meaning never)
+# MAX_REQUESTS_JITTER      - random jitter added to MAX_REQUESTS_PER_WORKER,
+#                            so that workers don't all recycle at once
+#                            (default: 10% of MAX_REQUESTS_PER_WORKER)
+# PRESIDIO_PROFILE         - set to 1 to enable the request profiling hooks
+#                            from wsgi_profiler.py (default: 0)
+
+import gc
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+preload_app = bool(int(os.environ.get('PRESIDIO_PRELOAD', 1)))
+
+max_requests = int(os.environ.get('MAX_REQUESTS_PER_WORKER', 0))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER',
+                                         max_requests // 10))
+
+if preload_app and worker_class == 'gevent':
+    # The gevent worker only monkey-patches after it has been forked;
+    # when preloading, the application modules have already been imported
+    # (and have bound names like time.sleep) in the master by then.
+    # Patch here, before anything else gets imported.
+    from gevent import monkey
+    monkey.patch_all()
+
+if bool(int(os.environ.get('PRESIDIO_PROFILE', 0))):
+    from wsgi_profiler import pre_request, post_request  # noqa: F401
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far into the permanent generation,
+    # so that the garbage collector in each worker doesn't touch (and
+    # thereby un-share) the pages inherited from the master.
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    from impact_presidio.Lifecycle import run_post_fork_hooks
+    run_post_fork_hooks()
+
+
+def post_worker_init(worker):
+    from impact_presidio.Lifecycle import run_worker_ready_hooks
+    run_worker_ready_hooks()
+
+
+def worker_exit(server, worker):
+    from impact_presidio.Lifecycle import run_worker_exit_hooks
+    run_worker_exit_hooks()
@@ -0,0 +1,234 @@
+import fcntl
+import os
+
+from flask import abort, current_app, jsonify, request
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os.path import join, normpath
+from threading import Thread
+from time import sleep, time
+
+from impact_presidio.Logging import LOG
+from impact_presidio.Admission import JWKS_ADMISSION, SAFE_ADMISSION
+from impact_presidio.CacheSnapshot import invalidate_snapshot
+from impact_presidio.CacheStats import cache_stats, invalidate_caches
+from impact_presidio.CredentialUtils import exempt_from_credentials
+from impact_presidio.IOPool import fs_stats
+from impact_presidio.Lifecycle import register_worker_ready_hook
+from impact_presidio.Memory import memory_report
+from impact_presidio.SharedCache import shared_cache_clear
+
+# A local-only interface for looking into (and invalidating) the caches,
+# for use from the Presidio host or container itself, e.g. after a SAFE
+# policy change or relabeling. Requests must come from a loopback address,
+# directly (not via nginx, which always adds X-Forwarded-For).
+#
+# An invalidation is applied by whichever worker receives it, and then
+# appended to a shared file, which every worker polls; so, it reaches all
+# of the workers within a few seconds. It's applied to the cache snapshot
+# (if any), too, so that no worker restores the dropped entries.
+_admin_url_prefix = '/__presidio_admin__'
+_admin_enabled = False
+_invalidation_file = '/dev/shm/presidio-invalidations'
+_invalidation_check_seconds = 1
+_invalidation_keep_seconds = 300
+_invalidation_file_max_bytes = 64 * 1024
+_invalidation_offset = 0
+_project_path = None
+
+_selector_fields = ('scid', 'dn', 'project', 'path_prefix')
+
+
+def _require_local():
+    if not _admin_enabled:
+        abort(404)
+    if (request.remote_addr not in ('127.0.0.1', '::1')) or (
+            'X-Forwarded-For' in request.headers):
+        abort(404)
+
+
+def _request_selector():
+    request_values = request.get_json(silent=True) or request.args
+    selector = {field: request_values.get(field)
+                for field in _selector_fields if request_values.get(field)}
+    if request_values.get('all') in (True, 'true', '1'):
+        selector = {'all': True}
+    if not selector:
+        abort(400, (f'Specify at least one of: '
+                    f'{", ".join(_selector_fields)}; or "all".'))
+
+    # Path prefixes are given relative to the project path, as in URLs.
+    path_prefix = selector.get('path_prefix')
+    if path_prefix:
+        rel_prefix = normpath(path_prefix.strip('/') or '.')
+        if (rel_prefix == '..') or rel_prefix.startswith('../'):
+            abort(400, 'Invalid path_prefix.')
+        selector['path_prefix'] = normpath(join(_project_path, rel_prefix))
+    return selector
+
+
+def apply_invalidation(selector):
+    """Drops the matching entries from this worker's caches; returns the
+    number dropped from each."""
+    dropped = invalidate_caches(selector)
+    LOG.info(f'Cache invalidation for {selector} dropped: {dropped}')
+    return dropped
+
+
+def _append_invalidation(selector):
+    record = json_dumps({'pid': os.getpid(), 'time': time(),
+                         'selector': selector}) + '\n'
+    with open(_invalidation_file, 'a+') as inv_file:
+        fcntl.lockf(inv_file, fcntl.LOCK_EX)
+        try:
+            inv_file.seek(0)
+            existing = inv_file.read()
+            if len(existing) > _invalidation_file_max_bytes:
+                # Keep only the records that some worker may not have
+                # seen yet; workers re-read a file that shrinks.
+                cutoff = time() - _invalidation_keep_seconds
+                recent = [line for line in existing.splitlines(True)
+                          if json_loads(line).get('time', 0) >= cutoff]
+                inv_file.seek(0)
+                inv_file.truncate()
+                inv_file.write(''.join(recent))
+            inv_file.write(record)
+        finally:
+            fcntl.lockf(inv_file, fcntl.LOCK_UN)
+
+
+def _read_new_invalidations():
+    global _invalidation_offset
+    try:
+        with open(_invalidation_file, 'r') as inv_file:
+            fcntl.lockf(inv_file, fcntl.LOCK_SH)
+            try:
+                inv_file.seek(0, os.SEEK_END)
+                if inv_file.tell() < _invalidation_offset:
+                    _invalidation_offset = 0
+                inv_file.seek(_invalidation_offset)
+                new_records = inv_file.read()
+                _invalidation_offset = inv_file.tell()
+            finally:
+                fcntl.lockf(inv_file, fcntl.LOCK_UN)
+    except FileNotFoundError:
+        return []
+    return [json_loads(line) for line in new_records.splitlines() if line]
+
+
+def _watch_invalidations():
+    while True:
+        try:
+            for record in _read_new_invalidations():
+                if record.get('pid') != os.getpid():
+                    apply_invalidation(record['selector'])
+        except Exception as e:
+            LOG.error('Error occurred while applying cache invalidations!')
+            LOG.error('Error message:')
+            LOG.error(e)
+        sleep(_invalidation_check_seconds)
+
+
+def _start_invalidation_watcher():
+    global _invalidation_offset
+    # A new worker's caches start out empty; only later records matter.
+    try:
+        _invalidation_offset = os.stat(_invalidation_file).st_size
+    except FileNotFoundError:
+        _invalidation_offset = 0
+    watcher = Thread(target=_watch_invalidations, daemon=True,
+                     name='presidio-cache-invalidations')
+    watcher.start()
+
+
+def admin_caches():
+    """Reports on this worker's caches, filesystem operations and
+    admission control."""
+    _require_local()
+    return jsonify({
+        'pid': os.getpid(),
+        'caches': cache_stats(),
+        'filesystem': fs_stats(),
+        'admission': {SAFE_ADMISSION.name: SAFE_ADMISSION.stats(),
+                      JWKS_ADMISSION.name: JWKS_ADMISSION.stats()},
+    })
+
+
+def admin_memory():
+    """Reports on this worker's memory use: RSS, cache sizes and, if
+    tracemalloc is tracing, heap growth by allocation site."""
+    _require_local()
+    compare_to = request.args.get('compare', 'previous')
+    if compare_to not in ('previous', 'baseline'):
+        abort(400, '"compare" must be one of: previous, baseline.')
+    top = request.args.get('top', type=int)
+    if (top is not None) and (top <= 0):
+        abort(400, '"top" must be a positive integer.')
+    return jsonify(memory_report(compare_to=compare_to, top=top))
+
+
+def admin_invalidate():
+    """Drops matching entries from the caches of every worker, the
+    shared cache and the cache snapshot (if any)."""
+    _require_local()
+    selector = _request_selector()
+    dropped = apply_invalidation(selector)
+    shared_cache_clear()
+    _append_invalidation(selector)
+    try:
+        dropped['snapshot'] = invalidate_snapshot(current_app, selector)
+    except Exception as e:
+        LOG.error('Error occurred while invalidating the cache snapshot!')
+        LOG.error('Error message:')
+        LOG.error(e)
+    return jsonify({'pid': os.getpid(), 'selector': selector,
+                    'dropped': dropped})
+
+
+def configure_admin(presidio_app, project_path):
+    global _admin_enabled, _project_path, _invalidation_file
+    global _invalidation_check_seconds
+    presidio_config = presidio_app.config['PRESIDIO_CONFIG']
+    _project_path = str(project_path)
+
+    conf_admin = presidio_config.get('admin')
+    if not conf_admin:
+        return
+    if type(conf_admin) is not dict:
+        LOG.warning('\"admin\" incorrectly specified in configuration!')
+        LOG.warning('Admin interface will be disabled.')
+        return
+
+    _invalidation_file = conf_admin.get('invalidation_file',
+                                        _invalidation_file)
+    conf_check_seconds = conf_admin.get('check_seconds')
+    if conf_check_seconds is not None:
+        if (type(conf_check_seconds) in (int, float)) and (
+                conf_check_seconds > 0):
+            _invalidation_check_seconds = conf_check_seconds
+        else:
+            LOG.warning(('\"check_seconds\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_invalidation_check_seconds}'))
+
+    _admin_enabled = bool(conf_admin.get('enabled', True))
+    if not _admin_enabled:
+        return
+
+    presidio_app.add_url_rule(f'{_admin_url_prefix}/caches',
+                              'admin_caches', admin_caches,
+                              methods=['GET'])
+    presidio_app.add_url_rule(f'{_admin_url_prefix}/memory',
+                              'admin_memory', admin_memory,
+                              methods=['GET'])
+    presidio_app.add_url_rule(f'{_admin_url_prefix}/caches/invalidate',
+                              'admin_invalidate', admin_invalidate,
+                              methods=['POST'])
+    # Admin requests are local, and carry no client certificate.
+    exempt_from_credentials('admin_caches')
+    exempt_from_credentials('admin_invalidate')
+    exempt_from_credentials('admin_memory')
+    register_worker_ready_hook(_start_invalidation_watcher)
+    LOG.info((f'Local admin interface enabled at {_admin_url_prefix}; '
+              f'invalidations shared via {_invalidation_file}'))
@@ -0,0 +1,241 @@
+import asyncio
+
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from threading import Event, Lock
+from timeit import default_timer as timer
+from werkzeug.exceptions import ServiceUnavailable
+
+from impact_presidio.Logging import LOG, METRICS_LOG
+
+_retry_after_seconds = 5
+
+
+class AdmissionRejected(ServiceUnavailable):
+    """Raised when an outbound call can't be admitted in time; results in
+    a 503 response, with a Retry-After header."""
+
+    def __init__(self, limiter_name):
+        super(AdmissionRejected, self).__init__(
+            (f'Presidio is too busy to check your access right now '
+             f'({limiter_name}); please try again shortly.'),
+            retry_after=_retry_after_seconds)
+
+
+class _Waiter(object):
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+def _wake_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Slots(object):
+    """A counting semaphore that both threads and coroutines can wait on.
+
+    A released slot is handed directly to the caller that has waited
+    longest, of either kind; each is woken by its own means, so nobody
+    has to poll."""
+
+    def __init__(self, count):
+        self.lock = Lock()
+        self.free = count
+        self.waiters = deque()
+
+    def _try_acquire(self):
+        # Called with the lock held.
+        if (self.free > 0) and not self.waiters:
+            self.free -= 1
+            return True
+        return False
+
+    def _settle(self, waiter):
+        """Returns whether the waiter was handed a slot; if it wasn't, it
+        stops waiting."""
+        with self.lock:
+            if not waiter.granted:
+                self.waiters.remove(waiter)
+            return waiter.granted
+
+    def acquire(self, timeout):
+        with self.lock:
+            if self._try_acquire():
+                return True
+            granted = Event()
+            waiter = _Waiter(granted.set)
+            self.waiters.append(waiter)
+        granted.wait(timeout)
+        return self._settle(waiter)
+
+    async def async_acquire(self, timeout):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self._try_acquire():
+                return True
+            future = loop.create_future()
+            waiter = _Waiter(
+                lambda: loop.call_soon_threadsafe(_wake_future, future))
+            self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Pass on any slot handed over in the meantime.
+            if self._settle(waiter):
+                self.release()
+            raise
+        return self._settle(waiter)
+
+    def release(self):
+        with self.lock:
+            if not self.waiters:
+                self.free += 1
+                return
+            waiter = self.waiters.popleft()
+            waiter.granted = True
+        waiter.wake()
+
+
+class AdmissionLimiter(object):
+    """Bounds the number of concurrent outbound calls of one kind, and
+    how long (and how many) callers may wait for a turn.
+
+    Synchronous and asynchronous callers share the same slots.
+
+    With max_concurrent of 0, everything is admitted immediately."""
+
+    def __init__(self, name):
+        self.name = name
+        self.max_concurrent = 0
+        self.max_queue_seconds = 1.0
+        self.max_waiting = 100
+        self.slots = None
+        self.waiting = 0
+        self.stats_lock = Lock()
+        self.admitted = 0
+        self.rejected = 0
+        self.queued_seconds = 0.0
+
+    def configure(self, max_concurrent, max_queue_seconds, max_waiting):
+        self.max_concurrent = max_concurrent
+        self.max_queue_seconds = max_queue_seconds
+        self.max_waiting = max_waiting
+        self.slots = None
+        if max_concurrent > 0:
+            self.slots = _Slots(max_concurrent)
+
+    def stats(self):
+        with self.stats_lock:
+            return {'admitted': self.admitted, 'rejected': self.rejected,
+                    'waiting': self.waiting,
+                    'queued_seconds': self.queued_seconds}
+
+    def _enter_queue(self):
+        with self.stats_lock:
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                queue_full = True
+            else:
+                self.waiting += 1
+                queue_full = False
+        if queue_full:
+            METRICS_LOG.info((f'Admission for {self.name} rejected: '
+                              f'{self.max_waiting} callers already waiting'))
+            raise AdmissionRejected(self.name)
+
+    def _leave_queue(self, acquired, queued_seconds):
+        with self.stats_lock:
+            self.waiting -= 1
+            self.queued_seconds += queued_seconds
+            if acquired:
+                self.admitted += 1
+            else:
+                self.rejected += 1
+        if not acquired:
+            METRICS_LOG.info((f'Admission for {self.name} rejected after '
+                              f'waiting {queued_seconds} seconds'))
+            raise AdmissionRejected(self.name)
+        if queued_seconds > 0.001:
+            METRICS_LOG.info((f'Admission for {self.name} granted after '
+                              f'waiting {queued_seconds} seconds'))
+
+    @contextmanager
+    def admit(self):
+        slots = self.slots
+        if slots is None:
+            yield
+            return
+
+        self._enter_queue()
+        queue_start = timer()
+        acquired = slots.acquire(self.max_queue_seconds)
+        self._leave_queue(acquired, timer() - queue_start)
+        try:
+            yield
+        finally:
+            slots.release()
+
+    @asynccontextmanager
+    async def async_admit(self):
+        slots = self.slots
+        if slots is None:
+            yield
+            return
+
+        self._enter_queue()
+        queue_start = timer()
+        acquired = await slots.async_acquire(self.max_queue_seconds)
+        self._leave_queue(acquired, timer() - queue_start)
+        try:
+            yield
+        finally:
+            slots.release()
+
+
+SAFE_ADMISSION = AdmissionLimiter('SAFE')
+JWKS_ADMISSION = AdmissionLimiter('Notary Service JWKS')
+
+
+def _configure_limiter(limiter, conf_key, presidio_config):
+    conf_limiter = presidio_config.get(conf_key)
+    if not conf_limiter:
+        limiter.configure(0, limiter.max_queue_seconds, limiter.max_waiting)
+        return
+
+    max_concurrent = conf_limiter.get('max_concurrent', 0)
+    max_queue_seconds = conf_limiter.get('max_queue_seconds', 1.0)
+    max_waiting = conf_limiter.get('max_waiting', 100)
+    if (((type(max_concurrent) is not int) or (max_concurrent < 0)) or
+            ((type(max_queue_seconds) not in (int, float)) or
+             (max_queue_seconds < 0)) or
+            ((type(max_waiting) is not int) or (max_waiting < 0))):
+        LOG.warning(f'\"{conf_key}\" incorrectly specified in configuration!')
+        LOG.warning(f'Admission control for {limiter.name} will be disabled.')
+        limiter.configure(0, limiter.max_queue_seconds, limiter.max_waiting)
+        return
+
+    limiter.configure(max_concurrent, max_queue_seconds, max_waiting)
+    if max_concurrent > 0:
+        LOG.info((f'Admission control for {limiter.name}: at most '
+                  f'{max_concurrent} concurrent calls, and {max_waiting} '
+                  f'callers waiting up to {max_queue_seconds} seconds.'))
+
+
+def configure_admission(presidio_config):
+    global _retry_after_seconds
+    conf_retry_after = presidio_config.get('admission_retry_after_seconds')
+    if conf_retry_after is not None:
+        if (type(conf_retry_after) is int) and (conf_retry_after >= 0):
+            _retry_after_seconds = conf_retry_after
+        else:
+            LOG.warning(('\"admission_retry_after_seconds\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning(f'Proceeding with default value: '
+                        f'{_retry_after_seconds}')
+
+    _configure_limiter(SAFE_ADMISSION, 'safe_admission', presidio_config)
+    _configure_limiter(JWKS_ADMISSION, 'jwks_admission', presidio_config)
@@ -0,0 +1,472 @@
+# An ASGI entry point for Presidio.
+#
+# This serves the same routes (under web_root), with the same authorization
+# semantics, as the WSGI application - but performs the outbound I/O that
+# Presidio needs (fetching the Notary Service JWKS, and querying SAFE)
+# asynchronously, using a pooled HTTP client, and without monkey-patching.
+#
+# The Flask application itself is still used to handle each request, on a
+# bounded thread pool, once the outbound I/O has completed; the results of
+# that I/O are passed in via the WSGI environ. Response bodies (including
+# files) are streamed back in chunks read on the thread pool, so that the
+# event loop never blocks on the filesystem.
+#
+# To use it, run gunicorn with a uvicorn worker:
+#
+#     GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker \
+#     PRESIDIO_APP=impact_presidio.AsyncPresidio:application
+
+import asyncio
+import httpx
+import io
+import OpenSSL.crypto as crypto
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+from os.path import isdir, isfile, join, normpath
+from random import shuffle
+from re import sub as re_sub
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_cookie
+from werkzeug.wsgi import FileWrapper
+
+from impact_presidio import app, autoIndex
+from impact_presidio import CredentialUtils
+from impact_presidio.CredentialUtils import decode_ns_jwt, ns_jwks_url
+from impact_presidio.CredentialUtils import verify_ns_jwt, x509_DN_string
+from impact_presidio.CredentialUtils import share_ns_jwt_result
+from impact_presidio.CredentialUtils import shared_ns_jwt_result
+from impact_presidio.Admission import AdmissionRejected
+from impact_presidio.Admission import JWKS_ADMISSION, SAFE_ADMISSION
+from impact_presidio.Checksums import checksums_enabled
+from impact_presidio.IOPool import fs_call
+from impact_presidio.LabelMechs import check_labels
+from impact_presidio.Logging import LOG
+from impact_presidio.Precompressed import precompressed_original
+from impact_presidio.Session import SESSION_COOKIE, check_session
+from impact_presidio.Uploads import uploads_enabled
+
+_chunk_size = 256 * 1024
+_default_threads = 32
+_default_connections = 100
+
+_executor = None
+_http_client = None
+
+
+def _configure_async_presidio(presidio_config):
+    global _executor
+
+    asgi_threads = presidio_config.get('asgi_threads')
+    if asgi_threads is None:
+        asgi_threads = _default_threads
+    elif (type(asgi_threads) is not int) or (asgi_threads < 1):
+        LOG.warning('\"asgi_threads\" incorrectly specified in configuration!')
+        LOG.warning(f'Proceeding with default value: {_default_threads}')
+        asgi_threads = _default_threads
+
+    _executor = ThreadPoolExecutor(max_workers=asgi_threads,
+                                   thread_name_prefix='presidio-asgi')
+    LOG.info(f'ASGI requests will be handled by {asgi_threads} threads.')
+
+
+def _open_http_client():
+    global _http_client
+    if _http_client is None:
+        presidio_config = app.config['PRESIDIO_CONFIG']
+        max_connections = presidio_config.get('asgi_max_connections')
+        if (type(max_connections) is not int) or (max_connections < 1):
+            max_connections = _default_connections
+        limits = httpx.Limits(max_connections=max_connections,
+                              max_keepalive_connections=max_connections)
+        _http_client = httpx.AsyncClient(limits=limits)
+    return _http_client
+
+
+async def _close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+class _FileWrapper(FileWrapper):
+    """Reads files in larger blocks than the default, since each block is
+    read with a round trip to the thread pool."""
+
+    def __init__(self, file, buffer_size=8192):
+        super().__init__(file, max(buffer_size, _chunk_size))
+
+
+class _ReceiveStream(io.RawIOBase):
+    """A blocking, file-like view of the ASGI request body, for use as
+    wsgi.input by the Flask application on the thread pool."""
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more_body = True
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(),
+                                                   self._loop).result()
+        if message['type'] == 'http.request':
+            self._buffer += message.get('body', b'')
+            self._more_body = message.get('more_body', False)
+        else:
+            # The client disconnected.
+            self._more_body = False
+
+    def readinto(self, b):
+        while self._more_body and not self._buffer:
+            self._fill()
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        del self._buffer[:size]
+        return size
+
+
+def _wsgi_environ(scope, body_stream):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client_addr = (scope.get('client') or ('', 0))[0]
+    path = scope['path'].encode('utf-8').decode('latin-1')
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': (scope.get('root_path', '')
+                        .encode('utf-8').decode('latin-1')),
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'SERVER_SOFTWARE': 'Presidio ASGI',
+        'REMOTE_ADDR': client_addr,
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body_stream,
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': _FileWrapper,
+    }
+
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+            continue
+        key = f'HTTP_{name}'
+        if key in environ:
+            separator = '; ' if name == 'COOKIE' else ','
+            value = f'{environ[key]}{separator}{value}'
+        environ[key] = value
+
+    return environ
+
+
+async def _fetch_ns_jwks(jwks_url):
+    async with JWKS_ADMISSION.async_admit():
+        try:
+            ns_jwks_resp = await _open_http_client().get(jwks_url)
+        except Exception:
+            return (None, None, 'GET of JWKS from Notary Service failed.')
+
+    ns_jwks_status_code = None
+    ns_jwks_keys_json = None
+    if ns_jwks_resp.status_code < 400:
+        ns_jwks_status_code = ns_jwks_resp.status_code
+        try:
+            ns_jwks_keys_json = ns_jwks_resp.json()
+        except Exception:
+            return (None, None, 'Invalid JWKS response from Notary Service.')
+
+    return (ns_jwks_status_code, ns_jwks_keys_json, None)
+
+
+async def async_process_ns_jwt(jwt, DN_from_cert):
+    """Asynchronous counterpart of CredentialUtils.process_ns_jwt."""
+    (ns_jwt, unverified_claims, decode_error) = decode_ns_jwt(jwt)
+    if decode_error:
+        return (None, decode_error)
+
+    (jwks_url, url_error) = ns_jwks_url(unverified_claims)
+    if url_error:
+        return (None, url_error)
+
+    (ns_jwks_status_code, ns_jwks_keys_json,
+     fetch_error) = await _fetch_ns_jwks(jwks_url)
+    if fetch_error:
+        return (None, fetch_error)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, verify_ns_jwt, ns_jwt,
+                                      ns_jwks_status_code,
+                                      ns_jwks_keys_json, DN_from_cert)
+
+
+async def async_safe_decision(dataset_SCID, user_DN, ns_token, project_ID):
+    """Asynchronous counterpart of SafeAutoIndex.safe_decision."""
+    if autoIndex.safe_bypassed():
+        return (True, None, None)
+
+    (methodParams, payload,
+     headers) = autoIndex.safe_query(dataset_SCID, user_DN,
+                                     ns_token, project_ID)
+
+    safe_server_list = list(app.config['SAFE_SERVER_LIST'])
+    shuffle(safe_server_list)
+    for server in safe_server_list:
+        url = (f'http://{server}/access')
+
+        (safe_result,
+         expire_time) = autoIndex.query_safe_result_cache(url, methodParams)
+        if safe_result is not None:
+            LOG.debug('Using cached SAFE query result')
+            return (safe_result, expire_time, server)
+
+        LOG.debug((f'Trying to query SAFE at {url} with the following '
+                   f'parameters: {payload}'))
+        async with SAFE_ADMISSION.async_admit():
+            try:
+                resp = await _open_http_client().post(url, content=payload,
+                                                      headers=headers,
+                                                      timeout=4)
+            except Exception as e:
+                LOG.warning((f'Error occurred while trying to '
+                             f'query SAFE server: {server}'))
+                LOG.warning('Error message:')
+                LOG.warning(e)
+                LOG.warning('Trying next SAFE server in list (if any)...')
+                continue
+
+        status_code = None
+        if resp.status_code < 400:
+            status_code = resp.status_code
+            try:
+                safe_result = resp.json()
+            except Exception as e:
+                LOG.warning((f'Error occurred while parsing response '
+                             f'from SAFE server: {server}'))
+                LOG.warning('Error message:')
+                LOG.warning(e)
+                LOG.warning('Trying next SAFE server in list (if any)...')
+                continue
+
+        (result,
+         expire_time) = autoIndex.safe_response_result(server, url,
+                                                       status_code,
+                                                       safe_result,
+                                                       methodParams)
+        if result is not None:
+            return (result, expire_time, server)
+
+    LOG.warning(('None of the configured SAFE servers replied; '
+                 'denying access.'))
+    return (None, None, None)
+
+
+def _labels_permit(abspath, dataset_SCID):
+    original_path = precompressed_original(abspath)
+    return (check_labels(abspath, dataset_SCID) and
+            ((original_path is None) or
+             check_labels(original_path, dataset_SCID)))
+
+
+def _safe_needed(endpoint, view_args, method, dataset_SCID):
+    """Returns whether the synchronous code would ask SAFE about this
+    request. It only does so once it knows the path exists, and (for
+    files) that the labels permit access; it mustn't be asked sooner."""
+    root_path = autoIndex.rootdir.abspath
+    if endpoint == 'autoindex':
+        abspath = join(root_path, re_sub(r'\/*$', '',
+                                         view_args.get('path', '.')))
+        if method in ('PUT', 'POST'):
+            return uploads_enabled() and check_labels(abspath, dataset_SCID)
+        if fs_call(isdir, abspath):
+            # Listings ask SAFE up front, to compute their ETags.
+            return True
+        return (fs_call(isfile, abspath) and
+                _labels_permit(abspath, dataset_SCID))
+    elif endpoint == 'checksum':
+        abspath = join(root_path, normpath(view_args['path'].strip('/')))
+        return (checksums_enabled() and fs_call(isfile, abspath) and
+                _labels_permit(abspath, dataset_SCID))
+    elif endpoint == 'search':
+        search_path = normpath(view_args.get('path', '').strip('/') or '.')
+        return fs_call(isdir, join(root_path, search_path))
+    elif endpoint == 'authorize':
+        return True
+    return False
+
+
+async def _preverify_credentials(environ):
+    """Performs the outbound I/O that process_credentials and
+    safe_check_access would otherwise do synchronously, leaving the
+    results in the environ for them to pick up.
+
+    Anything not handled here (missing or malformed credentials, for
+    instance) is left to the synchronous code, so that the responses
+    are exactly the same as under WSGI."""
+    if CredentialUtils._use_unverified_jwt:
+        return
+    loop = asyncio.get_running_loop()
+
+    # Public assets (stylesheets, icons) don't get credentials checked.
+    try:
+        endpoint, view_args = app.url_map.bind('').match(
+            environ['PATH_INFO'], method=environ['REQUEST_METHOD'])
+    except HTTPException:
+        endpoint, view_args = None, {}
+    if endpoint in CredentialUtils._credential_exempt_endpoints:
+        return
+
+    url_encoded_cert = environ.get('HTTP_X_SSL_CERT')
+    if not url_encoded_cert:
+        return
+    cert_pem = urllib.parse.unquote(url_encoded_cert)
+
+    # Mirror process_credentials: a JWT in the query string takes
+    # precedence (and results in a redirect), otherwise use the cookie.
+    query_args = urllib.parse.parse_qs(environ['QUERY_STRING'])
+    jwt_field = (query_args.get('ImPACT-JWT') or [None])[0]
+    jwt = jwt_field
+    session_claims = None
+    if not jwt_field:
+        cookies = parse_cookie(environ.get('HTTP_COOKIE', ''))
+        jwt = cookies.get('ImPACT-JWT')
+        # With a valid session, process_credentials won't need the JWKS.
+        session_claims = check_session(cert_pem, jwt,
+                                       cookies.get(SESSION_COOKIE),
+                                       CredentialUtils.CA_store_generation())
+    if not jwt:
+        return
+
+    if session_claims:
+        jwt_claims = session_claims
+    else:
+        try:
+            cert_x509 = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                                cert_pem)
+        except Exception:
+            return
+        x509_DN_str = x509_DN_string(cert_x509)
+
+        # Another worker may have verified this JWT already.
+        jwt_result = shared_ns_jwt_result(jwt, x509_DN_str)
+        if jwt_result is None:
+            jwt_result = await async_process_ns_jwt(jwt, x509_DN_str)
+            await loop.run_in_executor(_executor, share_ns_jwt_result,
+                                       jwt, x509_DN_str, jwt_result)
+        environ['presidio.ns_jwt_results'] = {(jwt, x509_DN_str): jwt_result}
+        jwt_claims = jwt_result[0]
+
+    if (not jwt_claims) or jwt_field:
+        return
+
+    safe_params = (jwt_claims.get('data-set'), jwt_claims.get('sub'),
+                   jwt_claims.get('ns-token'), jwt_claims.get('project-id'))
+    if None in safe_params:
+        return
+    if not await loop.run_in_executor(_executor, _safe_needed, endpoint,
+                                      view_args, environ['REQUEST_METHOD'],
+                                      safe_params[0]):
+        return
+    safe_decision = await async_safe_decision(*safe_params)
+    environ['presidio.safe_decisions'] = {safe_params: safe_decision}
+
+
+def _next_chunk(body_iterator):
+    """Collects up to _chunk_size bytes from the response body; returns
+    None once the body is exhausted."""
+    chunks = []
+    collected = 0
+    for chunk in body_iterator:
+        if chunk:
+            chunks.append(chunk)
+            collected += len(chunk)
+            if collected >= _chunk_size:
+                break
+    if not chunks:
+        return None
+    return b''.join(chunks)
+
+
+async def _run_wsgi(environ, send, wsgi_app=app):
+    loop = asyncio.get_running_loop()
+    response_start = {}
+
+    def start_response(status, headers, exc_info=None):
+        response_start['status'] = status
+        response_start['headers'] = headers
+
+        def write(data):
+            raise NotImplementedError('write() is not supported.')
+        return write
+
+    body = await loop.run_in_executor(_executor, wsgi_app, environ,
+                                      start_response)
+    try:
+        body_iterator = iter(body)
+        chunk = await loop.run_in_executor(_executor, _next_chunk,
+                                           body_iterator)
+
+        status_code = int(response_start['status'].split(' ', 1)[0])
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for (name, value) in response_start['headers']]
+        await send({'type': 'http.response.start',
+                    'status': status_code,
+                    'headers': headers})
+
+        while chunk is not None:
+            await send({'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True})
+            chunk = await loop.run_in_executor(_executor, _next_chunk,
+                                               body_iterator)
+        await send({'type': 'http.response.body',
+                    'body': b'',
+                    'more_body': False})
+    finally:
+        if hasattr(body, 'close'):
+            await loop.run_in_executor(_executor, body.close)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            _open_http_client()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await _close_http_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    loop = asyncio.get_running_loop()
+    environ = _wsgi_environ(scope, _ReceiveStream(receive, loop))
+    try:
+        await _preverify_credentials(environ)
+    except AdmissionRejected as e:
+        # Shed the load here; the synchronous code would only make the
+        # same call again, blocking.
+        await _run_wsgi(environ, send, e)
+        return
+    await _run_wsgi(environ, send)
+
+
+_configure_async_presidio(app.config['PRESIDIO_CONFIG'])
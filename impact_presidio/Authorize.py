@@ -0,0 +1,123 @@
+from flask import abort, jsonify, request
+from os import stat
+from os.path import join, normpath
+from stat import S_ISDIR
+from time import sleep
+from timeit import default_timer as timer
+
+from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.IOPool import fs_call
+from impact_presidio.LabelMechs import LabelBatch
+from impact_presidio.Precompressed import precompressed_original
+
+# Sync clients need to know which of many paths a requester may fetch.
+# Rather than one request (and so, one round of credential processing,
+# label checks and SAFE queries) per path, they may POST the whole batch:
+#
+#   {"paths": ["projectA/data/a.csv", "projectA/data/b/", ...]}
+#
+# SAFE is asked once; label checks share the lookups of common ancestor
+# directories; and paths are stat'd in chunks, one trip through the
+# filesystem pool per chunk. Paths that are denied, missing or invalid
+# are all simply reported as not allowed, as they'd all get 404.
+_authorize_max_paths = 10000
+_authorize_stat_chunk = 256
+
+
+def _stat_paths(abspaths):
+    path_stats = []
+    for abspath in abspaths:
+        if abspath is None:
+            path_stats.append(None)
+            continue
+        try:
+            path_stats.append(stat(abspath))
+        except EnvironmentError:
+            path_stats.append(None)
+    return path_stats
+
+
+def _request_paths():
+    request_body = request.get_json(silent=True)
+    if type(request_body) is not dict:
+        abort(400, 'Expected a JSON object, with a list of "paths".')
+    paths = request_body.get('paths')
+    if (type(paths) is not list) or not all(
+            type(path) is str for path in paths):
+        abort(400, '"paths" must be a list of relative paths.')
+    if len(paths) > _authorize_max_paths:
+        abort(413, (f'At most {_authorize_max_paths} paths may be '
+                    f'checked at once.'))
+    return paths
+
+
+def _resolve_path(root_path, path):
+    rel_path = normpath(path.strip('/') or '.')
+    if (rel_path == '..') or rel_path.startswith('../'):
+        return None
+    return join(root_path, rel_path)
+
+
+def authorize_paths(autoindex):
+    """Returns, as JSON, whether the requester may fetch each of the
+    paths POSTed, along with the type, size and modified time of those
+    they may."""
+    authorize_start = timer()
+    (dataset_SCID, user_DN,
+     ns_token, project_ID) = autoindex.request_safe_params()
+    paths = _request_paths()
+
+    # SAFE's answer doesn't depend upon the path; ask once, up front.
+    safe_permitted = autoindex.safe_check_access(dataset_SCID, user_DN,
+                                                 ns_token, project_ID)
+    root_path = autoindex.rootdir.abspath
+    label_batch = LabelBatch(dataset_SCID)
+    results = []
+    num_allowed = 0
+    for chunk_start in range(0, len(paths), _authorize_stat_chunk):
+        chunk_paths = paths[chunk_start:chunk_start +
+                            _authorize_stat_chunk]
+        abspaths = [_resolve_path(root_path, path) for path in chunk_paths]
+        path_stats = [None] * len(abspaths)
+        if safe_permitted:
+            path_stats = fs_call(_stat_paths, abspaths)
+
+        for path, abspath, path_stat in zip(chunk_paths, abspaths,
+                                            path_stats):
+            path_result = {'path': path, 'allowed': False}
+            if path_stat is not None:
+                is_dir = S_ISDIR(path_stat.st_mode)
+                original_path = (None if is_dir else
+                                 precompressed_original(abspath))
+                if (label_batch.check(abspath, is_dir=is_dir) and
+                        ((original_path is None) or
+                         label_batch.check(original_path, is_dir=False))):
+                    num_allowed += 1
+                    path_result.update({
+                        'allowed': True,
+                        'type': 'directory' if is_dir else 'file',
+                        'size': None if is_dir else path_stat.st_size,
+                        'modified': path_stat.st_mtime,
+                    })
+            results.append(path_result)
+        # Let other requests go, between chunks.
+        sleep(0)
+
+    authorize_end = timer()
+    METRICS_LOG.info((f'Authorization for request {request.uuid} of '
+                      f'{len(paths)} paths allowed {num_allowed} '
+                      f'in {authorize_end - authorize_start} seconds'))
+    return jsonify({'results': results})
+
+
+def configure_authorize(presidio_config):
+    global _authorize_max_paths
+    conf_max_paths = presidio_config.get('authorize_max_paths')
+    if conf_max_paths is not None:
+        if (type(conf_max_paths) is int) and (conf_max_paths > 0):
+            _authorize_max_paths = conf_max_paths
+        else:
+            LOG.warning(('\"authorize_max_paths\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_authorize_max_paths}'))
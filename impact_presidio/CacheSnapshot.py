@@ -0,0 +1,324 @@
+import fcntl
+import hashlib
+import hmac
+
+from datetime import datetime
+from json import dumps as json_dumps
+from json import load as json_load
+from json import loads as json_loads
+from os import fdopen, fstat, getuid, replace, unlink
+from os.path import dirname
+from pathlib import Path
+from stat import S_IWGRP, S_IWOTH
+from tempfile import mkstemp
+from threading import Thread
+from time import sleep, time
+
+from impact_presidio import LabelMechs
+from impact_presidio.CacheStats import selector_matches
+from impact_presidio.Logging import LOG
+from impact_presidio.Lifecycle import register_worker_ready_hook
+from impact_presidio.Lifecycle import register_worker_exit_hook
+
+# Snapshots hold SAFE's decisions, so they're authenticated with an HMAC,
+# keyed from Presidio's private key; only files owned by this user, and
+# writable by no one else, are read at all.
+#
+# An invalidation (see Admin) is applied to the snapshot as well, and
+# recorded in it for a while: a worker that hasn't yet seen the
+# invalidation may still hold the entries it dropped, so those are
+# dropped again from every snapshot written in the meantime.
+_snapshot_version = 4
+_snapshot_app = None
+_snapshot_autoindex = None
+_snapshot_file = None
+_snapshot_seconds = 60
+_snapshot_key = None
+_snapshot_invalidation_keep_seconds = 300
+
+
+def config_fingerprint(presidio_app):
+    """Returns a digest of the configuration and CA bundle; cached state
+    saved under a different fingerprint can't be trusted."""
+    presidio_config = presidio_app.config['PRESIDIO_CONFIG']
+    sha256Hasher = hashlib.sha256()
+    sha256Hasher.update(json_dumps(presidio_config, sort_keys=True,
+                                   default=str).encode('utf-8'))
+    ca_file = presidio_config.get('ca_file')
+    if ca_file:
+        try:
+            with open(ca_file, 'rb') as cf:
+                sha256Hasher.update(cf.read())
+        except EnvironmentError:
+            pass
+    return sha256Hasher.hexdigest()
+
+
+def _derive_snapshot_key(key_bytes):
+    return hmac.new(b'presidio-cache-snapshot', key_bytes,
+                    hashlib.sha256).digest()
+
+
+def _snapshot_mac(snapshot_body):
+    return hmac.new(_snapshot_key, snapshot_body.encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+def _collect_entries(autoindex):
+    now = time()
+    safe_results = {}
+    for key, (result, expire_time, selector_fields) in list(
+            autoindex.safe_result_cache.items()):
+        expire_timestamp = expire_time.timestamp()
+        if expire_timestamp > now:
+            safe_results[key] = [result, expire_timestamp,
+                                 list(selector_fields)]
+
+    safelabels = {}
+    for sl_path, (safeLabels, sl_mtime) in list(
+            LabelMechs._safelabels_cache.items()):
+        try:
+            # SafeLabels files may contain YAML values with no JSON
+            # equivalent (e.g. dates); such entries just don't get saved.
+            json_dumps(safeLabels)
+        except (TypeError, ValueError):
+            continue
+        safelabels[str(sl_path)] = [safeLabels, sl_mtime]
+
+    return safe_results, safelabels
+
+
+def _read_snapshot(snapshot_file, fingerprint):
+    try:
+        with open(snapshot_file, 'r') as sf:
+            sf_stat = fstat(sf.fileno())
+            if ((sf_stat.st_uid != getuid()) or
+                    (sf_stat.st_mode & (S_IWGRP | S_IWOTH))):
+                LOG.warning((f'Ignoring cache snapshot not owned by, or '
+                             f'writable by others than, this user: '
+                             f'{snapshot_file}'))
+                return None
+            envelope = json_load(sf)
+    except FileNotFoundError:
+        return None
+    except (EnvironmentError, ValueError) as e:
+        LOG.warning(f'Unable to read cache snapshot: {snapshot_file}')
+        LOG.warning('Error message:')
+        LOG.warning(e)
+        return None
+
+    if ((type(envelope) is not dict) or
+            (envelope.get('version') != _snapshot_version) or
+            (type(envelope.get('snapshot')) is not str) or
+            (type(envelope.get('mac')) is not str)):
+        LOG.info('Ignoring cache snapshot with unknown format.')
+        return None
+    if not hmac.compare_digest(envelope['mac'],
+                               _snapshot_mac(envelope['snapshot'])):
+        LOG.warning(('Ignoring cache snapshot that fails authentication: '
+                     f'{snapshot_file}'))
+        return None
+    try:
+        snapshot = json_loads(envelope['snapshot'])
+    except ValueError:
+        LOG.info('Ignoring cache snapshot with unknown format.')
+        return None
+    if ((type(snapshot) is not dict) or
+            (snapshot.get('fingerprint') != fingerprint)):
+        LOG.info(('Ignoring cache snapshot taken with a different '
+                  'configuration or CA bundle.'))
+        return None
+    return snapshot
+
+
+def _drop_invalidated(snapshot, selector):
+    """Drops the entries matching selector from snapshot; returns the
+    number dropped."""
+    dropped = 0
+    safe_results = snapshot['safe_results']
+    for key, (_, _, selector_fields) in list(safe_results.items()):
+        dataset_SCID, user_DN, project_ID = selector_fields
+        if selector_matches(selector, scid=dataset_SCID, dn=user_DN,
+                            project=project_ID):
+            del safe_results[key]
+            dropped += 1
+    safelabels = snapshot['safelabels']
+    for sl_path in list(safelabels.keys()):
+        if LabelMechs.safelabels_matches(selector, sl_path):
+            del safelabels[sl_path]
+            dropped += 1
+    return dropped
+
+
+def _update_snapshot(snapshot_file, fingerprint, update_fn):
+    """Reads the snapshot in snapshot_file, passes it to update_fn to
+    change in place, and writes it back; all under the snapshot's lock,
+    so that workers' updates don't undo one another."""
+    with open(f'{snapshot_file}.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            now = time()
+            snapshot = _read_snapshot(snapshot_file, fingerprint)
+            if snapshot is None:
+                snapshot = {'safe_results': {}, 'safelabels': {}}
+            snapshot['fingerprint'] = fingerprint
+            snapshot['written'] = now
+            snapshot['invalidations'] = [
+                (invalidation_time, selector)
+                for invalidation_time, selector in (
+                    snapshot.get('invalidations', []))
+                if now - invalidation_time < (
+                    _snapshot_invalidation_keep_seconds)]
+            update_result = update_fn(snapshot, now)
+
+            # Write to a temporary file, then swap it into place, so that
+            # readers never see a partially written snapshot.
+            tmp_fd, tmp_path = mkstemp(dir=(dirname(snapshot_file) or '.'),
+                                       prefix='.presidio-snapshot-')
+            try:
+                snapshot_body = json_dumps(snapshot)
+                with fdopen(tmp_fd, 'w') as tf:
+                    tf.write(json_dumps({'version': _snapshot_version,
+                                         'mac': _snapshot_mac(snapshot_body),
+                                         'snapshot': snapshot_body}))
+                replace(tmp_path, snapshot_file)
+            except Exception:
+                unlink(tmp_path)
+                raise
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return update_result
+
+
+def write_snapshot(presidio_app, autoindex, snapshot_file):
+    """Saves the still-valid cache entries to snapshot_file, merging them
+    with those already saved there by other workers."""
+    safe_results, safelabels = _collect_entries(autoindex)
+
+    def merge_entries(snapshot, now):
+        for key, entry in snapshot['safe_results'].items():
+            current = safe_results.get(key)
+            if ((entry[1] > now) and
+                    ((current is None) or (current[1] < entry[1]))):
+                safe_results[key] = entry
+        for sl_path, entry in snapshot['safelabels'].items():
+            safelabels.setdefault(sl_path, entry)
+        snapshot['safe_results'] = safe_results
+        snapshot['safelabels'] = safelabels
+        for _, selector in snapshot['invalidations']:
+            _drop_invalidated(snapshot, selector)
+
+    _update_snapshot(snapshot_file, config_fingerprint(presidio_app),
+                     merge_entries)
+    LOG.debug((f'Cache snapshot written with {len(safe_results)} SAFE '
+               f'results and {len(safelabels)} SafeLabels files.'))
+
+
+def invalidate_snapshot(presidio_app, selector):
+    """Drops the entries matching selector from the cache snapshot (if
+    any), and has later snapshot writes drop them too, for a while;
+    returns the number dropped."""
+    if _snapshot_file is None:
+        return 0
+
+    def drop_entries(snapshot, now):
+        snapshot['invalidations'].append((now, selector))
+        return _drop_invalidated(snapshot, selector)
+
+    return _update_snapshot(_snapshot_file,
+                            config_fingerprint(presidio_app), drop_entries)
+
+
+def load_snapshot(presidio_app, autoindex, snapshot_file):
+    """Restores the unexpired entries in snapshot_file into the caches."""
+    snapshot = _read_snapshot(snapshot_file,
+                              config_fingerprint(presidio_app))
+    if snapshot is None:
+        return
+
+    now = time()
+    num_safe_results = 0
+    for key, (result, expire_timestamp, selector_fields) in (
+            snapshot.get('safe_results', {}).items()):
+        if expire_timestamp > now:
+            autoindex.safe_result_cache[key] = (
+                result, datetime.fromtimestamp(expire_timestamp),
+                tuple(selector_fields))
+            num_safe_results += 1
+
+    num_safelabels = 0
+    for sl_path, (safeLabels, sl_mtime) in (
+            snapshot.get('safelabels', {}).items()):
+        # These are re-validated against the file's mtime on each use.
+        LabelMechs._safelabels_cache[Path(sl_path)] = (safeLabels, sl_mtime)
+        num_safelabels += 1
+
+    LOG.info((f'Restored {num_safe_results} SAFE results and '
+              f'{num_safelabels} SafeLabels files from cache snapshot.'))
+
+
+def _write_worker_snapshot():
+    try:
+        write_snapshot(_snapshot_app, _snapshot_autoindex, _snapshot_file)
+    except Exception as e:
+        LOG.warning(f'Unable to write cache snapshot: {_snapshot_file}')
+        LOG.warning('Error message:')
+        LOG.warning(e)
+
+
+def _periodic_snapshots():
+    while True:
+        sleep(_snapshot_seconds)
+        _write_worker_snapshot()
+
+
+def _restore_worker_snapshot():
+    load_snapshot(_snapshot_app, _snapshot_autoindex, _snapshot_file)
+    if _snapshot_seconds > 0:
+        writer = Thread(target=_periodic_snapshots,
+                        name='presidio-cache-snapshot', daemon=True)
+        writer.start()
+
+
+def configure_cache_snapshot(presidio_app, autoindex):
+    global _snapshot_app, _snapshot_autoindex
+    global _snapshot_file, _snapshot_seconds, _snapshot_key
+    _snapshot_app = presidio_app
+    _snapshot_autoindex = autoindex
+
+    presidio_config = presidio_app.config['PRESIDIO_CONFIG']
+    conf_snapshot_file = presidio_config.get('cache_snapshot_file')
+    if not conf_snapshot_file:
+        return
+    if type(conf_snapshot_file) is not str:
+        LOG.warning(('\"cache_snapshot_file\" incorrectly ' +
+                     'specified in configuration!'))
+        LOG.warning('Cache snapshots will be disabled.')
+        return
+
+    try:
+        with open(presidio_config.get('key_file'), 'rb') as kf:
+            _snapshot_key = _derive_snapshot_key(kf.read())
+    except (EnvironmentError, TypeError) as e:
+        LOG.warning('Unable to read key for authenticating cache snapshots!')
+        LOG.warning('Error message:')
+        LOG.warning(e)
+        LOG.warning('Cache snapshots will be disabled.')
+        return
+    _snapshot_file = conf_snapshot_file
+
+    conf_snapshot_seconds = presidio_config.get('cache_snapshot_seconds')
+    if conf_snapshot_seconds is not None:
+        if (((type(conf_snapshot_seconds) is int) or
+             (type(conf_snapshot_seconds) is float)) and
+                (conf_snapshot_seconds >= 0)):
+            _snapshot_seconds = conf_snapshot_seconds
+        else:
+            LOG.warning(('\"cache_snapshot_seconds\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning(f'Proceeding with default value: {_snapshot_seconds}')
+
+    LOG.info((f'Caches will be saved to {_snapshot_file} on shutdown, '
+              f'and every {_snapshot_seconds} seconds (if non-zero).'))
+    register_worker_ready_hook(_restore_worker_snapshot)
+    register_worker_exit_hook(_write_worker_snapshot)
@@ -0,0 +1,131 @@
+from itertools import islice
+from sys import getsizeof
+
+from impact_presidio.Lifecycle import register_post_fork_hook
+
+# A registry of the in-process caches, so that they can be reported on
+# (and invalidated) in one place. Each cache registers a function that
+# returns its container, and optionally one that drops the entries
+# matching an invalidation selector (see selector_matches), returning how
+# many it dropped. Caches count their own hits, misses and evictions.
+_caches = dict()
+
+_size_sample_entries = 100
+_size_depth = 3
+
+
+class CacheCounters(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidated = 0
+
+
+def register_cache(cache_name, container_fn, invalidate_fn=None):
+    """Registers a cache; returns the CacheCounters for it to update."""
+    counters = CacheCounters()
+    _caches[cache_name] = (container_fn, invalidate_fn, counters)
+    return counters
+
+
+@register_post_fork_hook
+def _reset_cache_counters():
+    for _, _, counters in _caches.values():
+        counters.reset()
+
+
+def _deep_size(obj, depth):
+    obj_size = getsizeof(obj)
+    if depth > 0:
+        if isinstance(obj, (tuple, list)):
+            obj_size += sum(_deep_size(o, depth - 1) for o in obj)
+        elif isinstance(obj, dict):
+            obj_size += sum(_deep_size(k, depth - 1) +
+                            _deep_size(v, depth - 1)
+                            for k, v in obj.items())
+    return obj_size
+
+
+def approximate_size(container):
+    """Estimates the memory used by a cache container and its entries, in
+    bytes, from a sample of the entries; None where that can't be done
+    (e.g. on PyPy, which has no sys.getsizeof)."""
+    try:
+        container_size = getsizeof(container)
+        num_entries = len(container)
+        if num_entries == 0:
+            return container_size
+        if hasattr(container, 'items'):
+            sample = list(islice(container.items(), _size_sample_entries))
+        else:
+            sample = list(islice(container, _size_sample_entries))
+        sample_size = sum(_deep_size(entry, _size_depth) for entry in sample)
+    except (TypeError, RuntimeError):
+        return None
+    return container_size + (sample_size * num_entries // len(sample))
+
+
+def cache_stats():
+    """Returns the size, hit ratio, eviction and invalidation counts, and
+    approximate memory footprint of each registered cache."""
+    stats = dict()
+    for cache_name, (container_fn, _, counters) in _caches.items():
+        container = container_fn()
+        lookups = counters.hits + counters.misses
+        stats[cache_name] = {
+            'entries': len(container) if container is not None else 0,
+            'hits': counters.hits,
+            'misses': counters.misses,
+            'hit_ratio': (counters.hits / lookups) if lookups else None,
+            'evictions': counters.evictions,
+            'invalidated': counters.invalidated,
+            'approximate_bytes': (approximate_size(container)
+                                  if container is not None else 0),
+        }
+    return stats
+
+
+def path_within(path, path_prefix):
+    return (path == path_prefix) or path.startswith(
+        path_prefix.rstrip('/') + '/')
+
+
+def selector_matches(selector, **entry_fields):
+    """Returns whether a cache entry matches an invalidation selector.
+
+    The selector may give any of: scid, dn, project and path_prefix (an
+    absolute path); the entry gives whichever of scid, dn, project and
+    path it knows. The entry matches if every criterion it can be judged
+    by matches - and there's at least one such criterion. A selector with
+    "all" set matches everything."""
+    if selector.get('all'):
+        return True
+    judged = False
+    for criterion in ('scid', 'dn', 'project'):
+        if (criterion in selector) and (criterion in entry_fields):
+            judged = True
+            if selector[criterion] != entry_fields[criterion]:
+                return False
+    if ('path_prefix' in selector) and ('path' in entry_fields):
+        judged = True
+        if not path_within(str(entry_fields['path']),
+                           selector['path_prefix']):
+            return False
+    return judged
+
+
+def invalidate_caches(selector):
+    """Drops the entries matching selector from every registered cache;
+    returns the number dropped from each."""
+    dropped = dict()
+    for cache_name, (_, invalidate_fn, counters) in _caches.items():
+        if invalidate_fn is None:
+            continue
+        num_dropped = invalidate_fn(selector)
+        counters.invalidated += num_dropped
+        dropped[cache_name] = num_dropped
+    return dropped
@@ -0,0 +1,281 @@
+import hashlib
+
+from base64 import b64encode
+from flask import abort, jsonify
+from werkzeug.exceptions import ServiceUnavailable
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os import makedirs, replace, stat
+from os.path import isdir, isfile, join, normpath
+from tempfile import NamedTemporaryFile
+from threading import Lock, Thread
+from time import sleep
+from xattr import xattr
+
+from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.IOPool import fs_call
+
+# SHA-256 digests of served files are computed on first request, and
+# stored alongside the file - in an extended attribute, or in a sidecar
+# index outside of the project tree - together with the size and mtime
+# they were computed for. A digest is only reused while those still match.
+_checksum_xattr = 'user.us.cyberimpact.presidio.sha256'
+_checksum_chunk_bytes = 1024 * 1024
+
+_checksum_store = None
+_checksum_index_path = None
+_checksum_header = False
+_checksum_header_max_bytes = 64 * 1024 * 1024
+
+# Digests of files larger than compute_max_bytes aren't computed while the
+# requester waits; a few at a time are computed in the background, and
+# the requester is asked to come back for them.
+_checksum_compute_max_bytes = 256 * 1024 * 1024
+_checksum_background_max = 4
+_checksum_retry_after_seconds = 10
+_checksum_pending = set()
+_checksum_pending_lock = Lock()
+
+
+def checksums_enabled():
+    return _checksum_store is not None
+
+
+def _file_version(file_stat):
+    return f'{file_stat.st_size}:{file_stat.st_mtime_ns}'
+
+
+def _hash_chunk(hf, file_hash):
+    chunk = hf.read(_checksum_chunk_bytes)
+    file_hash.update(chunk)
+    return bool(chunk)
+
+
+def hash_file(path):
+    """Returns the hex SHA-256 digest of the file at path, read a chunk
+    at a time (each via fs_call, so requests go in between)."""
+    file_hash = hashlib.sha256()
+    hf = fs_call(open, path, 'rb')
+    try:
+        while fs_call(_hash_chunk, hf, file_hash):
+            sleep(0)
+    finally:
+        fs_call(hf.close)
+    return file_hash.hexdigest()
+
+
+def _index_entry_path(path):
+    path_hash = hashlib.sha256(path.encode('utf-8')).hexdigest()
+    return join(_checksum_index_path, path_hash[:2], path_hash)
+
+
+def _read_stored_checksum(path):
+    if _checksum_store == 'xattr':
+        try:
+            stored = xattr(path).get(_checksum_xattr).decode('utf-8')
+        except (EnvironmentError, KeyError):
+            return None
+        stored_version, _, stored_digest = stored.rpartition(':')
+        return (stored_version, stored_digest)
+
+    try:
+        with open(_index_entry_path(path), 'r') as ef:
+            entry = json_loads(ef.read())
+        if entry.get('path') != path:
+            return None
+        return (entry['version'], entry['sha256'])
+    except (EnvironmentError, ValueError, KeyError):
+        return None
+
+
+def _write_stored_checksum(path, version, digest):
+    if _checksum_store == 'xattr':
+        xattr(path).set(_checksum_xattr,
+                        f'{version}:{digest}'.encode('utf-8'))
+        return
+
+    entry_path = _index_entry_path(path)
+    entry_dir = entry_path.rsplit('/', 1)[0]
+    makedirs(entry_dir, exist_ok=True)
+    with NamedTemporaryFile('w', dir=entry_dir, delete=False) as ef:
+        ef.write(json_dumps({'path': path, 'version': version,
+                             'sha256': digest}))
+    replace(ef.name, entry_path)
+
+
+def _stored_checksum(path):
+    file_version = _file_version(stat(path))
+    stored = _read_stored_checksum(path)
+    if stored and (stored[0] == file_version):
+        return (file_version, stored[1])
+    return (file_version, None)
+
+
+def _keep_checksum(path, file_version, digest):
+    # If the file changed while we were reading it, the digest is of
+    # neither version; don't keep it.
+    if _file_version(stat(path)) != file_version:
+        return
+    try:
+        _write_stored_checksum(path, file_version, digest)
+    except EnvironmentError as e:
+        LOG.debug(f'Unable to store checksum for {path}: {e}')
+
+
+def _store_checksum(path, digest):
+    _write_stored_checksum(path, _file_version(stat(path)), digest)
+
+
+def store_checksum(path, digest):
+    """Records a digest already computed for the file at path (e.g. while
+    it was being written), if checksums are enabled."""
+    if not checksums_enabled():
+        return
+    try:
+        fs_call(_store_checksum, path, digest)
+    except EnvironmentError as e:
+        LOG.debug(f'Unable to store checksum for {path}: {e}')
+
+
+def file_checksum(path, compute=True):
+    """Returns the hex SHA-256 digest of the file at path, computing and
+    storing it if needed (or, with compute False, returning None)."""
+    file_version, digest = fs_call(_stored_checksum, path)
+    if (digest is None) and compute:
+        digest = hash_file(path)
+        fs_call(_keep_checksum, path, file_version, digest)
+    return digest
+
+
+def _background_checksum(path):
+    try:
+        file_checksum(path)
+    except Exception as e:
+        LOG.debug(f'Unable to compute checksum for {path}: {e}')
+    finally:
+        with _checksum_pending_lock:
+            _checksum_pending.discard(path)
+
+
+def _compute_in_background(path):
+    """Starts computing the digest of the file at path in the background,
+    unless it's already underway; returns False if too many are."""
+    with _checksum_pending_lock:
+        if path in _checksum_pending:
+            return True
+        if len(_checksum_pending) >= _checksum_background_max:
+            return False
+        _checksum_pending.add(path)
+    background = Thread(target=_background_checksum, args=(path,),
+                        name='presidio-checksum', daemon=True)
+    background.start()
+    return True
+
+
+def add_checksum_header(response, path):
+    """Adds a Repr-Digest header to a response for the file at path, if
+    configured to do so, and the digest is known or cheap to compute."""
+    if not (checksums_enabled() and _checksum_header):
+        return response
+    try:
+        file_size = fs_call(stat, path).st_size
+        digest = file_checksum(
+            path, compute=(file_size <= _checksum_header_max_bytes))
+    except EnvironmentError:
+        return response
+    if digest:
+        digest_b64 = b64encode(bytes.fromhex(digest)).decode('ascii')
+        response.headers['Repr-Digest'] = f'sha-256=:{digest_b64}:'
+    return response
+
+
+def checksum_response(autoindex, path):
+    """Returns the SHA-256 digest of a file, as JSON, to a requester who
+    is authorized to fetch the file itself."""
+    if not checksums_enabled():
+        abort(404)
+    (dataset_SCID, user_DN,
+     ns_token, project_ID) = autoindex.request_safe_params()
+
+    rel_path = normpath(path.strip('/') or '.')
+    if (rel_path == '..') or rel_path.startswith('../'):
+        abort(404)
+    abspath = join(autoindex.rootdir.abspath, rel_path)
+    if not (fs_call(isfile, abspath) and
+            autoindex.is_it_safe(abspath, dataset_SCID, user_DN,
+                                 ns_token, project_ID)):
+        abort(404)
+
+    try:
+        file_size = fs_call(stat, abspath).st_size
+        digest = file_checksum(
+            abspath, compute=(file_size <= _checksum_compute_max_bytes))
+    except EnvironmentError:
+        abort(404)
+
+    if digest is None:
+        if not _compute_in_background(abspath):
+            raise ServiceUnavailable(
+                'Too many checksums are being computed; please try again.',
+                retry_after=_checksum_retry_after_seconds)
+        METRICS_LOG.info(f'Checksum computation started for {rel_path}')
+        response = jsonify({'path': rel_path, 'size': file_size,
+                            'sha256': None})
+        response.status_code = 202
+        response.headers['Retry-After'] = str(_checksum_retry_after_seconds)
+        return response
+
+    METRICS_LOG.info(f'Checksum returned for {rel_path}')
+    return jsonify({'path': rel_path, 'size': file_size, 'sha256': digest})
+
+
+def configure_checksums(presidio_config):
+    global _checksum_store, _checksum_index_path
+    global _checksum_header, _checksum_header_max_bytes
+    global _checksum_compute_max_bytes
+    _checksum_store = None
+
+    conf_checksums = presidio_config.get('checksums')
+    if not conf_checksums:
+        return
+
+    conf_store = conf_checksums.get('store', 'xattr')
+    conf_index_path = conf_checksums.get('index_path')
+    if conf_store == 'sidecar':
+        if (not conf_index_path) or (not isdir(conf_index_path)):
+            LOG.warning(('\"checksums\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning(('Checksums will be disabled; the sidecar store '
+                         'needs an existing \"index_path\".'))
+            return
+        _checksum_index_path = conf_index_path
+    elif conf_store != 'xattr':
+        LOG.warning('\"checksums\" incorrectly specified in configuration!')
+        LOG.warning('Checksums will be disabled.')
+        return
+    _checksum_store = conf_store
+
+    _checksum_header = bool(conf_checksums.get('header', False))
+    conf_header_max_bytes = conf_checksums.get('header_max_bytes')
+    if conf_header_max_bytes is not None:
+        if (type(conf_header_max_bytes) is int) and (
+                conf_header_max_bytes >= 0):
+            _checksum_header_max_bytes = conf_header_max_bytes
+        else:
+            LOG.warning(('\"header_max_bytes\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_checksum_header_max_bytes}'))
+
+    conf_compute_max_bytes = conf_checksums.get('compute_max_bytes')
+    if conf_compute_max_bytes is not None:
+        if (type(conf_compute_max_bytes) is int) and (
+                conf_compute_max_bytes >= 0):
+            _checksum_compute_max_bytes = conf_compute_max_bytes
+        else:
+            LOG.warning(('\"compute_max_bytes\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_checksum_compute_max_bytes}'))
+
+    LOG.info(f'File checksums will be stored using: {_checksum_store}')
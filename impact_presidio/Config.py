@@ -110,13 +110,28 @@ def get_safe_server_list(presidio_config):
     return safe_server_list
 
 
+def get_safe_result_cache_seconds(presidio_config):
+    safe_result_cache_seconds = presidio_config.get(
+        'safe_result_cache_seconds')
+
+    if safe_result_cache_seconds is not None:
+        if (((type(safe_result_cache_seconds) is int) or
+             (type(safe_result_cache_seconds) is float)) and
+                (safe_result_cache_seconds >= 0)):
+            return safe_result_cache_seconds
+        else:
+            LOG.warning(('\"safe_result_cache_seconds\" incorrectly ' +
+                         'specified in configuration!'))
+    return None
+
+
 def configure_safe_result_cache_seconds(presidio_app):
     presidio_config = presidio_app.config['PRESIDIO_CONFIG']
     safe_result_cache_seconds = None
 
     if presidio_config is not None:
         safe_result_cache_seconds = (
-            presidio_config.get('safe_result_cache_seconds')
+            get_safe_result_cache_seconds(presidio_config)
         )
     else:
         LOG.warning('Presidio app object somehow does not have')
@@ -126,15 +141,29 @@ def configure_safe_result_cache_seconds(presidio_app):
         LOG.warning('is going on...')
 
     if safe_result_cache_seconds is not None:
-        if (((type(safe_result_cache_seconds) is int) or
-             (type(safe_result_cache_seconds) is float)) and
-                (safe_result_cache_seconds >= 0)):
-            presidio_app.config['SAFE_RESULT_CACHE_SECONDS'] = (
-                safe_result_cache_seconds
-            )
+        presidio_app.config['SAFE_RESULT_CACHE_SECONDS'] = (
+            safe_result_cache_seconds
+        )
+
+
+def get_decision_cache_size(presidio_config):
+    decision_cache_size = presidio_config.get('decision_cache_size')
+
+    if decision_cache_size is not None:
+        if (type(decision_cache_size) is int) and (decision_cache_size >= 0):
+            return decision_cache_size
         else:
-            LOG.warning(('\"safe_result_cache_seconds\" incorrectly ' +
+            LOG.warning(('\"decision_cache_size\" incorrectly ' +
                          'specified in configuration!'))
+    return None
+
+
+def configure_decision_cache_size(presidio_app):
+    presidio_config = presidio_app.config['PRESIDIO_CONFIG']
+    decision_cache_size = get_decision_cache_size(presidio_config)
+
+    if decision_cache_size is not None:
+        presidio_app.config['DECISION_CACHE_SIZE'] = decision_cache_size
 
 
 def configure_ca_store(presidio_config):
@@ -6,20 +6,32 @@ import ssl
 import urllib.parse
 import uuid
 
-from flask import request, abort, make_response
-from datetime import datetime
+from flask import request, abort, make_response, after_this_request
+from datetime import datetime, timezone
 from jwcrypto import jwk
 from requests import get
 from ns_jwt import NSJWT
 from json import dumps as json_dumps
 from timeit import default_timer as timer
 
+from impact_presidio.Admission import JWKS_ADMISSION
 from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.Session import SESSION_COOKIE, sessions_enabled
+from impact_presidio.Session import check_session, issue_session
+from impact_presidio.SharedCache import shared_cache_get, shared_cache_set
+from impact_presidio.SharedCache import shared_credential_expiry
 
 _CAStore = crypto.X509Store()
+_credential_exempt_endpoints = set()
 _use_unverified_jwt = False
 
 
+def exempt_from_credentials(endpoint):
+    """Marks an endpoint as serving public content, for which
+    process_credentials should do nothing."""
+    _credential_exempt_endpoints.add(endpoint)
+
+
 def _BAD_IDEA_set_use_unverified_jwt():
     global _use_unverified_jwt
     LOG.warning('BAD IDEA: Use of unverified JWTs requested!')
@@ -29,18 +41,39 @@ def _BAD_IDEA_set_use_unverified_jwt():
     _use_unverified_jwt = True
 
 
-def initialize_CA_store(CAFile=None):
+def build_CA_store(CAFile=None):
     # Using this, with *full* knowledge that there's a potential
     # security issue.
     #
     # See: https://github.com/pyca/pyopenssl/pull/473
+    ca_store = crypto.X509Store()
+    sha256Hasher = hashlib.sha256()
     if CAFile:
         root_certs = pem.parse_file(CAFile)
         if root_certs:
             for root_cert in root_certs:
                 loaded_cert = crypto.load_certificate(crypto.FILETYPE_PEM,
                                                       root_cert.as_bytes())
-                _CAStore.add_cert(loaded_cert)
+                ca_store.add_cert(loaded_cert)
+                sha256Hasher.update(root_cert.as_bytes())
+    # The generation identifies the set of CAs; it's derived from their
+    # contents so that all workers agree on it. It is kept with the store,
+    # so that the two are always swapped in together.
+    ca_store.presidio_generation = sha256Hasher.hexdigest()[:16]
+    return ca_store
+
+
+def CA_store_generation(ca_store=None):
+    if ca_store is None:
+        ca_store = _CAStore
+    return getattr(ca_store, 'presidio_generation', '')
+
+
+def initialize_CA_store(CAFile=None):
+    # Build the new store completely before swapping it in, so that
+    # requests in flight never see a partially populated store.
+    global _CAStore
+    _CAStore = build_CA_store(CAFile)
 
 
 def generate_safe_principal_id(key):
@@ -57,10 +90,106 @@ def generate_presidio_principal(keyFile):
     return generate_safe_principal_id(private_key)
 
 
+def x509_DN_string(cert_x509):
+    x509_DN_str = ''
+    for k, v in cert_x509.get_subject().get_components():
+        x509_DN_str = (f'{x509_DN_str}/{k.decode()}={v.decode()}')
+    return x509_DN_str
+
+
+def _request_ns_jwt(jwt, DN_from_cert):
+    # When serving via AsyncPresidio, the JWT has already been verified
+    # (with the JWKS fetched asynchronously) before the request got here.
+    preverified = request.environ.get('presidio.ns_jwt_results')
+    if preverified:
+        jwt_result = preverified.get((jwt, DN_from_cert))
+        if jwt_result is not None:
+            return jwt_result
+
+    # Another worker may have verified this JWT already.
+    jwt_result = shared_ns_jwt_result(jwt, DN_from_cert)
+    if jwt_result is not None:
+        return jwt_result
+
+    jwt_result = process_ns_jwt(jwt, DN_from_cert)
+    share_ns_jwt_result(jwt, DN_from_cert, jwt_result)
+    return jwt_result
+
+
+def shared_ns_jwt_result(jwt, DN_from_cert):
+    """Returns the result of verifying this JWT, if any worker has done
+    so already; None otherwise."""
+    shared_claims = shared_cache_get('jwt', f'{DN_from_cert}|{jwt}')
+    if shared_claims is not None:
+        return check_ns_jwt_claims(shared_claims, DN_from_cert)
+    return None
+
+
+def share_ns_jwt_result(jwt, DN_from_cert, jwt_result):
+    jwt_claims = jwt_result[0]
+    if jwt_claims and not _use_unverified_jwt:
+        shared_cache_set('jwt', f'{DN_from_cert}|{jwt}', jwt_claims,
+                         shared_credential_expiry(jwt_claims.get('exp')))
+
+
+def _cert_not_after(cert_x509):
+    cert_not_after = datetime.strptime(
+        cert_x509.get_notAfter().decode('ascii'), '%Y%m%d%H%M%SZ')
+    return cert_not_after.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _verify_client_cert(cert_x509, ca_store):
+    # Another worker may have verified this certificate already, against
+    # the same set of CAs.
+    cert_digest = hashlib.sha256(request.cert.encode('utf-8')).hexdigest()
+    shared_key = f'{CA_store_generation(ca_store)}|{cert_digest}'
+    if shared_cache_get('cert', shared_key):
+        return True
+
+    x509_context = crypto.X509StoreContext(ca_store, cert_x509)
+    try:
+        verify_result = x509_context.verify_certificate()
+    except crypto.X509StoreContextError:
+        return False
+
+    # verify_result should be None, if the cert validated.
+    if verify_result is not None:
+        return False
+
+    shared_cache_set('cert', shared_key, True,
+                     shared_credential_expiry(_cert_not_after(cert_x509)))
+    return True
+
+
+def _issue_session_cookie(cert_x509, jwt_claims, ca_store):
+    session_exp = min(jwt_claims.get('exp'), _cert_not_after(cert_x509))
+    session_value = issue_session(request.cert, jwt_claims, session_exp,
+                                  CA_store_generation(ca_store))
+
+    @after_this_request
+    def set_session_cookie(response):
+        response.set_cookie(SESSION_COOKIE, value=session_value,
+                            expires=int(session_exp), secure=True,
+                            httponly=True, samesite='Lax')
+        return response
+
+
+def _log_credential_metrics():
+    cred_end = timer()
+    cred_message = (
+        f'Credential processing for request {request.uuid} '
+        f'completed in {cred_end - request.start_time} seconds'
+    )
+    METRICS_LOG.info(cred_message)
+
+
 def process_credentials():
     request.uuid = uuid.uuid4()
     request.start_time = timer()
 
+    if request.endpoint in _credential_exempt_endpoints:
+        return
+
     url_encoded_cert = request.headers.get('X-SSL-Cert')
     if url_encoded_cert:
         request.cert = urllib.parse.unquote(url_encoded_cert)
@@ -73,28 +202,30 @@ def process_credentials():
                            f'certificate or installing one into your '
                            f'browser.'))
 
-    cert_x509 = crypto.load_certificate(crypto.FILETYPE_PEM, request.cert)
-    x509_context = crypto.X509StoreContext(_CAStore, cert_x509)
-    try:
-        verify_result = x509_context.verify_certificate()
-    except crypto.X509StoreContextError:
-        return abort(401, (f'The client certificate your browser provided '
-                           f'failed to verify against the set of Certificate '
-                           f'Authorities recognized by this instance of '
-                           f'Presidio. Please contact your administrator for '
-                           f'assistance.'))
+    # Use the same CA store throughout, even if a reload swaps it.
+    ca_store = _CAStore
+
+    # A valid session cookie vouches for this certificate and JWT
+    # having been fully verified already.
+    if sessions_enabled() and not request.args.get('ImPACT-JWT'):
+        session_claims = check_session(request.cert,
+                                       request.cookies.get('ImPACT-JWT'),
+                                       request.cookies.get(SESSION_COOKIE),
+                                       CA_store_generation(ca_store))
+        if session_claims:
+            request.verified_jwt_claims = session_claims
+            _log_credential_metrics()
+            return
 
-    # verify_result should be None, if the cert validated.
-    if verify_result is not None:
+    cert_x509 = crypto.load_certificate(crypto.FILETYPE_PEM, request.cert)
+    if not _verify_client_cert(cert_x509, ca_store):
         return abort(401, (f'The client certificate your browser provided '
                            f'failed to verify against the set of Certificate '
                            f'Authorities recognized by this instance of '
                            f'Presidio. Please contact your administrator for '
                            f'assistance.'))
 
-    x509_DN_str = ''
-    for k, v in cert_x509.get_subject().get_components():
-        x509_DN_str = (f'{x509_DN_str}/{k.decode()}={v.decode()}')
+    x509_DN_str = x509_DN_string(cert_x509)
 
     jwt_claims = None
     jwt_error = None
@@ -102,7 +233,7 @@ def process_credentials():
         jwt_field = request.args.get('ImPACT-JWT')
         if jwt_field:
             jwt_expiration = None
-            (jwt_claims, jwt_error) = process_ns_jwt(jwt_field, x509_DN_str)
+            (jwt_claims, jwt_error) = _request_ns_jwt(jwt_field, x509_DN_str)
             if jwt_claims:
                 jwt_expiration = jwt_claims.get('exp')
             else:
@@ -121,7 +252,7 @@ def process_credentials():
     # We'll grab that and process it.
     jwt_cookie = request.cookies.get('ImPACT-JWT')
     if jwt_cookie:
-        (jwt_claims, jwt_error) = process_ns_jwt(jwt_cookie, x509_DN_str)
+        (jwt_claims, jwt_error) = _request_ns_jwt(jwt_cookie, x509_DN_str)
     else:
         return abort(401, (f'Cookie containing requisite information from '
                            f'Notary Service missing or expired. Please '
@@ -130,17 +261,14 @@ def process_credentials():
 
     if jwt_claims:
         request.verified_jwt_claims = jwt_claims
-        cred_end = timer()
-        cred_message = (
-            f'Credential processing for request {request.uuid} '
-            f'completed in {cred_end - request.start_time} seconds'
-        )
-        METRICS_LOG.info(cred_message)
+        if sessions_enabled() and not _use_unverified_jwt:
+            _issue_session_cookie(cert_x509, jwt_claims, ca_store)
+        _log_credential_metrics()
     else:
         return abort(401, jwt_error)
 
 
-def process_ns_jwt(jwt, DN_from_cert):
+def decode_ns_jwt(jwt):
     ns_jwt = NSJWT()
     ns_jwt.setToken(jwt)
 
@@ -148,101 +276,113 @@ def process_ns_jwt(jwt, DN_from_cert):
     try:
         ns_jwt.decode(publicKey=None, verify=False)
     except Exception:
-        return (None, 'Notary Service JWT failed unverified decode.')
+        return (None, None, 'Notary Service JWT failed unverified decode.')
 
     unverified_claims = None
     try:
         unverified_claims = ns_jwt.getClaims()
     except Exception:
-        return (None, 'Failed to extract unverified claims from JWT.')
+        return (None, None, 'Failed to extract unverified claims from JWT.')
 
-    verified_claims = None
-    if not _use_unverified_jwt:
-        ns_fqdn = unverified_claims.get('iss')
-        ns_jwks_resp = None
-        if ns_fqdn:
-            ns_jwks_url = f'https://{ns_fqdn}/jwks'
-            try:
-                ns_jwks_resp = get(ns_jwks_url, verify=True)
-            except Exception:
-                if nw_jwks_resp:
-                    nw_jwks_resp.close()
-                return (None, 'GET of JWKS from Notary Service failed.')
-        else:
-            return (None, 'Unable to find issuer in JWT claims.')
-
-        ns_jwks_status_code = None
-        ns_jwks_keys_json = None
-        if ns_jwks_resp:
-            ns_jwks_status_code = ns_jwks_resp.status_code
-            try:
-                ns_jwks_keys_json = ns_jwks_resp.json()
-            except Exception as e:
-                return (None, 'Invalid JWKS response from Notary Service.')
-            finally:
+    return (ns_jwt, unverified_claims, None)
+
+
+def ns_jwks_url(unverified_claims):
+    ns_fqdn = unverified_claims.get('iss')
+    if ns_fqdn:
+        return (f'https://{ns_fqdn}/jwks', None)
+    else:
+        return (None, 'Unable to find issuer in JWT claims.')
+
+
+def fetch_ns_jwks(jwks_url):
+    ns_jwks_resp = None
+    with JWKS_ADMISSION.admit():
+        try:
+            ns_jwks_resp = get(jwks_url, verify=True)
+        except Exception:
+            if ns_jwks_resp:
                 ns_jwks_resp.close()
+            return (None, None, 'GET of JWKS from Notary Service failed.')
+
+    ns_jwks_status_code = None
+    ns_jwks_keys_json = None
+    if ns_jwks_resp:
+        ns_jwks_status_code = ns_jwks_resp.status_code
+        try:
+            ns_jwks_keys_json = ns_jwks_resp.json()
+        except Exception as e:
+            return (None, None, 'Invalid JWKS response from Notary Service.')
+        finally:
+            ns_jwks_resp.close()
+
+    return (ns_jwks_status_code, ns_jwks_keys_json, None)
+
+
+def verify_ns_jwt(ns_jwt, ns_jwks_status_code, ns_jwks_keys_json,
+                  DN_from_cert):
+    if ns_jwks_status_code != 200:
+        return (None, 'GET of JWKS from Notary Service reported an error.')
 
-        if ns_jwks_status_code != 200:
-            return (None, 'GET of JWKS from Notary Service reported an error.')
-
-        ns_jwks_keys = None
-        if ns_jwks_keys_json:
-            ns_jwks_keys = ns_jwks_keys_json.get('keys')
-        else:
-            return (None, 'Empty JWKS returned by Notary Service.')
-
-        ns_pubkey = None
-        if ns_jwks_keys:
-            num_keys = 0
-            try:
-                num_keys = len(ns_jwks_keys)
-            except Exception:
-                return (None, 'Could not determine number of keys in JWKS.')
-
-            if not (num_keys > 0):
-                return (None, 'Invalid number of keys in JWKS.')
-
-            # Only grab the first key entry from the JWKS, then try to process.
-            ns_jwk_value = ns_jwks_keys[0]
-            try:
-                ns_jwk_json = json_dumps(ns_jwk_value).encode('utf-8')
-                ns_jwk = jwk.JWK.from_json(ns_jwk_json)
-                ns_jwk_pem = ns_jwk.export_to_pem().decode('utf-8')
-                ns_pubkey = crypto.load_publickey(crypto.FILETYPE_PEM,
-                                                  ns_jwk_pem)
-            except Exception:
-                return (None, 'Key entry could not be extracted from JWKS.')
-        else:
-            return (None, 'JWKS from Notary Service missing key container.')
-
-        if ns_pubkey:
-            try:
-                ns_pubkey_pem = crypto.dump_publickey(crypto.FILETYPE_PEM,
-                                                      ns_pubkey)
-                ns_jwt.decode(publicKey=ns_pubkey_pem)
-            except Exception:
-                return (None, 'Notary Service JWT failed verified decode.')
-        else:
-            return (None, 'No valid public key provided by JWT issuer.')
+    ns_jwks_keys = None
+    if ns_jwks_keys_json:
+        ns_jwks_keys = ns_jwks_keys_json.get('keys')
+    else:
+        return (None, 'Empty JWKS returned by Notary Service.')
 
+    ns_pubkey = None
+    if ns_jwks_keys:
+        num_keys = 0
         try:
-            verified_claims = ns_jwt.getClaims()
+            num_keys = len(ns_jwks_keys)
         except Exception:
-            return (None, 'Failed to extract verified claims from JWT.')
+            return (None, 'Could not determine number of keys in JWKS.')
 
-        computed_ns_token = generate_safe_principal_id(ns_pubkey)
-        ns_token = verified_claims.get('ns-token')
-        if ns_token:
-            if ns_token != computed_ns_token.decode('utf-8'):
-                return (None, (f'JWT ns-token does not match token '
-                               f'computed from public key.'))
-        else:
-            return (None, 'Unable to find ns-token in JWT claims.')
+        if not (num_keys > 0):
+            return (None, 'Invalid number of keys in JWKS.')
 
+        # Only grab the first key entry from the JWKS, then try to process.
+        ns_jwk_value = ns_jwks_keys[0]
+        try:
+            ns_jwk_json = json_dumps(ns_jwk_value).encode('utf-8')
+            ns_jwk = jwk.JWK.from_json(ns_jwk_json)
+            ns_jwk_pem = ns_jwk.export_to_pem().decode('utf-8')
+            ns_pubkey = crypto.load_publickey(crypto.FILETYPE_PEM,
+                                              ns_jwk_pem)
+        except Exception:
+            return (None, 'Key entry could not be extracted from JWKS.')
     else:
-        LOG.warning('BAD IDEA: Using unverified JWT claims, against advice...')
-        verified_claims = unverified_claims
+        return (None, 'JWKS from Notary Service missing key container.')
+
+    if ns_pubkey:
+        try:
+            ns_pubkey_pem = crypto.dump_publickey(crypto.FILETYPE_PEM,
+                                                  ns_pubkey)
+            ns_jwt.decode(publicKey=ns_pubkey_pem)
+        except Exception:
+            return (None, 'Notary Service JWT failed verified decode.')
+    else:
+        return (None, 'No valid public key provided by JWT issuer.')
 
+    verified_claims = None
+    try:
+        verified_claims = ns_jwt.getClaims()
+    except Exception:
+        return (None, 'Failed to extract verified claims from JWT.')
+
+    computed_ns_token = generate_safe_principal_id(ns_pubkey)
+    ns_token = verified_claims.get('ns-token')
+    if ns_token:
+        if ns_token != computed_ns_token.decode('utf-8'):
+            return (None, (f'JWT ns-token does not match token '
+                           f'computed from public key.'))
+    else:
+        return (None, 'Unable to find ns-token in JWT claims.')
+
+    return check_ns_jwt_claims(verified_claims, DN_from_cert)
+
+
+def check_ns_jwt_claims(verified_claims, DN_from_cert):
     expiry = verified_claims.get('exp')
     if expiry:
         dte = datetime.fromtimestamp(expiry)
@@ -260,3 +400,25 @@ def process_ns_jwt(jwt, DN_from_cert):
         return (None, 'Unable to find subject in JWT claims.')
 
     return (verified_claims, None)
+
+
+def process_ns_jwt(jwt, DN_from_cert):
+    (ns_jwt, unverified_claims, decode_error) = decode_ns_jwt(jwt)
+    if decode_error:
+        return (None, decode_error)
+
+    if _use_unverified_jwt:
+        LOG.warning('BAD IDEA: Using unverified JWT claims, against advice...')
+        return check_ns_jwt_claims(unverified_claims, DN_from_cert)
+
+    (jwks_url, url_error) = ns_jwks_url(unverified_claims)
+    if url_error:
+        return (None, url_error)
+
+    (ns_jwks_status_code, ns_jwks_keys_json,
+     fetch_error) = fetch_ns_jwks(jwks_url)
+    if fetch_error:
+        return (None, fetch_error)
+
+    return verify_ns_jwt(ns_jwt, ns_jwks_status_code, ns_jwks_keys_json,
+                         DN_from_cert)
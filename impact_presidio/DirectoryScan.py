@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from threading import Lock
+
+from flask_autoindex import File
+
+from impact_presidio.Logging import LOG
+from impact_presidio.CacheStats import register_cache, selector_matches
+from impact_presidio.IOPool import fs_call
+from impact_presidio.Lifecycle import register_post_fork_hook
+from impact_presidio.StaticAssets import listing_icon
+
+# Snapshots of directory scans - the entries, already stat'd, in each of
+# the orders a listing can be sorted by - kept in an LRU cache bounded by
+# the total number of entries held. A snapshot is reused for as long as
+# the directory's listing signature (see LabelMechs.listing_signature,
+# which listings compute anyway, for their ETag) is unchanged - that is,
+# until an entry is added, removed or renamed, or the directory's labels
+# change; a file rewritten in place keeps its old size and time in the
+# listing until then. Only the label filtering is done per request.
+_scan_cache = OrderedDict()
+_scan_cache_lock = Lock()
+_scan_cache_max_entries = 20000
+_scan_cache_entries = 0
+
+# Sort keys equivalent to flask_autoindex's Directory.explore comparison:
+# directories before files (except by modified time), and by name where
+# an entry lacks the attribute (i.e., the size of a directory).
+_sort_keys = {
+    'name': lambda e: (e.is_file, e.name),
+    'modified': lambda e: (e.modified,),
+    'size': lambda e: (e.is_file, e.size if e.is_file else e.name),
+}
+
+
+class ScannedEntry(object):
+    """Wraps a flask_autoindex Entry, with the results of the stat calls
+    the listing template needs already made."""
+
+    __slots__ = ('entry', 'modified', 'size', 'is_file')
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.modified = entry.modified
+        self.size = getattr(entry, 'size', None)
+        self.is_file = type(entry) is File
+
+    def __getattr__(self, name):
+        return getattr(self.entry, name)
+
+    def guess_icon(self):
+        return listing_icon(self.entry.guess_icon())
+
+
+class ScanSnapshot(object):
+    __slots__ = ('signature', 'parent', 'orders', 'num_entries')
+
+    def __init__(self, signature, parent, children):
+        self.signature = signature
+        self.parent = parent
+        self.num_entries = len(children)
+        self.orders = dict()
+        for sort_by, sort_key in _sort_keys.items():
+            self.orders[(sort_by, 1)] = sorted(children, key=sort_key)
+            # Not simply reversed; ties stay in name order either way.
+            self.orders[(sort_by, -1)] = sorted(children, key=sort_key,
+                                                reverse=True)
+
+
+def _invalidate_scans(selector):
+    global _scan_cache_entries
+    dropped = 0
+    with _scan_cache_lock:
+        for dir_path in list(_scan_cache.keys()):
+            if selector_matches(selector, path=dir_path):
+                snapshot = _scan_cache.pop(dir_path)
+                _scan_cache_entries -= snapshot.num_entries
+                dropped += 1
+    return dropped
+
+
+_scan_counters = register_cache(
+    'directory_scans', lambda: _scan_cache, _invalidate_scans)
+
+
+@register_post_fork_hook
+def _clear_scan_cache():
+    global _scan_cache_entries
+    with _scan_cache_lock:
+        _scan_cache.clear()
+        _scan_cache_entries = 0
+
+
+def _trim_scan_cache():
+    # Call with _scan_cache_lock held.
+    global _scan_cache_entries
+    while _scan_cache and (_scan_cache_entries > _scan_cache_max_entries):
+        _, snapshot = _scan_cache.popitem(last=False)
+        _scan_cache_entries -= snapshot.num_entries
+        _scan_counters.evictions += 1
+
+
+def scan_directory(curdir, sort_by, order, show_hidden):
+    """Lists, stats and sorts the entries of a directory, all in one
+    go; meant to be run via fs_call."""
+    entries = curdir.explore(sort_by=sort_by, order=order,
+                             show_hidden=show_hidden)
+    return [ScannedEntry(e) for e in entries]
+
+
+def _snapshot_directory(curdir, signature):
+    parent = None
+    children = []
+    for e in curdir.explore(show_hidden=True):
+        if e.name == '..':
+            parent = e
+        else:
+            children.append(ScannedEntry(e))
+    return ScanSnapshot(signature, parent, children)
+
+
+def cached_scan(curdir, signature, sort_by, order, show_hidden):
+    """Returns the (ScannedEntry wrapped) entries of a directory, as
+    scan_directory would, from a snapshot if the directory's listing
+    signature hasn't changed since it was taken."""
+    if _scan_cache_max_entries <= 0:
+        return fs_call(scan_directory, curdir, sort_by, order, show_hidden)
+
+    global _scan_cache_entries
+    dir_path = curdir.abspath
+    with _scan_cache_lock:
+        snapshot = _scan_cache.get(dir_path)
+        if (snapshot is not None) and (snapshot.signature == signature):
+            _scan_counters.hits += 1
+            _scan_cache.move_to_end(dir_path)
+        else:
+            snapshot = None
+            _scan_counters.misses += 1
+
+    if snapshot is None:
+        # Scanned without the lock held; the scan can take a while.
+        snapshot = fs_call(_snapshot_directory, curdir, signature)
+        with _scan_cache_lock:
+            previous = _scan_cache.pop(dir_path, None)
+            if previous is not None:
+                _scan_cache_entries -= previous.num_entries
+            _scan_cache[dir_path] = snapshot
+            _scan_cache_entries += snapshot.num_entries
+            _trim_scan_cache()
+
+    entries = []
+    if snapshot.parent is not None:
+        # The parent's modified time isn't covered by the signature.
+        entries.append(fs_call(ScannedEntry, snapshot.parent))
+    ordered = snapshot.orders.get((sort_by, order),
+                                  snapshot.orders[('name', order)])
+    if show_hidden:
+        entries.extend(ordered)
+    else:
+        entries.extend(e for e in ordered if not e.hidden)
+    return entries
+
+
+def configure_scan_cache(presidio_config):
+    global _scan_cache_max_entries
+
+    conf_max_entries = presidio_config.get('scan_cache_entries')
+    if conf_max_entries is not None:
+        if (type(conf_max_entries) is int) and (conf_max_entries >= 0):
+            _scan_cache_max_entries = conf_max_entries
+        else:
+            LOG.warning(('\"scan_cache_entries\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_scan_cache_max_entries}'))
+    with _scan_cache_lock:
+        _trim_scan_cache()
+
+    if _scan_cache_max_entries > 0:
+        LOG.info((f'Directory scans will be cached, for up to '
+                  f'{_scan_cache_max_entries} entries.'))
@@ -0,0 +1,211 @@
+import fcntl
+
+from contextlib import suppress
+from json import dumps as json_dumps, loads as json_loads
+from mmap import mmap, ACCESS_READ
+from os import fstat, getpid, remove, replace, scandir, stat
+from os.path import join
+from threading import Lock, Thread
+from time import sleep, time
+from timeit import default_timer as timer
+
+from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.IOPool import fs_call
+from impact_presidio.Lifecycle import register_worker_ready_hook
+
+# An index of every file under the project path, as (relative path, size,
+# mtime) tuples; searches read it, rather than walking the filesystem
+# while the requester waits. It's kept in a file (_index_file, in
+# /dev/shm by default) as JSON lines sorted by path, which every worker
+# maps into memory and searches by bisection, so there's one copy of it
+# per host. One worker at a time rebuilds it, holding a lock on
+# "<search_index_file>.lock", once it's _index_seconds old; until the
+# first build finishes (or when disabled), searches walk the filesystem
+# live instead.
+_index_root = None
+_index_seconds = 0
+_index_file = '/dev/shm/presidio-file-index'
+_index_map = None
+_index_version = None
+_index_map_lock = Lock()
+
+
+def _scan_dir(abs_dir):
+    subdirs = []
+    files = []
+    with scandir(abs_dir) as dir_entries:
+        for dir_entry in dir_entries:
+            try:
+                # Symlinked directories aren't followed, to avoid loops.
+                if dir_entry.is_dir(follow_symlinks=False):
+                    subdirs.append(dir_entry.name)
+                elif dir_entry.is_file():
+                    entry_stat = dir_entry.stat()
+                    files.append((dir_entry.name, entry_stat.st_size,
+                                  entry_stat.st_mtime))
+            except EnvironmentError:
+                # Broken links, entries removed while we're looking, etc.
+                continue
+    return (sorted(subdirs), sorted(files))
+
+
+def walk_files(root, rel_path=''):
+    """Yields (relative path, size, mtime) for each file under rel_path,
+    in path order, reading each directory via the filesystem pool."""
+    pending = [rel_path]
+    while pending:
+        rel_dir = pending.pop()
+        try:
+            subdirs, files = fs_call(_scan_dir, join(root, rel_dir))
+        except EnvironmentError:
+            continue
+        for name, size, mtime in files:
+            yield (join(rel_dir, name), size, mtime)
+        pending.extend(join(rel_dir, name) for name in reversed(subdirs))
+
+
+def _entry_at(index_map, line_start):
+    line_end = index_map.find(b'\n', line_start)
+    return json_loads(index_map[line_start:line_end])
+
+
+def _next_line_start(index_map, pos):
+    if pos == 0:
+        return 0
+    newline = index_map.find(b'\n', pos - 1)
+    return len(index_map) if newline < 0 else newline + 1
+
+
+def _first_line_from(index_map, prefix):
+    """Returns the offset of the first line whose path sorts at or after
+    prefix."""
+    low = 0
+    high = len(index_map)
+    while low < high:
+        mid = (low + high) // 2
+        line_start = _next_line_start(index_map, mid)
+        if ((line_start < len(index_map)) and
+                (_entry_at(index_map, line_start)[0] < prefix)):
+            low = mid + 1
+        else:
+            high = mid
+    return _next_line_start(index_map, low)
+
+
+def _current_index_map():
+    """Returns the mapping of the index file, re-mapping it if another
+    worker has rebuilt it; None if there's no index yet."""
+    global _index_map, _index_version
+    try:
+        with open(_index_file, 'rb') as index_fd:
+            index_stat = fstat(index_fd.fileno())
+            index_version = (index_stat.st_ino, index_stat.st_mtime_ns)
+            with _index_map_lock:
+                if index_version != _index_version:
+                    if index_stat.st_size == 0:
+                        return None
+                    # A previous mapping is left to be closed once any
+                    # searches still reading it are done with it.
+                    _index_map = mmap(index_fd.fileno(), 0,
+                                      access=ACCESS_READ)
+                    _index_version = index_version
+                return _index_map
+    except EnvironmentError:
+        return None
+
+
+def indexed_files(rel_path=''):
+    """Yields (relative path, size, mtime) for each file under rel_path,
+    from the index if it has been built."""
+    index_map = fs_call(_current_index_map) if _index_seconds > 0 else None
+    if index_map is None:
+        yield from walk_files(_index_root, rel_path)
+        return
+
+    prefix = f'{rel_path}/' if rel_path else ''
+    line_start = _first_line_from(index_map, prefix)
+    while line_start < len(index_map):
+        line_end = index_map.find(b'\n', line_start)
+        entry = json_loads(index_map[line_start:line_end])
+        if not entry[0].startswith(prefix):
+            break
+        yield tuple(entry)
+        line_start = line_end + 1
+
+
+def build_index():
+    build_start = timer()
+    index_entries = sorted(walk_files(_index_root))
+    temp_path = f'{_index_file}.{getpid()}.tmp'
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as temp_file:
+            for entry in index_entries:
+                temp_file.write(json_dumps(entry, separators=(',', ':')))
+                temp_file.write('\n')
+        replace(temp_path, _index_file)
+    except Exception:
+        with suppress(EnvironmentError):
+            remove(temp_path)
+        raise
+    build_end = timer()
+    METRICS_LOG.info((f'File index of {len(index_entries)} files '
+                      f'built in {build_end - build_start} seconds'))
+
+
+def _index_is_current():
+    try:
+        index_age = time() - stat(_index_file).st_mtime
+    except EnvironmentError:
+        return False
+    return index_age < _index_seconds
+
+
+def _build_unless_locked():
+    with open(f'{_index_file}.lock', 'a') as lock_file:
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Another worker is already at it.
+            return
+        # Or has already done it, this time around.
+        if not _index_is_current():
+            build_index()
+
+
+def _maintain_index():
+    while True:
+        try:
+            _build_unless_locked()
+        except Exception as e:
+            LOG.error('Error occurred while building file index!')
+            LOG.error('Error message:')
+            LOG.error(e)
+        sleep(_index_seconds)
+
+
+def _start_index_builder():
+    builder = Thread(target=_maintain_index, name='presidio-file-index',
+                     daemon=True)
+    builder.start()
+
+
+def configure_file_index(presidio_config, project_path):
+    global _index_root, _index_seconds, _index_file
+    _index_root = str(project_path)
+    _index_file = presidio_config.get('search_index_file', _index_file)
+
+    conf_index_seconds = presidio_config.get('search_index_seconds')
+    if conf_index_seconds is not None:
+        if (((type(conf_index_seconds) is int) or
+             (type(conf_index_seconds) is float)) and
+                (conf_index_seconds >= 0)):
+            _index_seconds = conf_index_seconds
+        else:
+            LOG.warning(('\"search_index_seconds\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning('Searches will walk the filesystem directly.')
+
+    if _index_seconds > 0:
+        LOG.info((f'File index will be rebuilt every '
+                  f'{_index_seconds} seconds.'))
+        register_worker_ready_hook(_start_index_builder)
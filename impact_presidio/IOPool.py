@@ -0,0 +1,136 @@
+from threading import BoundedSemaphore, Lock
+from timeit import default_timer as timer
+
+from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.Lifecycle import register_worker_ready_hook
+
+# Filesystem operations (stat, open, listdir, getxattr) block whatever
+# thread issues them; under the gevent worker, that means every greenlet
+# in the worker. When configured, such operations are sent through a
+# pool of native threads instead, so that one slow stat on network
+# storage only holds up the request that made it.
+_pool = None
+_pool_size = 0
+_pool_queue = None
+_queue_slots = None
+_slow_op_seconds = 0.05
+
+_op_stats = dict()
+_op_stats_lock = Lock()
+
+
+def _record_op(op_name, elapsed):
+    with _op_stats_lock:
+        count, total, longest = _op_stats.get(op_name, (0, 0.0, 0.0))
+        _op_stats[op_name] = (count + 1, total + elapsed,
+                              max(longest, elapsed))
+    if elapsed > _slow_op_seconds:
+        METRICS_LOG.info((f'Slow filesystem operation {op_name} '
+                          f'completed in {elapsed} seconds'))
+
+
+def fs_stats():
+    """Returns the count, total and maximum time (in seconds) of each
+    kind of filesystem operation performed via fs_call."""
+    with _op_stats_lock:
+        return {op_name: {'count': count, 'total_seconds': total,
+                          'max_seconds': longest}
+                for op_name, (count, total, longest) in _op_stats.items()}
+
+
+def fs_pool_configured():
+    """Returns whether filesystem operations are to be sent through a
+    thread pool (rather than run inline, on the calling greenlet)."""
+    return _pool_size > 0
+
+
+def _capture_result(fs_fn, args, kwargs):
+    # Missing files are routine here (e.g. directories with no SafeLabels
+    # file); hand exceptions back to the caller rather than letting the
+    # pool's hub report them.
+    try:
+        return (fs_fn(*args, **kwargs), None)
+    except BaseException as e:
+        return (None, e)
+
+
+def fs_call(fs_fn, *args, **kwargs):
+    """Runs fs_fn(*args, **kwargs), on the filesystem thread pool if
+    one has been configured, and returns its result (or raises its
+    exception)."""
+    op_start = timer()
+    if _pool is None:
+        try:
+            return fs_fn(*args, **kwargs)
+        finally:
+            _record_op(fs_fn.__name__, timer() - op_start)
+
+    # Bound the number of operations waiting on the pool; beyond that,
+    # callers wait (cooperatively) for a slot.
+    with _queue_slots:
+        try:
+            result, error = _pool.apply(_capture_result,
+                                        (fs_fn, args, kwargs))
+        finally:
+            _record_op(fs_fn.__name__, timer() - op_start)
+    if error is not None:
+        raise error
+    return result
+
+
+def _start_fs_pool():
+    global _pool, _queue_slots
+    try:
+        from gevent import monkey
+        from gevent.threadpool import ThreadPool
+    except ImportError:
+        LOG.info('gevent unavailable; filesystem thread pool not started.')
+        return
+
+    if not monkey.is_module_patched('threading'):
+        # Not running under the gevent worker; blocking calls only
+        # block the calling thread, so there's nothing to gain.
+        LOG.info('Not running under gevent; filesystem thread pool unused.')
+        return
+
+    _queue_slots = BoundedSemaphore(_pool_size + _pool_queue)
+    _pool = ThreadPool(_pool_size)
+    LOG.info((f'Filesystem thread pool started with {_pool_size} threads '
+              f'and room for {_pool_queue} queued operations.'))
+
+
+def configure_fs_pool(presidio_config):
+    global _pool_size, _pool_queue, _slow_op_seconds
+
+    conf_pool_size = presidio_config.get('fs_threadpool_size')
+    if conf_pool_size is not None:
+        if (type(conf_pool_size) is int) and (conf_pool_size >= 0):
+            _pool_size = conf_pool_size
+        else:
+            LOG.warning(('\"fs_threadpool_size\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning('Filesystem thread pool will be disabled.')
+
+    _pool_queue = 4 * _pool_size
+    conf_pool_queue = presidio_config.get('fs_threadpool_queue')
+    if conf_pool_queue is not None:
+        if (type(conf_pool_queue) is int) and (conf_pool_queue >= 0):
+            _pool_queue = conf_pool_queue
+        else:
+            LOG.warning(('\"fs_threadpool_queue\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning(f'Proceeding with default value: {_pool_queue}')
+
+    conf_slow_op_seconds = presidio_config.get('fs_slow_op_seconds')
+    if conf_slow_op_seconds is not None:
+        if (((type(conf_slow_op_seconds) is int) or
+             (type(conf_slow_op_seconds) is float)) and
+                (conf_slow_op_seconds >= 0)):
+            _slow_op_seconds = conf_slow_op_seconds
+        else:
+            LOG.warning(('\"fs_slow_op_seconds\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning(f'Proceeding with default value: {_slow_op_seconds}')
+
+    if _pool_size > 0:
+        register_worker_ready_hook(_start_fs_pool)
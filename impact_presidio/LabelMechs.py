@@ -1,3 +1,4 @@
+from os import stat
 from os.path import basename, isdir
 from pathlib import Path
 from re import search as re_search
@@ -5,29 +6,86 @@ from xattr import xattr
 from yaml import safe_load, YAMLError
 
 from impact_presidio.Logging import LOG
+from impact_presidio.CacheStats import path_within, register_cache
+from impact_presidio.CacheStats import selector_matches
+from impact_presidio.Lifecycle import register_post_fork_hook
+from impact_presidio.IOPool import fs_call
+
+_default_safelabels_filename = '.safelabels'
+_default_xattr_label_base = 'user.us.cyberimpact.SAFE.SCID'
 
 _label_mech_fn = None
 _project_path = None
-_safelabels_filename = '.safelabels'
+_safelabels_filename = _default_safelabels_filename
 _safelabels_cache = dict()
-_xattr_label_base = 'user.us.cyberimpact.SAFE.SCID'
+_xattr_label_base = _default_xattr_label_base
+
+
+@register_post_fork_hook
+def _reset_safelabels_cache():
+    _safelabels_cache.clear()
+
+
+def safelabels_matches(selector, sl_path):
+    """Returns whether the SafeLabels file at sl_path matches an
+    invalidation selector."""
+    # The labels from a SafeLabels file apply to everything beneath its
+    # directory; so, a file in any ancestor of the path prefix matches.
+    path_prefix = selector.get('path_prefix')
+    sl_dir = str(Path(sl_path).parent)
+    return (selector_matches(selector, path=sl_dir) or
+            bool(path_prefix and path_within(path_prefix, sl_dir)))
+
+
+def _invalidate_safelabels(selector):
+    dropped = 0
+    for sl_path in list(_safelabels_cache.keys()):
+        if safelabels_matches(selector, sl_path):
+            _safelabels_cache.pop(sl_path, None)
+            dropped += 1
+    return dropped
+
+
+_safelabels_counters = register_cache(
+    'safelabels', lambda: _safelabels_cache, _invalidate_safelabels)
+
+
+def _walk_ended(cur_path):
+    # Walks up from a path end above the project path; or, for a path
+    # that isn't within it, at the root (which is its own parent).
+    return ((cur_path == _project_path.parent) or
+            (cur_path == cur_path.parent))
+
+
+def _within_project(path):
+    return path_within(str(path), str(_project_path))
+
+
+def _stat_safelabels(sl_path):
+    return sl_path.stat().st_mtime
+
+
+def _load_safelabels(sl_path):
+    with open(sl_path, 'r') as sl:
+        return safe_load(sl)
 
 
 def _get_safelabels(cur_path):
     sl_path = Path((cur_path / _safelabels_filename))
-    sl_mtime = sl_path.stat().st_mtime
+    sl_mtime = fs_call(_stat_safelabels, sl_path)
 
     cached_sl, cached_mtime = _safelabels_cache.get(sl_path,
                                                     (None, None))
 
     if cached_sl:
         if (cached_mtime == sl_mtime):
+            _safelabels_counters.hits += 1
             return cached_sl
 
-    with open(sl_path, 'r') as sl:
-        safeLabels = safe_load(sl)
-        _safelabels_cache[sl_path] = (safeLabels, sl_mtime)
-        return safeLabels
+    _safelabels_counters.misses += 1
+    safeLabels = fs_call(_load_safelabels, sl_path)
+    _safelabels_cache[sl_path] = (safeLabels, sl_mtime)
+    return safeLabels
 
 
 def SafeLabelsFileCheck(path, dataset_SCID):
@@ -39,11 +97,11 @@ def SafeLabelsFileCheck(path, dataset_SCID):
         return False
 
     cur_path = Path(path)
-    if not isdir(cur_path):
+    if not fs_call(isdir, cur_path):
         cur_path = cur_path.parent
 
     safeLabels = None
-    while cur_path != _project_path.parent:
+    while not _walk_ended(cur_path):
         LOG.debug(f'cur_path is: {cur_path}')
         try:
             safeLabels = _get_safelabels(cur_path)
@@ -70,22 +128,7 @@ def SafeLabelsFileCheck(path, dataset_SCID):
 
         # Proceeding under the assumption that the safelabels file
         # loaded properly.
-        file_version = safeLabels.get('version')
-        if file_version is None:
-            LOG.warning('SafeLabels file missing \'version\' specifier.')
-            LOG.warning('Will attempt to check according to the most recent')
-            LOG.warning('version specification...')
-        elif file_version == 1.0:
-            # Base case, since we have only one version, right now.
-            pass
-        else:
-            # Sigh. Specified an invalid version.
-            # Try to parse using the most recent version,
-            # and let the chips fall where they may.
-            LOG.warning(('SafeLabels file found with invalid ' +
-                         '\'version\' specified.'))
-            LOG.warning('Will attempt to check according to the most recent')
-            LOG.warning('version specification...')
+        _check_safelabels_version(safeLabels)
         label_check = SafeLabelsChecker_v1(path, dataset_SCID, safeLabels)
         if label_check:
             LOG.debug(f'Matching SCID found for {path}')
@@ -99,6 +142,25 @@ def SafeLabelsFileCheck(path, dataset_SCID):
     return False
 
 
+def _check_safelabels_version(safeLabels):
+    file_version = safeLabels.get('version')
+    if file_version is None:
+        LOG.warning('SafeLabels file missing \'version\' specifier.')
+        LOG.warning('Will attempt to check according to the most recent')
+        LOG.warning('version specification...')
+    elif file_version == 1.0:
+        # Base case, since we have only one version, right now.
+        pass
+    else:
+        # Sigh. Specified an invalid version.
+        # Try to parse using the most recent version,
+        # and let the chips fall where they may.
+        LOG.warning(('SafeLabels file found with invalid ' +
+                     '\'version\' specified.'))
+        LOG.warning('Will attempt to check according to the most recent')
+        LOG.warning('version specification...')
+
+
 def SafeLabelsChecker_v1(path, dataset_SCID, safeLabels):
     per_file_overrides = safeLabels.get('overrides')
     if per_file_overrides is None:
@@ -155,20 +217,42 @@ def SafeLabelsChecker_v1(path, dataset_SCID, safeLabels):
     return False
 
 
+def _read_label_xattrs(cur_path):
+    # Reads all of the label attributes for a path in one go, so that
+    # only one trip through the filesystem thread pool is needed. A path
+    # that doesn't exist (yet - e.g. an upload's target) has no labels of
+    # its own.
+    try:
+        path_attrs = xattr(cur_path)
+        return [(attr, path_attrs[attr]) for attr in path_attrs.list()
+                if _xattr_label_base in attr]
+    except FileNotFoundError:
+        return []
+
+
+def copy_label_xattrs(source_path, dest_path):
+    """Gives dest_path the label attributes of source_path, when using
+    the extended attribute mechanism; for files about to take the place
+    of (or be served alongside) source_path. Call via fs_call."""
+    if _label_mech_fn != ExtendedAttributeLabelCheck:
+        return
+    dest_attrs = xattr(dest_path)
+    for attr, attr_value in _read_label_xattrs(source_path):
+        dest_attrs.set(attr, attr_value)
+
+
 def ExtendedAttributeLabelCheck(path, dataset_SCID):
     cur_path = Path(path)
     LOG.debug(f'_project_path is: {_project_path}')
     LOG.debug(f'_project_path.parent is: {_project_path.parent}')
-    while cur_path != _project_path.parent:
+    while not _walk_ended(cur_path):
         LOG.debug(f'cur_path is: {cur_path}')
-        path_attrs = xattr(cur_path)
-        attr_key_list = [e for e in path_attrs.list()
-                         if _xattr_label_base in e]
+        label_attrs = fs_call(_read_label_xattrs, cur_path)
 
-        if attr_key_list:
-            for attr in attr_key_list:
+        if label_attrs:
+            for attr, attr_value in label_attrs:
                 LOG.debug(f'Checking xattr: {attr} for path: {cur_path}')
-                if (path_attrs[attr]).decode('utf-8') == dataset_SCID:
+                if attr_value.decode('utf-8') == dataset_SCID:
                     LOG.debug(f'Matching SCID found for {path}')
                     return True
             # If we got here, we got to the end of the list of
@@ -185,37 +269,219 @@ def ExtendedAttributeLabelCheck(path, dataset_SCID):
     return False
 
 
+def _safelabels_signature(path):
+    # The SafeLabels file that applies is the nearest one; so, the
+    # presence (or not) of each one up to and including it matters.
+    cur_path = Path(path)
+    if not isdir(cur_path):
+        cur_path = cur_path.parent
+
+    signature = []
+    while not _walk_ended(cur_path):
+        try:
+            sl_stat = stat(cur_path / _safelabels_filename)
+        except EnvironmentError:
+            signature.append(None)
+            cur_path = cur_path.parent
+            continue
+        signature.append((sl_stat.st_ino, sl_stat.st_mtime_ns,
+                          sl_stat.st_size))
+        break
+    return tuple(signature)
+
+
+def _xattr_signature(path):
+    # Setting or removing an extended attribute updates the ctime.
+    cur_path = Path(path)
+    signature = []
+    while not _walk_ended(cur_path):
+        try:
+            signature.append(stat(cur_path).st_ctime_ns)
+        except EnvironmentError:
+            signature.append(None)
+        cur_path = cur_path.parent
+    return tuple(signature)
+
+
+def label_signature(path):
+    """Returns a value that changes whenever the labels that apply to path
+    (might) have changed, for use in validating cached decisions."""
+    if _label_mech_fn == ExtendedAttributeLabelCheck:
+        return fs_call(_xattr_signature, path)
+    return fs_call(_safelabels_signature, path)
+
+
+def _listing_signature(dir_path):
+    # Adding, removing or renaming an entry updates the directory's mtime;
+    # changing its own extended attributes, its ctime. Entries' labels are
+    # checked per request, as the listing is filtered.
+    dir_stat = stat(dir_path)
+    return (dir_stat.st_ino, dir_stat.st_mtime_ns, dir_stat.st_ctime_ns)
+
+
+def listing_signature(dir_path):
+    """Returns a value that changes whenever the entries of dir_path, or
+    the labels that apply to dir_path itself, (might) have changed; from a
+    single stat of the directory, along with those of its label sources."""
+    return (fs_call(_listing_signature, dir_path),
+            label_signature(dir_path))
+
+
 def configure_label_mech(presidio_config, project_path):
     global _project_path
     _project_path = Path(project_path)
 
     global _label_mech_fn
-    _label_mech_fn = SafeLabelsFileCheck
+    global _safelabels_filename
+    global _xattr_label_base
+    label_mech_fn = SafeLabelsFileCheck
+    safelabels_filename = _default_safelabels_filename
+    xattr_label_base = _default_xattr_label_base
 
     conf_label_mech = presidio_config.get('label_mech')
     if conf_label_mech:
         conf_label_mech = conf_label_mech.lower()
         if conf_label_mech == 'xattr':
-            _label_mech_fn = ExtendedAttributeLabelCheck
+            label_mech_fn = ExtendedAttributeLabelCheck
         elif conf_label_mech != 'safelabels':
             LOG.warning('Unknown value specified for \"label_mech\"')
             LOG.warning('in configuration file.')
     else:
         LOG.warning('\"label_mech\" entry not specified in configuration.')
 
-    if _label_mech_fn == ExtendedAttributeLabelCheck:
+    if label_mech_fn == ExtendedAttributeLabelCheck:
         LOG.info('Using extended attribute mechanism for SAFE labels.')
         conf_xattr_label_base = presidio_config.get('xattr_label_base')
         if conf_xattr_label_base:
-            _xattr_label_base = conf_xattr_label_base
-        LOG.info(f'Extended attribute label base is: {_xattr_label_base}')
+            xattr_label_base = conf_xattr_label_base
+        LOG.info(f'Extended attribute label base is: {xattr_label_base}')
     else:
         LOG.info('Using default SafeLabels file mechanism for SAFE labels.')
         conf_safelabels_filename = presidio_config.get('safelabels_filename')
         if conf_safelabels_filename:
-            _safelabels_filename = conf_safelabels_filename
-        LOG.info(f'SafeLabels file name is: {_safelabels_filename}')
+            safelabels_filename = conf_safelabels_filename
+        LOG.info(f'SafeLabels file name is: {safelabels_filename}')
+
+    # Cached SafeLabels files are only of use if we're still using
+    # the same mechanism, and looking for files with the same name.
+    if ((label_mech_fn != _label_mech_fn) or
+            (safelabels_filename != _safelabels_filename)):
+        _safelabels_cache.clear()
+
+    _xattr_label_base = xattr_label_base
+    _safelabels_filename = safelabels_filename
+    _label_mech_fn = label_mech_fn
+
+
+def is_label_file(name):
+    """Returns whether name is that of a SafeLabels file; such files
+    are never served, and may never be written by requesters."""
+    return name == _safelabels_filename
 
 
 def check_labels(path, dataset_SCID):
+    if not _within_project(path):
+        LOG.debug(f'Disallowing access to path outside project: {path}')
+        return False
     return _label_mech_fn(path, dataset_SCID)
+
+
+class LabelBatch(object):
+    """Checks the labels of many paths against one dataset SCID, as
+    check_labels would; but the labels that apply to each ancestor
+    directory are only looked up once, for the whole batch."""
+
+    # Stands in for a SafeLabels file that couldn't be parsed.
+    _unparseable = object()
+
+    def __init__(self, dataset_SCID):
+        self.dataset_SCID = dataset_SCID
+        self.label_mech_fn = _label_mech_fn
+        self.resolved = dict()
+
+    def check(self, path, is_dir=None):
+        """Returns whether the labels of path permit access; is_dir may
+        be given, where it's already known, to save a stat."""
+        if not _within_project(path):
+            return False
+        if self.label_mech_fn == SafeLabelsFileCheck:
+            return self._check_safelabels(path, is_dir)
+        if self.label_mech_fn == ExtendedAttributeLabelCheck:
+            return self._check_xattrs(path, is_dir)
+        return check_labels(path, self.dataset_SCID)
+
+    def _nearest_safelabels(self, dir_path):
+        # Walk up to the nearest SafeLabels file (or to a directory that
+        # has already been resolved); everything on the way shares it.
+        unresolved = []
+        safeLabels = None
+        cur_path = dir_path
+        while not _walk_ended(cur_path):
+            if cur_path in self.resolved:
+                safeLabels = self.resolved[cur_path]
+                break
+            unresolved.append(cur_path)
+            try:
+                safeLabels = _get_safelabels(cur_path)
+                _check_safelabels_version(safeLabels)
+            except EnvironmentError:
+                cur_path = cur_path.parent
+                continue
+            except YAMLError as ye:
+                # Fail safe, as SafeLabelsFileCheck does.
+                LOG.error('Encountered error while parsing SafeLabels file!')
+                LOG.error('Error message:')
+                LOG.error(ye)
+                LOG.error(f'Failing safe, and disallowing access under: '
+                          f'{cur_path}')
+                safeLabels = self._unparseable
+            break
+        for resolved_path in unresolved:
+            self.resolved[resolved_path] = safeLabels
+        return safeLabels
+
+    def _check_safelabels(self, path, is_dir):
+        if basename(path) == _safelabels_filename:
+            return False
+        cur_path = Path(path)
+        if is_dir is None:
+            is_dir = fs_call(isdir, cur_path)
+        if not is_dir:
+            cur_path = cur_path.parent
+        safeLabels = self._nearest_safelabels(cur_path)
+        if (safeLabels is None) or (safeLabels is self._unparseable):
+            return False
+        return SafeLabelsChecker_v1(str(path), self.dataset_SCID, safeLabels)
+
+    def _labels_match(self, label_attrs):
+        return any(attr_value.decode('utf-8') == self.dataset_SCID
+                   for _, attr_value in label_attrs)
+
+    def _xattr_decision(self, dir_path):
+        # The nearest labeled directory decides, for everything on the way.
+        unresolved = []
+        decision = False
+        cur_path = dir_path
+        while not _walk_ended(cur_path):
+            if cur_path in self.resolved:
+                decision = self.resolved[cur_path]
+                break
+            unresolved.append(cur_path)
+            label_attrs = fs_call(_read_label_xattrs, cur_path)
+            if label_attrs:
+                decision = self._labels_match(label_attrs)
+                break
+            cur_path = cur_path.parent
+        for resolved_path in unresolved:
+            self.resolved[resolved_path] = decision
+        return decision
+
+    def _check_xattrs(self, path, is_dir):
+        cur_path = Path(path)
+        if not is_dir:
+            # A file's own labels come first.
+            label_attrs = fs_call(_read_label_xattrs, cur_path)
+            if label_attrs:
+                return self._labels_match(label_attrs)
+            cur_path = cur_path.parent
+        return self._xattr_decision(cur_path)
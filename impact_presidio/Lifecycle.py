@@ -0,0 +1,60 @@
+from impact_presidio.Logging import LOG, reopen_log_handlers
+
+# Hooks that get run in each gunicorn worker, just after it is forked
+# from the master. When the application is preloaded, everything set up
+# at import time is shared (copy-on-write) between the master and all of
+# the workers; anything that must *not* be shared (caches, open log files,
+# connection pools) should register a hook here that re-initializes it.
+_post_fork_hooks = []
+
+# Hooks that get run in each gunicorn worker, once it has finished
+# loading the application, but before it begins accepting requests.
+_worker_ready_hooks = []
+
+# Hooks that get run in each gunicorn worker, as it exits.
+_worker_exit_hooks = []
+
+
+def register_post_fork_hook(hook_fn):
+    if hook_fn not in _post_fork_hooks:
+        _post_fork_hooks.append(hook_fn)
+    return hook_fn
+
+
+def register_worker_ready_hook(hook_fn):
+    if hook_fn not in _worker_ready_hooks:
+        _worker_ready_hooks.append(hook_fn)
+    return hook_fn
+
+
+def register_worker_exit_hook(hook_fn):
+    if hook_fn not in _worker_exit_hooks:
+        _worker_exit_hooks.append(hook_fn)
+    return hook_fn
+
+
+def _run_hooks(hook_list, hook_type):
+    for hook_fn in hook_list:
+        try:
+            hook_fn()
+        except Exception as e:
+            LOG.error(f'Error occurred while running {hook_type} hook: '
+                      f'{hook_fn.__module__}.{hook_fn.__name__}')
+            LOG.error('Error message:')
+            LOG.error(e)
+
+
+def run_post_fork_hooks():
+    _run_hooks(_post_fork_hooks, 'post-fork')
+
+
+def run_worker_ready_hooks():
+    _run_hooks(_worker_ready_hooks, 'worker ready')
+
+
+def run_worker_exit_hooks():
+    _run_hooks(_worker_exit_hooks, 'worker exit')
+
+
+# Log files opened by the master must be re-opened by each worker.
+register_post_fork_hook(reopen_log_handlers)
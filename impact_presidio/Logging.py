@@ -103,3 +103,19 @@ def create_metrics_logger():
     METRICS_LOG.setLevel(logging.INFO)
     METRICS_LOG.addHandler(handler)
     METRICS_LOG.propagate = False
+
+
+def reopen_log_handlers():
+    # File handlers opened in the gunicorn master get inherited by each
+    # forked worker; close our copy of the stream, so that the handler
+    # lazily opens its own on the next emit().
+    for logger in [LOG, METRICS_LOG]:
+        for handler in logger.handlers:
+            if isinstance(handler, logging.FileHandler):
+                handler.acquire()
+                try:
+                    if handler.stream:
+                        handler.stream.close()
+                    handler.stream = None
+                finally:
+                    handler.release()
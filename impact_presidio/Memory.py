@@ -0,0 +1,263 @@
+import gc
+import os
+import resource
+import signal
+
+from collections import deque
+from datetime import datetime
+from json import dumps as json_dumps
+from os.path import join
+from tempfile import gettempdir
+from threading import Event, Thread
+from time import time
+
+from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.CacheStats import cache_stats
+from impact_presidio.Lifecycle import register_worker_ready_hook
+
+# tracemalloc isn't available on PyPy.
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Optional memory diagnostics for long-running workers: a periodic sample
+# of each worker's RSS and, with tracemalloc, of where the Python heap has
+# grown since the previous sample (by allocation site). Reports also
+# include the entry counts and approximate sizes of the caches.
+#
+# Reports are available locally, from the admin interface; or, on SIGUSR2
+# to a worker process (not the master, for which it means something else
+# entirely), written to a file in "dump_dir".
+_memory_enabled = False
+_memory_sample_seconds = 60
+_memory_history_samples = 60
+_memory_tracemalloc = False
+_memory_tracemalloc_frames = 1
+_memory_top = 20
+_memory_dump_dir = gettempdir()
+
+_rss_history = deque(maxlen=_memory_history_samples)
+_baseline_snapshot = None
+_previous_snapshot = None
+_previous_snapshot_time = None
+_last_growth = None
+_dump_requested = Event()
+
+# Allocations made by tracemalloc itself, and by importing, are not of
+# interest.
+_snapshot_filters = None
+if tracemalloc is not None:
+    _snapshot_filters = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    )
+
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (EnvironmentError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss():
+    # Reported in kilobytes, on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _tracing():
+    return (tracemalloc is not None) and tracemalloc.is_tracing()
+
+
+def _take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(_snapshot_filters)
+
+
+def _growth(snapshot, earlier_snapshot, top):
+    key_type = 'traceback' if _memory_tracemalloc_frames > 1 else 'lineno'
+    growth = []
+    for stat_diff in snapshot.compare_to(earlier_snapshot, key_type)[:top]:
+        growth.append({
+            'site': [str(frame) for frame in stat_diff.traceback],
+            'size': stat_diff.size,
+            'size_diff': stat_diff.size_diff,
+            'count': stat_diff.count,
+            'count_diff': stat_diff.count_diff,
+        })
+    return growth
+
+
+def _sample_memory():
+    global _last_growth
+    rss = _current_rss()
+    _rss_history.append((round(time()), rss))
+    memory_message = f'Memory sample: RSS {rss} bytes'
+
+    if _tracing():
+        snapshot = _take_snapshot()
+        if _previous_snapshot is not None:
+            _last_growth = {
+                'since': _previous_snapshot_time,
+                'sites': _growth(snapshot, _previous_snapshot, _memory_top),
+            }
+        _remember_snapshot(snapshot)
+        traced_current, traced_peak = tracemalloc.get_traced_memory()
+        memory_message += (f'; traced {traced_current} bytes '
+                           f'(peak {traced_peak})')
+    METRICS_LOG.info(memory_message)
+
+
+def _remember_snapshot(snapshot):
+    global _previous_snapshot, _previous_snapshot_time
+    _previous_snapshot = snapshot
+    _previous_snapshot_time = round(time())
+
+
+def memory_report(compare_to='previous', top=None):
+    """Returns this worker's RSS (current, peak and recent samples), the
+    sizes of its caches, garbage collector counts and, if tracemalloc is
+    tracing, where the heap has grown - between the last two samples, or
+    (with compare_to 'baseline') since the worker became ready."""
+    top = top or _memory_top
+    report = {
+        'pid': os.getpid(),
+        'time': round(time()),
+        'rss_bytes': _current_rss(),
+        'peak_rss_bytes': _peak_rss(),
+        'rss_history': list(_rss_history),
+        'caches': {cache_name: {'entries': stats['entries'],
+                                'approximate_bytes':
+                                    stats['approximate_bytes']}
+                   for cache_name, stats in cache_stats().items()},
+        'gc': {'counts': gc.get_count(), 'garbage': len(gc.garbage)},
+    }
+
+    if not _tracing():
+        report['tracemalloc'] = None
+        return report
+
+    traced_current, traced_peak = tracemalloc.get_traced_memory()
+    traced_report = {'traced_bytes': traced_current,
+                     'traced_peak_bytes': traced_peak}
+    if (compare_to == 'baseline') and (_baseline_snapshot is not None):
+        traced_report['growth'] = {
+            'since': 'baseline',
+            'sites': _growth(_take_snapshot(), _baseline_snapshot, top),
+        }
+    elif _last_growth is not None:
+        traced_report['growth'] = dict(_last_growth,
+                                       sites=_last_growth['sites'][:top])
+    else:
+        traced_report['growth'] = None
+    report['tracemalloc'] = traced_report
+    return report
+
+
+def dump_memory_report():
+    """Writes a memory report (with growth since the baseline) to a file
+    in dump_dir; returns its path."""
+    report = memory_report(compare_to='baseline')
+    dump_time = datetime.now().strftime('%Y%m%d-%H%M%S')
+    dump_path = join(_memory_dump_dir,
+                     f'presidio-memory-{os.getpid()}-{dump_time}.json')
+    with open(dump_path, 'w') as dump_file:
+        dump_file.write(json_dumps(report, indent=2))
+    return dump_path
+
+
+def _handle_sigusr2(signum, frame):
+    _dump_requested.set()
+
+
+def _watch_memory():
+    while True:
+        requested = _dump_requested.wait(_memory_sample_seconds)
+        _dump_requested.clear()
+        try:
+            if requested:
+                LOG.info(f'Memory report written to: {dump_memory_report()}')
+            else:
+                _sample_memory()
+        except Exception as e:
+            LOG.error('Error occurred while sampling memory!')
+            LOG.error('Error message:')
+            LOG.error(e)
+
+
+def _start_memory_watcher():
+    global _baseline_snapshot
+    if _memory_tracemalloc:
+        tracemalloc.start(_memory_tracemalloc_frames)
+        _baseline_snapshot = _take_snapshot()
+        _remember_snapshot(_baseline_snapshot)
+    _rss_history.clear()
+    _rss_history.append((round(time()), _current_rss()))
+
+    signal.signal(signal.SIGUSR2, _handle_sigusr2)
+    watcher = Thread(target=_watch_memory, name='presidio-memory-watcher',
+                     daemon=True)
+    watcher.start()
+
+
+def _conf_positive_int(conf_memory, conf_key, default_value):
+    conf_value = conf_memory.get(conf_key)
+    if conf_value is None:
+        return default_value
+    if (type(conf_value) is int) and (conf_value > 0):
+        return conf_value
+    LOG.warning((f'\"{conf_key}\" incorrectly ' +
+                 'specified in configuration!'))
+    LOG.warning(f'Proceeding with default value: {default_value}')
+    return default_value
+
+
+def configure_memory_diagnostics(presidio_config):
+    global _memory_enabled, _memory_sample_seconds, _memory_tracemalloc
+    global _memory_tracemalloc_frames, _memory_top, _memory_dump_dir
+    global _rss_history
+
+    conf_memory = presidio_config.get('memory_diagnostics')
+    if not conf_memory:
+        return
+    if type(conf_memory) is not dict:
+        LOG.warning(('\"memory_diagnostics\" incorrectly ' +
+                     'specified in configuration!'))
+        LOG.warning('Memory diagnostics will be disabled.')
+        return
+
+    _memory_enabled = bool(conf_memory.get('enabled', True))
+    if not _memory_enabled:
+        return
+
+    _memory_sample_seconds = _conf_positive_int(
+        conf_memory, 'sample_seconds', _memory_sample_seconds)
+    _memory_tracemalloc_frames = _conf_positive_int(
+        conf_memory, 'tracemalloc_frames', _memory_tracemalloc_frames)
+    _memory_top = _conf_positive_int(conf_memory, 'top', _memory_top)
+    _rss_history = deque(maxlen=_conf_positive_int(
+        conf_memory, 'history_samples', _memory_history_samples))
+
+    conf_dump_dir = conf_memory.get('dump_dir')
+    if conf_dump_dir is not None:
+        if os.path.isdir(conf_dump_dir):
+            _memory_dump_dir = conf_dump_dir
+        else:
+            LOG.warning(('\"dump_dir\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning(f'Proceeding with default value: {_memory_dump_dir}')
+
+    _memory_tracemalloc = bool(conf_memory.get('tracemalloc', False))
+    if _memory_tracemalloc and (tracemalloc is None):
+        LOG.warning(('tracemalloc is not available on this interpreter; '
+                     'only RSS and cache sizes will be sampled.'))
+        _memory_tracemalloc = False
+
+    LOG.info((f'Memory diagnostics enabled; sampling every '
+              f'{_memory_sample_seconds} seconds'
+              f'{", with tracemalloc" if _memory_tracemalloc else ""}.'))
+    register_worker_ready_hook(_start_memory_watcher)
@@ -0,0 +1,349 @@
+import fcntl
+import gzip
+
+from flask import request, send_file
+from mimetypes import guess_type
+from os import remove, replace, stat, utime
+from os.path import basename, dirname, isfile, join, splitext
+from stat import S_ISREG
+from tempfile import NamedTemporaryFile
+from threading import Thread
+from time import sleep
+from timeit import default_timer as timer
+
+from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.FileIndex import walk_files
+from impact_presidio.IOPool import fs_call
+from impact_presidio.LabelMechs import copy_label_xattrs, is_label_file
+from impact_presidio.Lifecycle import register_worker_ready_hook
+
+# zstandard is optional; without it, existing .zst siblings are still
+# served, but none are created.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Eligible files (text datasets, by extension) may have precompressed
+# siblings alongside them - data.csv.zst, data.csv.gz - which are sent
+# instead, with a Content-Encoding, to requesters that accept them. A
+# sibling is only used if its mtime matches the original's (as gzip -k
+# leaves it, and as the compressor sets it), and it's smaller.
+# Siblings are sent under the original's authorization. Requested (or
+# listed) directly, a sibling needs the requester to be authorized for
+# the original as well as for the sibling; siblings the compressor
+# creates get the original's label attributes, too.
+#
+# Optionally, a background compressor creates and refreshes the siblings;
+# one worker at a time does so, holding a lock on "lock_file".
+_encoding_suffixes = {'zstd': '.zst', 'gzip': '.gz'}
+
+_precompressed_enabled = False
+_precompressed_encodings = ['zstd', 'gzip']
+_precompressed_extensions = ['.csv', '.tsv', '.json', '.txt', '.xml']
+_compress_root = None
+_compress_seconds = 0
+_compress_min_bytes = 1024
+_compress_levels = {'zstd': 10, 'gzip': 6}
+_compress_chunk_bytes = 1024 * 1024
+_compress_lock_file = '/dev/shm/presidio-compressor.lock'
+_compress_prefix = '.presidio-compress-'
+
+
+def _eligible(path):
+    return splitext(path)[1].lower() in _precompressed_extensions
+
+
+def _sibling_matches(file_stat, sibling_stat):
+    return (S_ISREG(sibling_stat.st_mode) and
+            (sibling_stat.st_mtime_ns == file_stat.st_mtime_ns))
+
+
+def precompressed_original(abspath):
+    """Returns the path of the file that the file at abspath is a
+    precompressed sibling of, if there is such a file; otherwise None."""
+    for suffix in _encoding_suffixes.values():
+        if abspath.endswith(suffix):
+            original_path = abspath[:-len(suffix)]
+            if _eligible(original_path) and fs_call(isfile, original_path):
+                return original_path
+    return None
+
+
+def precompressed_variant(abspath):
+    """Returns (encoding, sibling path) for the precompressed sibling of
+    the file at abspath best suited to the requester, or None."""
+    if not (_precompressed_enabled and _eligible(abspath)):
+        return None
+
+    accepted = []
+    for preference, encoding in enumerate(_precompressed_encodings):
+        quality = request.accept_encodings.quality(encoding)
+        if quality > 0:
+            accepted.append((-quality, preference, encoding))
+    if not accepted:
+        return None
+
+    try:
+        file_stat = fs_call(stat, abspath)
+    except EnvironmentError:
+        return None
+    for _, _, encoding in sorted(accepted):
+        sibling_path = abspath + _encoding_suffixes[encoding]
+        try:
+            sibling_stat = fs_call(stat, sibling_path)
+        except EnvironmentError:
+            continue
+        if (_sibling_matches(file_stat, sibling_stat) and
+                (sibling_stat.st_size < file_stat.st_size)):
+            return (encoding, sibling_path)
+    return None
+
+
+def send_precompressed(abspath, mimetype=None):
+    """Sends the file at abspath, or its best precompressed sibling;
+    returns the response, and the path of the file actually sent."""
+    variant = precompressed_variant(abspath)
+    if variant is None:
+        if mimetype:
+            file_response = send_file(abspath, mimetype=mimetype)
+        else:
+            file_response = send_file(abspath)
+        sent_path = abspath
+    else:
+        encoding, sent_path = variant
+        file_response = send_file(
+            sent_path, mimetype=(mimetype or guess_type(abspath)[0] or
+                                 'application/octet-stream'))
+        file_response.headers['Content-Encoding'] = encoding
+    if _precompressed_enabled and _eligible(abspath):
+        file_response.vary.add('Accept-Encoding')
+    return (file_response, sent_path)
+
+
+def _open_compressor(temp_file, encoding, file_stat):
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(
+            level=_compress_levels['zstd'])
+        return compressor.stream_writer(temp_file, closefd=False)
+    return gzip.GzipFile(filename='', mode='wb', fileobj=temp_file,
+                         compresslevel=_compress_levels['gzip'],
+                         mtime=int(file_stat.st_mtime))
+
+
+def _compress_chunk(source, compressor):
+    chunk = source.read(_compress_chunk_bytes)
+    if chunk:
+        compressor.write(chunk)
+    return bool(chunk)
+
+
+def _open_compress_files(abspath, encoding, file_stat):
+    source = open(abspath, 'rb')
+    temp_file = NamedTemporaryFile('wb', dir=dirname(abspath),
+                                   prefix=_compress_prefix, delete=False)
+    return (source, temp_file,
+            _open_compressor(temp_file, encoding, file_stat))
+
+
+def _close_compress_files(source, temp_file, compressor):
+    source.close()
+    compressor.close()
+    temp_file.close()
+
+
+def _install_sibling(temp_path, abspath, sibling_path, file_stat):
+    # If the file changed while we were reading it, the result is of
+    # neither version; don't keep it.
+    if stat(abspath).st_mtime_ns != file_stat.st_mtime_ns:
+        remove(temp_path)
+        return False
+    copy_label_xattrs(abspath, temp_path)
+    utime(temp_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+    replace(temp_path, sibling_path)
+    return True
+
+
+def _remove_quietly(path):
+    try:
+        remove(path)
+    except EnvironmentError:
+        pass
+
+
+def compress_file(abspath, encoding, file_stat):
+    """Writes the precompressed sibling of the file at abspath, a chunk
+    at a time (each via fs_call, so requests go in between); returns
+    whether it was installed."""
+    source, temp_file, compressor = fs_call(_open_compress_files, abspath,
+                                            encoding, file_stat)
+    try:
+        while fs_call(_compress_chunk, source, compressor):
+            sleep(0)
+        fs_call(_close_compress_files, source, temp_file, compressor)
+        return fs_call(_install_sibling, temp_file.name, abspath,
+                       abspath + _encoding_suffixes[encoding], file_stat)
+    except Exception:
+        fs_call(source.close)
+        fs_call(temp_file.close)
+        fs_call(_remove_quietly, temp_file.name)
+        raise
+
+
+def _compress_encodings():
+    return [encoding for encoding in _precompressed_encodings
+            if (encoding != 'zstd') or (zstandard is not None)]
+
+
+def _compress_candidate(rel_path, size):
+    name = basename(rel_path)
+    return (_eligible(name) and (size >= _compress_min_bytes) and
+            (not name.startswith('.')) and (not is_label_file(name)))
+
+
+def compress_pass():
+    """Creates or refreshes the precompressed siblings of every eligible
+    file under the project path; returns the number written."""
+    pass_start = timer()
+    num_written = 0
+    encodings = _compress_encodings()
+    for rel_path, size, _ in walk_files(_compress_root):
+        if not _compress_candidate(rel_path, size):
+            continue
+        abspath = join(_compress_root, rel_path)
+        for encoding in encodings:
+            try:
+                file_stat = fs_call(stat, abspath)
+                try:
+                    sibling_stat = fs_call(
+                        stat, abspath + _encoding_suffixes[encoding])
+                    if _sibling_matches(file_stat, sibling_stat):
+                        continue
+                except FileNotFoundError:
+                    pass
+                if compress_file(abspath, encoding, file_stat):
+                    num_written += 1
+            except EnvironmentError as e:
+                LOG.debug(f'Unable to compress {rel_path}: {e}')
+        # Let requests go first.
+        sleep(0)
+    pass_end = timer()
+    METRICS_LOG.info((f'Compressor wrote {num_written} precompressed '
+                      f'files in {pass_end - pass_start} seconds'))
+    return num_written
+
+
+def _compress_unless_locked():
+    with open(_compress_lock_file, 'a') as lock_file:
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Another worker is already at it.
+            return
+        compress_pass()
+
+
+def _maintain_siblings():
+    while True:
+        try:
+            _compress_unless_locked()
+        except Exception as e:
+            LOG.error('Error occurred while precompressing files!')
+            LOG.error('Error message:')
+            LOG.error(e)
+        sleep(_compress_seconds)
+
+
+def _start_compressor():
+    compressor = Thread(target=_maintain_siblings,
+                        name='presidio-compressor', daemon=True)
+    compressor.start()
+
+
+def configure_precompressed(presidio_config, project_path):
+    global _precompressed_enabled, _precompressed_encodings
+    global _precompressed_extensions, _compress_root, _compress_seconds
+    global _compress_min_bytes, _compress_lock_file
+    _precompressed_enabled = False
+    _compress_root = str(project_path)
+
+    conf_precompressed = presidio_config.get('precompressed')
+    if not conf_precompressed:
+        return
+    if type(conf_precompressed) is not dict:
+        LOG.warning(('\"precompressed\" incorrectly ' +
+                     'specified in configuration!'))
+        LOG.warning('Precompressed files will not be served.')
+        return
+
+    conf_encodings = conf_precompressed.get('encodings')
+    if conf_encodings is not None:
+        if (type(conf_encodings) is list) and conf_encodings and all(
+                encoding in _encoding_suffixes
+                for encoding in conf_encodings):
+            _precompressed_encodings = conf_encodings
+        else:
+            LOG.warning(('\"encodings\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_precompressed_encodings}'))
+
+    conf_extensions = conf_precompressed.get('extensions')
+    if conf_extensions is not None:
+        if (type(conf_extensions) is list) and all(
+                (type(ext) is str) and ext.startswith('.')
+                for ext in conf_extensions):
+            _precompressed_extensions = [ext.lower()
+                                         for ext in conf_extensions]
+        else:
+            LOG.warning(('\"extensions\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_precompressed_extensions}'))
+
+    conf_min_bytes = conf_precompressed.get('min_bytes')
+    if conf_min_bytes is not None:
+        if (type(conf_min_bytes) is int) and (conf_min_bytes >= 0):
+            _compress_min_bytes = conf_min_bytes
+        else:
+            LOG.warning(('\"min_bytes\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_compress_min_bytes}'))
+
+    for encoding in _encoding_suffixes:
+        conf_level = conf_precompressed.get(f'{encoding}_level')
+        if conf_level is not None:
+            if type(conf_level) is int:
+                _compress_levels[encoding] = conf_level
+            else:
+                LOG.warning((f'\"{encoding}_level\" incorrectly ' +
+                             'specified in configuration!'))
+                LOG.warning((f'Proceeding with default value: '
+                             f'{_compress_levels[encoding]}'))
+
+    _compress_lock_file = conf_precompressed.get('lock_file',
+                                                 _compress_lock_file)
+    conf_compress_seconds = conf_precompressed.get('compress_seconds')
+    if conf_compress_seconds is not None:
+        if (type(conf_compress_seconds) in (int, float)) and (
+                conf_compress_seconds >= 0):
+            _compress_seconds = conf_compress_seconds
+        else:
+            LOG.warning(('\"compress_seconds\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning('Background compression will be disabled.')
+
+    _precompressed_enabled = bool(conf_precompressed.get('enabled', True))
+    if not _precompressed_enabled:
+        return
+    LOG.info((f'Precompressed siblings ({", ".join(_precompressed_encodings)})'
+              f' will be served for: {", ".join(_precompressed_extensions)}'))
+
+    if _compress_seconds > 0:
+        if ('zstd' in _precompressed_encodings) and (zstandard is None):
+            LOG.warning(('zstandard is not installed; the compressor will '
+                         'only create gzip siblings.'))
+        LOG.info((f'Precompressed siblings will be refreshed every '
+                  f'{_compress_seconds} seconds.'))
+        register_worker_ready_hook(_start_compressor)
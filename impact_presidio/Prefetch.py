@@ -0,0 +1,148 @@
+from os.path import join
+from queue import Full, Queue
+from threading import Thread
+from time import sleep, time
+
+from flask_autoindex import Directory
+
+from impact_presidio import LabelMechs
+from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.DirectoryScan import cached_scan
+from impact_presidio.IOPool import fs_pool_configured
+from impact_presidio.LabelMechs import check_labels, listing_signature
+from impact_presidio.Lifecycle import register_worker_ready_hook
+
+# After a listing, the requester will likely open one of the directories
+# it showed. The prefetcher scans those directories, and resolves the
+# labels of their entries, in the background - so the filesystem's
+# attribute caches, our SafeLabels cache and the directory scan cache are
+# warm when they do.
+#
+# Prefetching is best-effort and low priority: a few threads work through
+# a bounded queue, and work that doesn't fit is dropped. Under the gevent
+# worker those threads are greenlets, so prefetching relies on the
+# filesystem thread pool to keep its reads off the hub.
+_prefetch_workers = 0
+_prefetch_queue = None
+_prefetch_queue_size = 64
+_prefetch_max_dirs = 16
+_prefetch_recent_seconds = 30
+_recently_prefetched = dict()
+
+
+def _prefetch_directory(autoindex, rel_path, dataset_SCID):
+    curdir = Directory(rel_path, autoindex.rootdir)
+    entries = cached_scan(curdir, listing_signature(curdir.abspath),
+                          'name', 1, autoindex.show_hidden)
+    if LabelMechs._label_mech_fn == LabelMechs.ExtendedAttributeLabelCheck:
+        # Labels are read straight from each entry's xattrs, and aren't
+        # cached; there's nothing to warm.
+        return len(entries)
+    for e in entries:
+        if e.name == '..':
+            continue
+        check_labels(e.abspath, dataset_SCID)
+        # Let requests go first.
+        sleep(0)
+    return len(entries)
+
+
+def _prefetch_worker():
+    while True:
+        autoindex, rel_path, dataset_SCID = _prefetch_queue.get()
+        try:
+            _prefetch_directory(autoindex, rel_path, dataset_SCID)
+        except Exception as e:
+            LOG.debug(f'Unable to prefetch {rel_path}: {e}')
+
+
+def _start_prefetch_workers():
+    global _prefetch_queue
+    _prefetch_queue = Queue(_prefetch_queue_size)
+    for worker_num in range(_prefetch_workers):
+        worker = Thread(target=_prefetch_worker, daemon=True,
+                        name=f'presidio-prefetch-{worker_num}')
+        worker.start()
+
+
+def schedule_prefetch(autoindex, entries, dataset_SCID):
+    """Queues the directories among entries (those just shown to the
+    requester) for prefetching; entries are ScannedEntry objects."""
+    if _prefetch_queue is None:
+        return
+
+    now = time()
+    num_scheduled = 0
+    num_dropped = 0
+    for e in entries:
+        if num_scheduled >= _prefetch_max_dirs:
+            break
+        if (e.name == '..') or not isinstance(e.entry, Directory):
+            continue
+
+        prefetch_key = (join(autoindex.rootdir.abspath, e.path),
+                        dataset_SCID)
+        if now - _recently_prefetched.get(prefetch_key, 0) < (
+                _prefetch_recent_seconds):
+            continue
+        try:
+            _prefetch_queue.put_nowait((autoindex, e.path, dataset_SCID))
+        except Full:
+            num_dropped += 1
+            continue
+        _recently_prefetched[prefetch_key] = now
+        num_scheduled += 1
+
+    if len(_recently_prefetched) > (16 * _prefetch_queue_size):
+        for prefetch_key, prefetch_time in list(
+                _recently_prefetched.items()):
+            if now - prefetch_time >= _prefetch_recent_seconds:
+                _recently_prefetched.pop(prefetch_key, None)
+
+    if num_scheduled or num_dropped:
+        METRICS_LOG.info((f'Prefetch scheduled for {num_scheduled} '
+                          f'directories; {num_dropped} dropped'))
+
+
+def configure_prefetch(presidio_config):
+    global _prefetch_workers, _prefetch_queue_size, _prefetch_max_dirs
+
+    conf_workers = presidio_config.get('prefetch_workers')
+    if conf_workers is not None:
+        if (type(conf_workers) is int) and (conf_workers >= 0):
+            _prefetch_workers = conf_workers
+        else:
+            LOG.warning(('\"prefetch_workers\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning('Prefetching will be disabled.')
+
+    conf_queue_size = presidio_config.get('prefetch_queue')
+    if conf_queue_size is not None:
+        if (type(conf_queue_size) is int) and (conf_queue_size > 0):
+            _prefetch_queue_size = conf_queue_size
+        else:
+            LOG.warning(('\"prefetch_queue\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_prefetch_queue_size}'))
+
+    conf_max_dirs = presidio_config.get('prefetch_max_dirs')
+    if conf_max_dirs is not None:
+        if (type(conf_max_dirs) is int) and (conf_max_dirs >= 0):
+            _prefetch_max_dirs = conf_max_dirs
+        else:
+            LOG.warning(('\"prefetch_max_dirs\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_prefetch_max_dirs}'))
+
+    if (_prefetch_workers > 0) and not fs_pool_configured():
+        LOG.warning(('\"prefetch_workers\" requires \"fs_threadpool_size\" ' +
+                     'to be set in configuration!'))
+        LOG.warning('Prefetching will be disabled.')
+        _prefetch_workers = 0
+
+    if _prefetch_workers > 0:
+        LOG.info((f'Prefetching up to {_prefetch_max_dirs} subdirectories '
+                  f'per listing, with {_prefetch_workers} workers.'))
+        register_worker_ready_hook(_start_prefetch_workers)
@@ -0,0 +1,274 @@
+import signal
+
+from os import stat
+from threading import Event, Thread
+
+from impact_presidio import Config
+from impact_presidio import CredentialUtils
+from impact_presidio.Admission import configure_admission
+from impact_presidio.Authorize import configure_authorize
+from impact_presidio.Checksums import configure_checksums
+from impact_presidio.CredentialUtils import build_CA_store
+from impact_presidio.DirectoryScan import configure_scan_cache
+from impact_presidio.Search import configure_search
+from impact_presidio.Uploads import configure_uploads
+from impact_presidio import LabelMechs
+from impact_presidio import Session
+from impact_presidio import SharedCache
+from impact_presidio.Logging import LOG
+from impact_presidio.Lifecycle import register_worker_ready_hook
+
+_reload_app = None
+_reload_autoindex = None
+_reload_check_seconds = 0
+_reload_requested = Event()
+_reload_hooks = []
+
+# Settings that are only read at startup; changing these requires a restart.
+_restart_required_keys = ['project_path', 'web_root', 'log_file',
+                          'log_level', 'log_file_retain', 'log_file_size',
+                          'warmup_requests', 'warmup_seconds',
+                          'config_reload_check_seconds',
+                          'asgi_threads', 'asgi_max_connections',
+                          'fs_threadpool_size', 'fs_threadpool_queue',
+                          'fs_slow_op_seconds', 'search_index_seconds',
+                          'search_index_file', 'inline_icons',
+                          'prefetch_workers',
+                          'prefetch_queue', 'prefetch_max_dirs',
+                          'cache_snapshot_file', 'cache_snapshot_seconds',
+                          'admin', 'memory_diagnostics', 'precompressed']
+
+
+def register_reload_hook(hook_fn):
+    """Registers a function to be called, with the old and new
+    configuration dictionaries, whenever the configuration is reloaded.
+
+    Hooks should invalidate whatever cached state depends upon the
+    settings that changed, and nothing more."""
+    if hook_fn not in _reload_hooks:
+        _reload_hooks.append(hook_fn)
+    return hook_fn
+
+
+def _file_version(file_path):
+    if not file_path:
+        return None
+    try:
+        file_stat = stat(file_path)
+    except EnvironmentError:
+        return None
+    return (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+
+def _watched_versions(presidio_config):
+    return (_file_version(Config._ConfFile),
+            _file_version(presidio_config.get('ca_file')))
+
+
+def _changed_keys(old_config, new_config):
+    all_keys = set(old_config.keys()) | set(new_config.keys())
+    return {k for k in all_keys if old_config.get(k) != new_config.get(k)}
+
+
+def reload_presidio_config(presidio_app, autoindex):
+    """Re-reads the configuration file, and applies the new settings.
+
+    Everything is loaded and validated before anything is swapped in; if
+    the new configuration can't be loaded, the current one stays in place.
+    Only the cached state affected by the changed settings is invalidated.
+    """
+    old_config = presidio_app.config['PRESIDIO_CONFIG']
+    old_ca_version = _file_version(old_config.get('ca_file'))
+
+    # The Config loaders exit on fatal errors, which is what we want at
+    # startup - but not here.
+    try:
+        new_config = Config.load_presidio_config()
+        new_principal = Config.get_presidio_principal(new_config)
+        new_safe_server_list = Config.get_safe_server_list(new_config)
+    except SystemExit:
+        LOG.error('Unable to reload configuration; keeping current settings.')
+        return False
+
+    if type(new_config) is not dict:
+        LOG.error('Reloaded configuration is not a dictionary; ignoring.')
+        return False
+
+    changed_keys = _changed_keys(old_config, new_config)
+    ca_file_changed = (
+        ('ca_file' in changed_keys) or
+        (_file_version(new_config.get('ca_file')) != old_ca_version))
+    if not changed_keys and not ca_file_changed:
+        LOG.info('Configuration unchanged; nothing to reload.')
+        return True
+
+    new_ca_store = None
+    if ca_file_changed and not new_config.get('ca_file'):
+        LOG.warning('ca_file entry not specified in config file!')
+        LOG.warning('Continuing with the current CA roots.')
+    elif ca_file_changed:
+        try:
+            new_ca_store = build_CA_store(new_config.get('ca_file'))
+        except Exception as e:
+            LOG.error('Error loading CA roots; keeping current settings.')
+            LOG.error('Error message:')
+            LOG.error(e)
+            return False
+
+    new_safe_result_cache_seconds = Config.get_safe_result_cache_seconds(
+        new_config)
+    if new_safe_result_cache_seconds is None:
+        new_safe_result_cache_seconds = (
+            type(autoindex).safe_result_cache_seconds)
+    new_decision_cache_size = Config.get_decision_cache_size(new_config)
+    if new_decision_cache_size is None:
+        new_decision_cache_size = type(autoindex).decision_cache_size
+
+    for key in _restart_required_keys:
+        if key in changed_keys:
+            LOG.warning((f'Change to \"{key}\" will not take effect '
+                         f'until Presidio is restarted.'))
+
+    # Swap the new settings in, each as a unit; a request never sees a
+    # store or configuration that is only partly updated.
+    if new_ca_store is not None:
+        CredentialUtils._CAStore = new_ca_store
+
+    old_principal = presidio_app.config['PRESIDIO_PRINCIPAL']
+    old_safe_server_list = presidio_app.config['SAFE_SERVER_LIST']
+    presidio_app.config.update({
+        'PRESIDIO_CONFIG': new_config,
+        'PRESIDIO_PRINCIPAL': new_principal,
+        'SAFE_SERVER_LIST': new_safe_server_list,
+        'SAFE_RESULT_CACHE_SECONDS': new_safe_result_cache_seconds,
+        'DECISION_CACHE_SIZE': new_decision_cache_size})
+
+    label_mech_changed = bool(changed_keys & {'label_mech',
+                                              'safelabels_filename',
+                                              'xattr_label_base'})
+    if label_mech_changed:
+        LabelMechs.configure_label_mech(new_config,
+                                        LabelMechs._project_path)
+
+    # Then drop whatever cached state was derived from the old settings.
+    if ((new_principal != old_principal) or (new_ca_store is not None) or
+            label_mech_changed):
+        if new_principal != old_principal:
+            # Every cached SAFE result was for the old principal.
+            autoindex.safe_result_cache.clear()
+        autoindex.clear_decision_cache()
+    else:
+        removed_servers = (set(old_safe_server_list) -
+                           set(new_safe_server_list))
+        if removed_servers:
+            autoindex.drop_safe_results_for_servers(removed_servers)
+
+    if 'safe_result_cache_seconds' in changed_keys:
+        autoindex.set_safe_result_cache_seconds(new_safe_result_cache_seconds)
+
+    if 'decision_cache_size' in changed_keys:
+        autoindex.set_decision_cache_size(new_decision_cache_size)
+
+    if changed_keys & {'session_cookies', 'session_key_file', 'key_file'}:
+        # Sessions issued under the old key simply stop validating.
+        Session.configure_sessions(new_config)
+
+    if changed_keys & {'safe_admission', 'jwks_admission',
+                       'admission_retry_after_seconds'}:
+        configure_admission(new_config)
+
+    if 'shared_cache' in changed_keys:
+        SharedCache.configure_shared_cache(new_config)
+
+    if 'checksums' in changed_keys:
+        configure_checksums(new_config)
+
+    if 'uploads' in changed_keys:
+        configure_uploads(new_config)
+
+    if 'scan_cache_entries' in changed_keys:
+        configure_scan_cache(new_config)
+
+    if 'search_max_results' in changed_keys:
+        configure_search(new_config)
+
+    if 'authorize_max_paths' in changed_keys:
+        configure_authorize(new_config)
+
+    if new_config.get('BAD_IDEA_use_unverified_jwt'):
+        Config.configure_bad_ideas(new_config)
+
+    for hook_fn in _reload_hooks:
+        try:
+            hook_fn(old_config, new_config)
+        except Exception as e:
+            LOG.error(f'Error occurred while running reload hook: '
+                      f'{hook_fn.__module__}.{hook_fn.__name__}')
+            LOG.error('Error message:')
+            LOG.error(e)
+
+    LOG.info((f'Configuration reloaded; changed settings: '
+              f'{", ".join(sorted(changed_keys)) or "(ca_file contents)"}'))
+    return True
+
+
+def request_reload():
+    _reload_requested.set()
+
+
+def _handle_sighup(signum, frame):
+    request_reload()
+
+
+def _watch_config():
+    versions = _watched_versions(_reload_app.config['PRESIDIO_CONFIG'])
+    while True:
+        # With no check interval, only wait for SIGHUP.
+        timeout = _reload_check_seconds or None
+        requested = _reload_requested.wait(timeout)
+        _reload_requested.clear()
+
+        current_versions = _watched_versions(
+            _reload_app.config['PRESIDIO_CONFIG'])
+        if requested or (current_versions != versions):
+            try:
+                reload_presidio_config(_reload_app, _reload_autoindex)
+            except Exception as e:
+                LOG.error('Error occurred while reloading configuration!')
+                LOG.error('Error message:')
+                LOG.error(e)
+            versions = _watched_versions(
+                _reload_app.config['PRESIDIO_CONFIG'])
+
+
+def _start_config_watcher():
+    # gunicorn workers would otherwise exit on SIGHUP; send it to the
+    # worker processes (not the master, which would replace them) to
+    # reload the configuration without losing warm caches.
+    signal.signal(signal.SIGHUP, _handle_sighup)
+    watcher = Thread(target=_watch_config, name='presidio-config-watcher',
+                     daemon=True)
+    watcher.start()
+
+
+def configure_reload(presidio_app, autoindex):
+    global _reload_app, _reload_autoindex, _reload_check_seconds
+    _reload_app = presidio_app
+    _reload_autoindex = autoindex
+
+    presidio_config = presidio_app.config['PRESIDIO_CONFIG']
+    conf_check_seconds = presidio_config.get('config_reload_check_seconds')
+    if conf_check_seconds is not None:
+        if (((type(conf_check_seconds) is int) or
+             (type(conf_check_seconds) is float)) and
+                (conf_check_seconds >= 0)):
+            _reload_check_seconds = conf_check_seconds
+        else:
+            LOG.warning(('\"config_reload_check_seconds\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning('Configuration file will not be watched.')
+
+    if _reload_check_seconds > 0:
+        LOG.info((f'Configuration file will be checked for changes every '
+                  f'{_reload_check_seconds} seconds.'))
+    register_worker_ready_hook(_start_config_watcher)
@@ -1,5 +1,10 @@
+import hashlib
+
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from flask import request, abort, render_template, send_file
+from flask import request, abort, render_template
+from flask import make_response
+from flask import has_request_context
 from flask_autoindex import AutoIndex, RootDirectory, Directory, __autoindex__
 from jinja2 import TemplateNotFound
 from json import dumps as json_dumps
@@ -7,11 +12,24 @@ from os.path import isdir, isfile, join
 from random import shuffle
 from requests import post
 from re import sub as re_sub
+from threading import Lock
 from time import sleep
 from timeit import default_timer as timer
 
+from impact_presidio.Admission import SAFE_ADMISSION
+from impact_presidio.CacheStats import register_cache, selector_matches
+from impact_presidio.Checksums import add_checksum_header
+from impact_presidio.DirectoryScan import cached_scan
 from impact_presidio.Logging import LOG, METRICS_LOG
-from impact_presidio.LabelMechs import check_labels
+from impact_presidio.IOPool import fs_call
+from impact_presidio.LabelMechs import check_labels, label_signature
+from impact_presidio.LabelMechs import listing_signature
+from impact_presidio.Lifecycle import register_post_fork_hook
+from impact_presidio.Precompressed import precompressed_original
+from impact_presidio.Precompressed import send_precompressed
+from impact_presidio.Prefetch import schedule_prefetch
+from impact_presidio.Uploads import receive_upload, uploads_enabled
+from impact_presidio.SharedCache import shared_cache_get, shared_cache_set
 
 dt_now = datetime.now
 
@@ -23,6 +41,9 @@ class SafeAutoIndex(AutoIndex):
     template_prefix = ''
     safe_result_cache = dict()
     safe_result_cache_seconds = 2  # Seconds before results are stale
+    decision_cache = OrderedDict()
+    decision_cache_lock = Lock()
+    decision_cache_size = 10000  # Maximum number of cached decisions
 
     def __init__(self, app, browse_root=None, **silk_options):
         super(SafeAutoIndex, self).__init__(app, browse_root,
@@ -30,8 +51,11 @@ class SafeAutoIndex(AutoIndex):
         self.app = app
         self._register_shared_autoindex(app=self.app)
 
-    def safe_check_access(self, dataset_SCID, user_DN,
-                          ns_token, project_ID):
+        decision_cache_size = app.config.get('DECISION_CACHE_SIZE')
+        if decision_cache_size is not None:
+            self.decision_cache_size = decision_cache_size
+
+    def safe_bypassed(self):
         pconf = self.app.config['PRESIDIO_CONFIG']
         bypass_safe = pconf.get('BAD_IDEA_bypass_safe_servers')
         if bypass_safe:
@@ -41,7 +65,9 @@ class SafeAutoIndex(AutoIndex):
                          f'use this in production!'))
             LOG.warning('BAD IDEA: You have been warned...')
             return True
+        return False
 
+    def safe_query(self, dataset_SCID, user_DN, ns_token, project_ID):
         presidio_principal = self.app.config['PRESIDIO_PRINCIPAL']
         presidio_principal = presidio_principal.decode('utf-8')
         methodParams = [dataset_SCID, user_DN, ns_token, project_ID]
@@ -50,6 +76,71 @@ class SafeAutoIndex(AutoIndex):
         payload = json_dumps(payload_dict)
         headers = {'Content-Type': 'application/json',
                    'Accept-Charset': 'UTF-8'}
+        return (methodParams, payload, headers)
+
+    def safe_response_result(self, server, url, status_code, safe_result,
+                             methodParams):
+        """Interprets a response from a SAFE server, caching the decision.
+
+        Returns the decision and the time at which it expires; or None
+        (twice) if the next SAFE server in the list should be tried."""
+        dataset_SCID, user_DN = methodParams[0], methodParams[1]
+        LOG.debug(f'Status code from SAFE is: {status_code}')
+        if status_code == 200:
+            # Default to deny.
+            result_message = (
+                f'SAFE did not permit access for {user_DN} '
+                f'to dataset {dataset_SCID}'
+            )
+            result = False
+
+            if (safe_result.get('result') == 'succeed'):
+                # SAFE reported affirmative result.
+                result_message = (
+                    f'SAFE permitted access for {user_DN} '
+                    f'to dataset {dataset_SCID}'
+                )
+                result = True
+
+            LOG.debug(result_message)
+            expire_time = self.update_safe_result_cache(url, methodParams,
+                                                        result)
+            return (result, expire_time)
+        else:
+            LOG.debug((f'SAFE server {server} returned '
+                       f'status code {status_code}'))
+            LOG.debug('Trying next SAFE server in list (if any)...')
+            return (None, None)
+
+    def safe_check_access(self, dataset_SCID, user_DN,
+                          ns_token, project_ID):
+        return self.safe_answer(dataset_SCID, user_DN,
+                                ns_token, project_ID) is True
+
+    def safe_answer(self, dataset_SCID, user_DN, ns_token, project_ID):
+        """Returns SAFE's decision, or None if no SAFE server answered
+        (in which case access is to be denied, but not for long)."""
+        return self.safe_decision(dataset_SCID, user_DN,
+                                  ns_token, project_ID)[0]
+
+    def safe_decision(self, dataset_SCID, user_DN, ns_token, project_ID):
+        """Returns SAFE's decision, as safe_answer does, along with the
+        time at which that decision expires (None, if it doesn't) and the
+        SAFE server that made it."""
+        if self.safe_bypassed():
+            return (True, None, None)
+
+        # When serving via AsyncPresidio, SAFE has already been asked
+        # (asynchronously) before the request got here.
+        if has_request_context():
+            decisions = request.environ.get('presidio.safe_decisions')
+            safe_params = (dataset_SCID, user_DN, ns_token, project_ID)
+            if decisions and (safe_params in decisions):
+                return decisions[safe_params]
+
+        (methodParams, payload,
+         headers) = self.safe_query(dataset_SCID, user_DN,
+                                    ns_token, project_ID)
 
         safe_server_list = self.app.config['SAFE_SERVER_LIST']
         shuffle(safe_server_list)
@@ -58,30 +149,34 @@ class SafeAutoIndex(AutoIndex):
             url = (f'http://{server}/access')
 
             # Check the cache first...
-            safe_result = self.query_safe_result_cache(url, methodParams)
+            (safe_result,
+             expire_time) = self.query_safe_result_cache(url, methodParams)
             if safe_result is not None:
                 LOG.debug('Using cached SAFE query result')
                 LOG.debug((f'Access decision for dataset {dataset_SCID} '
                            f'by {user_DN} was: {safe_result}'))
-                return safe_result
+                return (safe_result, expire_time, server)
 
             # Nothing in the cache? Time to ask SAFE.
             LOG.debug((f'Trying to query SAFE at {url} with the following '
                        f'parameters: {payload}'))
 
             resp = None
-            try:
-                resp = post(url, data=payload,
-                            headers=headers, timeout=4)
-            except Exception as e:
-                LOG.warning((f'Error occurred while trying to '
-                             f'query SAFE server: {server}'))
-                LOG.warning('Error message:')
-                LOG.warning(e)
-                LOG.warning('Trying next SAFE server in list (if any)...')
-                if resp:
-                    resp.close()
-                continue
+            # If SAFE is slow, fail fast (with a 503) rather than letting
+            # requests pile up waiting on it.
+            with SAFE_ADMISSION.admit():
+                try:
+                    resp = post(url, data=payload,
+                                headers=headers, timeout=4)
+                except Exception as e:
+                    LOG.warning((f'Error occurred while trying to '
+                                 f'query SAFE server: {server}'))
+                    LOG.warning('Error message:')
+                    LOG.warning(e)
+                    LOG.warning('Trying next SAFE server in list (if any)...')
+                    if resp:
+                        resp.close()
+                    continue
 
             status_code = None
             if resp:
@@ -98,56 +193,67 @@ class SafeAutoIndex(AutoIndex):
                 finally:
                     resp.close()
 
-            LOG.debug(f'Status code from SAFE is: {status_code}')
-            if status_code == 200:
-                # Default to deny.
-                result_message = (
-                    f'SAFE did not permit access for {user_DN} '
-                    f'to dataset {dataset_SCID}'
-                )
-                result = False
-
-                if (safe_result.get('result') == 'succeed'):
-                    # SAFE reported affirmative result.
-                    result_message = (
-                        f'SAFE permitted access for {user_DN} '
-                        f'to dataset {dataset_SCID}'
-                    )
-                    result = True
-
-                LOG.debug(result_message)
-                self.update_safe_result_cache(url, methodParams, result)
-                return result
-            else:
-                LOG.debug((f'SAFE server {server} returned '
-                           f'status code {status_code}'))
-                LOG.debug('Trying next SAFE server in list (if any)...')
-                continue
+            (result,
+             expire_time) = self.safe_response_result(server, url,
+                                                      status_code,
+                                                      safe_result,
+                                                      methodParams)
+            if result is not None:
+                return (result, expire_time, server)
 
         LOG.warning((f'None of the configured SAFE servers replied; '
                      f'denying access.'))
-        return False
+        return (None, None, None)
 
     def is_it_safe(self, path, dataset_SCID,
                    user_DN, ns_token, project_ID):
-        if check_labels(path, dataset_SCID):
-            return self.safe_check_access(dataset_SCID, user_DN,
-                                          ns_token, project_ID)
-        return False
+        decision_key = (path, dataset_SCID, user_DN, ns_token, project_ID)
+        # A precompressed sibling holds the same data as its original, so
+        # the original's labels must permit access, too.
+        original_path = precompressed_original(path)
+        signature = label_signature(path)
+        if original_path is not None:
+            signature = (signature, label_signature(original_path))
+        decision = self.query_decision_cache(decision_key, signature)
+        if decision is not None:
+            LOG.debug(f'Using cached access decision for {path}')
+            return decision
+
+        decision = False
+        safe_expire_time = None
+        safe_server = None
+        if (check_labels(path, dataset_SCID) and
+                ((original_path is None) or
+                 check_labels(original_path, dataset_SCID))):
+            (decision, safe_expire_time,
+             safe_server) = self.safe_decision(dataset_SCID, user_DN,
+                                               ns_token, project_ID)
+            if decision is None:
+                # SAFE didn't answer; deny this time, but don't remember
+                # it, so that access resumes as soon as SAFE is back.
+                return False
+        self.update_decision_cache(decision_key, signature, decision,
+                                   safe_expire_time, safe_server)
+        return decision
 
     def safe_entry_generator(self, abspath, request_uuid,
                              entries, dataset_SCID,
                              user_DN, ns_token, project_ID):
         entries_start = timer()
 
+        shown_entries = []
         for e in entries:
             if (self.is_it_safe(e.abspath, dataset_SCID,
                                 user_DN, ns_token, project_ID)):
+                shown_entries.append(e)
                 yield e
                 # Prevent the generator loop from being too tight,
                 # if we're using gevent or eventlet workers.
                 sleep(0)
 
+        # The requester will likely open one of these next.
+        schedule_prefetch(self, shown_entries, dataset_SCID)
+
         entries_end = timer()
         entries_message = (
             f'Processing entries for request {request_uuid} '
@@ -156,6 +262,29 @@ class SafeAutoIndex(AutoIndex):
         )
         METRICS_LOG.info(entries_message)
 
+    def request_safe_params(self):
+        """Returns the parameters for SAFE queries on behalf of the
+        requester, from their verified credentials (aborting with 401
+        if anything is missing)."""
+        if request.cert is None:
+            abort(401, 'Client certificate not found.')
+        if request.verified_jwt_claims is None:
+            abort(401, 'Notary Service JWT not found.')
+
+        dataset_SCID = request.verified_jwt_claims.get('data-set')
+        if dataset_SCID is None:
+            abort(401, 'Unable to find data-set in JWT claims.')
+        user_DN = request.verified_jwt_claims.get('sub')
+        if user_DN is None:
+            abort(401, 'Unable to find sub in JWT claims.')
+        ns_token = request.verified_jwt_claims.get('ns-token')
+        if ns_token is None:
+            abort(401, 'Unable to find ns-token in JWT claims.')
+        project_ID = request.verified_jwt_claims.get('project-id')
+        if project_ID is None:
+            abort(401, 'Unable to find project-id in JWT claims.')
+        return (dataset_SCID, user_DN, ns_token, project_ID)
+
     def render_autoindex(self, path, browse_root=None, template=None,
                          template_context=None, endpoint='.autoindex',
                          show_hidden=None, sort_by='name', order=1,
@@ -183,27 +312,16 @@ class SafeAutoIndex(AutoIndex):
         path = re_sub(r'\/*$', '', path)
         abspath = join(rootdir.abspath, path)
 
-        if request.cert is None:
-            return abort(401, 'Client certificate not found.')
-        if request.verified_jwt_claims is None:
-            return abort(401, 'Notary Service JWT not found.')
+        (dataset_SCID, user_DN,
+         ns_token, project_ID) = self.request_safe_params()
 
         LOG.debug('Path is: %s' % abspath)
 
-        dataset_SCID = request.verified_jwt_claims.get('data-set')
-        if dataset_SCID is None:
-            return abort(401, 'Unable to find data-set in JWT claims.')
-        user_DN = request.verified_jwt_claims.get('sub')
-        if user_DN is None:
-            return abort(401, 'Unable to find sub in JWT claims.')
-        ns_token = request.verified_jwt_claims.get('ns-token')
-        if ns_token is None:
-            return abort(401, 'Unable to find ns-token in JWT claims.')
-        project_ID = request.verified_jwt_claims.get('project-id')
-        if project_ID is None:
-            return abort(401, 'Unable to find project-id in JWT claims.')
+        if (request.method in ('PUT', 'POST')) and uploads_enabled():
+            return receive_upload(self, path, dataset_SCID, user_DN,
+                                  ns_token, project_ID)
 
-        if isdir(abspath):
+        if fs_call(isdir, abspath):
             sort_by = request.args.get('sort_by', sort_by)
             if sort_by[0] in ['-', '+']:
                 order = {'+': 1, '-': -1}[sort_by[0]]
@@ -211,11 +329,21 @@ class SafeAutoIndex(AutoIndex):
             else:
                 order = (
                     {'asc': 1, 'desc': -1}[request.args.get('order', 'asc')])
-            curdir = Directory(path, rootdir)
             if show_hidden is None:
                 show_hidden = self.show_hidden
-            entries = curdir.explore(sort_by=sort_by, order=order,
-                                     show_hidden=show_hidden)
+
+            # If the requester's copy of the listing is still current,
+            # there's no need to scan the directory or render anything.
+            signature = listing_signature(abspath)
+            etag = self.listing_etag(signature, dataset_SCID, user_DN,
+                                     ns_token, project_ID, sort_by, order,
+                                     show_hidden)
+            if request.if_none_match.contains_weak(etag):
+                return self.listing_response('', etag, 304)
+
+            curdir = Directory(path, rootdir)
+            entries = cached_scan(curdir, signature, sort_by, order,
+                                  show_hidden)
 
             # We wrap the "entries" generator here, with our own.
             # The "safe_entries" generator will call out to SAFE,
@@ -240,30 +368,76 @@ class SafeAutoIndex(AutoIndex):
                 curdir=curdir, entries=safe_entries,
                 sort_by=sort_by, order=order, endpoint=endpoint)
             if template:
-                return render_template(template, **context)
-            try:
-                template = '{0}autoindex.html'.format(self.template_prefix)
-                return render_template(template, **context)
-            except TemplateNotFound:
-                template = '{0}/autoindex.html'.format(__autoindex__)
-                return render_template(template, **context)
-        elif (isfile(abspath) and
+                rendered = render_template(template, **context)
+            else:
+                try:
+                    template = '{0}autoindex.html'.format(
+                        self.template_prefix)
+                    rendered = render_template(template, **context)
+                except TemplateNotFound:
+                    template = '{0}/autoindex.html'.format(__autoindex__)
+                    rendered = render_template(template, **context)
+            return self.listing_response(rendered, etag)
+        elif (fs_call(isfile, abspath) and
               self.is_it_safe(abspath, dataset_SCID, user_DN,
                               ns_token, project_ID)):
-            if mimetype:
-                return send_file(abspath, mimetype=mimetype)
-            else:
-                return send_file(abspath)
+            file_response, sent_path = send_precompressed(abspath, mimetype)
+            return add_checksum_header(file_response, sent_path)
         else:
             return abort(404)
 
+    def _shared_safe_result_key(self, key):
+        # Decisions are made on behalf of our principal; don't share them
+        # with workers configured with a different one.
+        presidio_principal = self.app.config['PRESIDIO_PRINCIPAL']
+        return f'{presidio_principal.decode("utf-8")}|{key}'
+
+    def listing_etag(self, signature, dataset_SCID, user_DN, ns_token,
+                     project_ID, sort_by, order, show_hidden):
+        """Returns a strong validator for the listing of a directory with
+        the given listing signature, as it would be rendered for this
+        requester; from the signature's stats alone, without enumerating
+        the directory's entries."""
+        safe_permitted = self.safe_check_access(dataset_SCID, user_DN,
+                                                ns_token, project_ID)
+        listing_state = (signature, dataset_SCID,
+                         sort_by, order, show_hidden, safe_permitted,
+                         self.app.config['WEB_ROOT'])
+        sha256Hasher = hashlib.sha256()
+        sha256Hasher.update(repr(listing_state).encode('utf-8'))
+        return sha256Hasher.hexdigest()[:32]
+
+    def listing_response(self, rendered, etag, status=200):
+        response = make_response(rendered, status)
+        response.set_etag(etag)
+        # Listings differ by requester; and must be revalidated each time,
+        # since access may have been revoked.
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response
+
     def query_safe_result_cache(self, url, methodParams):
+        """Returns the cached result, and the time at which it expires;
+        or None (twice) if there isn't one."""
         key = f'{url}{methodParams}'
-        result, expire_time = self.safe_result_cache.get(key, (None, None))
+        result, expire_time, _ = self.safe_result_cache.get(
+            key, (None, None, None))
         if result is not None:
             if (dt_now() < expire_time):
-                return result
-        return None
+                _safe_result_counters.hits += 1
+                return (result, expire_time)
+        _safe_result_counters.misses += 1
+
+        # Perhaps another worker has asked SAFE already?
+        shared_entry = shared_cache_get('safe',
+                                        self._shared_safe_result_key(key))
+        if shared_entry is not None:
+            result, expire_timestamp = shared_entry
+            expire_time = datetime.fromtimestamp(expire_timestamp)
+            self.safe_result_cache[key] = (
+                result, expire_time, safe_selector_fields(methodParams))
+            return (result, expire_time)
+        return (None, None)
 
     def update_safe_result_cache(self, url, methodParams, result):
         if ((len(self.safe_result_cache) == 0) and
@@ -280,4 +454,143 @@ class SafeAutoIndex(AutoIndex):
         key = f'{url}{methodParams}'
         expire_time = (dt_now() +
                        timedelta(0, self.safe_result_cache_seconds))
-        self.safe_result_cache[key] = (result, expire_time)
+        self.safe_result_cache[key] = (result, expire_time,
+                                       safe_selector_fields(methodParams))
+        if self.safe_result_cache_seconds != 0:
+            expire_timestamp = expire_time.timestamp()
+            shared_cache_set('safe', self._shared_safe_result_key(key),
+                             [result, expire_timestamp], expire_timestamp)
+        return expire_time
+
+    def query_decision_cache(self, decision_key, signature):
+        with self.decision_cache_lock:
+            cached = self.decision_cache.get(decision_key)
+            if cached is None:
+                _decision_counters.misses += 1
+                return None
+            decision, cached_signature, expire_time, _ = cached
+            if (dt_now() >= expire_time) or (cached_signature != signature):
+                # Either SAFE's answer is stale, or the labels changed.
+                del self.decision_cache[decision_key]
+                _decision_counters.misses += 1
+                return None
+            self.decision_cache.move_to_end(decision_key)
+            _decision_counters.hits += 1
+            return decision
+
+    def update_decision_cache(self, decision_key, signature, decision,
+                              safe_expire_time=None, safe_server=None):
+        if ((self.decision_cache_size == 0) or
+                (self.safe_result_cache_seconds == 0)):
+            return
+        expire_time = (dt_now() +
+                       timedelta(0, self.safe_result_cache_seconds))
+        # A decision can't outlive the SAFE result it was made from.
+        if safe_expire_time is not None:
+            expire_time = min(expire_time, safe_expire_time)
+        with self.decision_cache_lock:
+            self.decision_cache[decision_key] = (decision, signature,
+                                                 expire_time, safe_server)
+            self.decision_cache.move_to_end(decision_key)
+            while len(self.decision_cache) > self.decision_cache_size:
+                self.decision_cache.popitem(last=False)
+                _decision_counters.evictions += 1
+
+    def clear_decision_cache(self):
+        with self.decision_cache_lock:
+            self.decision_cache.clear()
+
+    def set_decision_cache_size(self, cache_size):
+        self.decision_cache_size = cache_size
+        with self.decision_cache_lock:
+            while len(self.decision_cache) > cache_size:
+                self.decision_cache.popitem(last=False)
+                _decision_counters.evictions += 1
+
+    def drop_safe_results_for_servers(self, servers):
+        # Cache keys are the query URL, followed by the method parameters.
+        key_prefixes = tuple(f'http://{server}/access[' for server in servers)
+        for key in list(self.safe_result_cache.keys()):
+            if key.startswith(key_prefixes):
+                self.safe_result_cache.pop(key, None)
+
+        # Along with the decisions made from those servers' answers.
+        with self.decision_cache_lock:
+            for decision_key, (_, _, _, safe_server) in list(
+                    self.decision_cache.items()):
+                if safe_server in servers:
+                    del self.decision_cache[decision_key]
+
+    def set_safe_result_cache_seconds(self, cache_seconds):
+        previous_seconds = self.safe_result_cache_seconds
+        self.safe_result_cache_seconds = cache_seconds
+        if cache_seconds == previous_seconds:
+            return
+
+        if cache_seconds == 0:
+            self.safe_result_cache.clear()
+            self.clear_decision_cache()
+            return
+
+        # Re-compute the expiry time of each cached result (and decision),
+        # as though it had been cached with the new setting in the first
+        # place.
+        delta = timedelta(0, cache_seconds - previous_seconds)
+        for key, (result, expire_time, selector_fields) in list(
+                self.safe_result_cache.items()):
+            self.safe_result_cache[key] = (result, expire_time + delta,
+                                           selector_fields)
+        with self.decision_cache_lock:
+            for decision_key, (decision, signature, expire_time,
+                               safe_server) in list(
+                    self.decision_cache.items()):
+                self.decision_cache[decision_key] = (
+                    decision, signature, expire_time + delta, safe_server)
+        LOG.info((f'SAFE result cache expiry time is '
+                  f'{self.safe_result_cache_seconds} seconds.'))
+
+
+def safe_selector_fields(methodParams):
+    """Returns the fields of a SAFE query by which cached results may be
+    invalidated - (dataset SCID, user DN, project ID) - kept alongside
+    each result."""
+    dataset_SCID, user_DN, _, project_ID = methodParams
+    return (dataset_SCID, user_DN, project_ID)
+
+
+def _invalidate_safe_results(selector):
+    dropped = 0
+    for key, (_, _, selector_fields) in list(
+            SafeAutoIndex.safe_result_cache.items()):
+        dataset_SCID, user_DN, project_ID = selector_fields
+        if selector_matches(selector, scid=dataset_SCID, dn=user_DN,
+                            project=project_ID):
+            SafeAutoIndex.safe_result_cache.pop(key, None)
+            dropped += 1
+    return dropped
+
+
+def _invalidate_decisions(selector):
+    dropped = 0
+    with SafeAutoIndex.decision_cache_lock:
+        for decision_key in list(SafeAutoIndex.decision_cache.keys()):
+            path, dataset_SCID, user_DN, _, project_ID = decision_key
+            if selector_matches(selector, path=path, scid=dataset_SCID,
+                                dn=user_DN, project=project_ID):
+                del SafeAutoIndex.decision_cache[decision_key]
+                dropped += 1
+    return dropped
+
+
+_safe_result_counters = register_cache(
+    'safe_results', lambda: SafeAutoIndex.safe_result_cache,
+    _invalidate_safe_results)
+_decision_counters = register_cache(
+    'decisions', lambda: SafeAutoIndex.decision_cache,
+    _invalidate_decisions)
+
+
+@register_post_fork_hook
+def _reset_safe_result_cache():
+    SafeAutoIndex.safe_result_cache.clear()
+    SafeAutoIndex.decision_cache.clear()
@@ -0,0 +1,146 @@
+from flask import Response, abort, request, stream_with_context
+from fnmatch import fnmatchcase
+from json import dumps as json_dumps
+from os.path import basename, isdir, join, normpath
+from timeit import default_timer as timer
+
+from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.FileIndex import indexed_files
+from impact_presidio.IOPool import fs_call
+from impact_presidio.LabelMechs import LabelBatch
+from impact_presidio.Precompressed import precompressed_original
+
+_max_results = 10000
+_max_pattern_length = 256
+
+
+def _number_arg(arg_name):
+    arg_value = request.args.get(arg_name)
+    if arg_value is None:
+        return None
+    try:
+        return float(arg_value)
+    except ValueError:
+        abort(400, f'Invalid value specified for {arg_name}.')
+
+
+def _path_matcher():
+    # No regular expressions: a user-supplied one can take exponential
+    # time to match, tying up the worker for everyone.
+    if 'regex' in request.args:
+        abort(400, 'Regular expressions are not supported; use glob or '
+                   'contains.')
+    glob_pattern = request.args.get('glob')
+    substring = request.args.get('contains')
+    if glob_pattern and substring:
+        abort(400, 'Only one of glob or contains may be specified.')
+
+    pattern = glob_pattern or substring
+    if pattern and (len(pattern) > _max_pattern_length):
+        abort(400, 'Search pattern is too long.')
+
+    if glob_pattern:
+        # Patterns without a slash match file names; those with one match
+        # paths relative to the directory being searched.
+        if '/' in glob_pattern:
+            return (lambda rel_path: fnmatchcase(rel_path, glob_pattern))
+        return (lambda rel_path: fnmatchcase(basename(rel_path),
+                                             glob_pattern))
+    if substring:
+        return (lambda rel_path: substring in rel_path)
+    return (lambda rel_path: True)
+
+
+def _is_hidden(rel_path):
+    return any(part.startswith('.') for part in rel_path.split('/'))
+
+
+def search_files(autoindex, path):
+    """Streams back (as JSON lines) the files under path that match the
+    search parameters, and that the requester is authorized to see.
+
+    Query parameters: glob or contains; min_size and max_size (bytes);
+    modified_after and modified_before (seconds since the epoch); and
+    max_results."""
+    search_start = timer()
+    (dataset_SCID, user_DN,
+     ns_token, project_ID) = autoindex.request_safe_params()
+
+    root_path = autoindex.rootdir.abspath
+    search_path = normpath(path.strip('/') or '.')
+    if search_path == '.':
+        search_path = ''
+    if (search_path == '..') or search_path.startswith('../'):
+        abort(404)
+    if not fs_call(isdir, join(root_path, search_path)):
+        abort(404)
+
+    path_matches = _path_matcher()
+    min_size = _number_arg('min_size')
+    max_size = _number_arg('max_size')
+    modified_after = _number_arg('modified_after')
+    modified_before = _number_arg('modified_before')
+    max_results = _number_arg('max_results')
+    if (max_results is None) or (max_results > _max_results):
+        max_results = _max_results
+
+    # SAFE's answer doesn't depend upon the path; ask once, up front.
+    # After that, only the labels need checking, file by file; files in
+    # the same directory share the lookup of that directory's labels.
+    safe_permitted = autoindex.safe_check_access(dataset_SCID, user_DN,
+                                                 ns_token, project_ID)
+    label_batch = LabelBatch(dataset_SCID)
+    show_hidden = autoindex.show_hidden
+    prefix_length = (len(search_path) + 1) if search_path else 0
+    request_uuid = request.uuid
+    LOG.debug(f'Searching {search_path or "/"} for request {request_uuid}')
+
+    def search_results():
+        num_results = 0
+        num_candidates = 0
+        if safe_permitted:
+            for rel_path, size, mtime in indexed_files(search_path):
+                if num_results >= max_results:
+                    break
+                if (not show_hidden) and _is_hidden(rel_path):
+                    continue
+                if not path_matches(rel_path[prefix_length:]):
+                    continue
+                if (((min_size is not None) and (size < min_size)) or
+                        ((max_size is not None) and (size > max_size))):
+                    continue
+                if (((modified_after is not None) and
+                     (mtime < modified_after)) or
+                        ((modified_before is not None) and
+                         (mtime > modified_before))):
+                    continue
+                num_candidates += 1
+                abspath = join(root_path, rel_path)
+                original_path = precompressed_original(abspath)
+                if (label_batch.check(abspath, is_dir=False) and
+                        ((original_path is None) or
+                         label_batch.check(original_path, is_dir=False))):
+                    num_results += 1
+                    yield json_dumps({'path': rel_path, 'size': size,
+                                      'modified': mtime}) + '\n'
+
+        search_end = timer()
+        METRICS_LOG.info((f'Search for request {request_uuid} '
+                          f'on directory {search_path or "/"} returned '
+                          f'{num_results} of {num_candidates} matching files '
+                          f'in {search_end - search_start} seconds'))
+
+    return Response(stream_with_context(search_results()),
+                    mimetype='application/x-ndjson')
+
+
+def configure_search(presidio_config):
+    global _max_results
+    conf_max_results = presidio_config.get('search_max_results')
+    if conf_max_results is not None:
+        if (type(conf_max_results) is int) and (conf_max_results > 0):
+            _max_results = conf_max_results
+        else:
+            LOG.warning(('\"search_max_results\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning(f'Proceeding with default value: {_max_results}')
@@ -0,0 +1,121 @@
+import hashlib
+import hmac
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from json import dumps as json_dumps
+from json import loads as json_loads
+from time import time
+
+from impact_presidio.Logging import LOG
+
+# Once a client certificate and Notary Service JWT have been fully
+# verified, Presidio can hand out a session cookie: an expiry time, and an
+# HMAC (under a server-side key) over that expiry, the certificate
+# fingerprint, the digest of the verified claims, and the CA bundle
+# generation. Neither the fingerprint nor the digest needs to be in the
+# cookie itself - the client presents the certificate and the JWT anyway -
+# so checking a session costs two hashes and one HMAC, instead of a
+# certificate chain verification and an RSA signature check.
+SESSION_COOKIE = 'Presidio-Session'
+
+_session_key = None
+
+
+def sessions_enabled():
+    return _session_key is not None
+
+
+def _b64encode(raw_bytes):
+    return urlsafe_b64encode(raw_bytes).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(encoded):
+    return urlsafe_b64decode(encoded + ('=' * (-len(encoded) % 4)))
+
+
+def unverified_jwt_claims(jwt):
+    """Extracts the claims from a JWT without checking its signature; only
+    to be trusted if they match a digest that was computed over verified
+    claims."""
+    try:
+        claims = json_loads(_b64decode(jwt.split('.')[1]))
+    except Exception:
+        return None
+    if type(claims) is not dict:
+        return None
+    return claims
+
+
+def _session_mac(cert_pem, claims, session_exp, ca_generation):
+    cert_fingerprint = hashlib.sha256(cert_pem.encode('utf-8')).digest()
+    claims_json = json_dumps(claims, sort_keys=True, separators=(',', ':'))
+    claims_digest = hashlib.sha256(claims_json.encode('utf-8')).digest()
+    session_mac = hmac.new(_session_key, digestmod=hashlib.sha256)
+    session_mac.update(f'{session_exp}|{ca_generation}|'.encode('utf-8'))
+    session_mac.update(cert_fingerprint)
+    session_mac.update(claims_digest)
+    return _b64encode(session_mac.digest())
+
+
+def issue_session(cert_pem, verified_claims, session_exp, ca_generation):
+    """Returns the value for a session cookie, valid until session_exp
+    (in seconds since the epoch) for this certificate and these claims."""
+    session_exp = int(session_exp)
+    session_mac = _session_mac(cert_pem, verified_claims, session_exp,
+                               ca_generation)
+    return f'{session_exp}.{session_mac}'
+
+
+def check_session(cert_pem, jwt, session_cookie, ca_generation):
+    """Returns the (previously verified) claims from jwt, if session_cookie
+    is a valid, unexpired session for this certificate and JWT; otherwise,
+    returns None, and full verification is required."""
+    if (_session_key is None) or not (session_cookie and jwt and cert_pem):
+        return None
+
+    try:
+        session_exp, session_mac = session_cookie.split('.')
+        session_exp = int(session_exp)
+    except ValueError:
+        return None
+    if time() >= session_exp:
+        return None
+
+    claims = unverified_jwt_claims(jwt)
+    if claims is None:
+        return None
+
+    expected_mac = _session_mac(cert_pem, claims, session_exp, ca_generation)
+    if not hmac.compare_digest(expected_mac, session_mac):
+        return None
+    return claims
+
+
+def _derive_session_key(key_bytes):
+    return hmac.new(b'presidio-session-cookie', key_bytes,
+                    hashlib.sha256).digest()
+
+
+def configure_sessions(presidio_config):
+    global _session_key
+    session_key = None
+
+    if presidio_config.get('session_cookies'):
+        # Every worker (and every instance behind a load balancer) must
+        # derive the same key; by default, it comes from Presidio's own
+        # private key, which they all share already.
+        key_file = (presidio_config.get('session_key_file') or
+                    presidio_config.get('key_file'))
+        try:
+            with open(key_file, 'rb') as kf:
+                session_key = _derive_session_key(kf.read())
+        except (EnvironmentError, TypeError) as e:
+            LOG.warning('Unable to read key for session cookies!')
+            LOG.warning('Error message:')
+            LOG.warning(e)
+            LOG.warning('Session cookies will be disabled.')
+            session_key = None
+
+    if session_key is not None:
+        LOG.info('Session cookies enabled.')
+    _session_key = session_key
@@ -0,0 +1,291 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+
+from json import dumps as json_dumps
+from json import loads as json_loads
+from threading import Lock
+from time import time
+
+from impact_presidio.Logging import LOG
+
+# Each gunicorn worker has its own caches; without somewhere to share
+# results, N workers ask SAFE (and verify credentials) up to N times for
+# the same thing. A shared cache backend is consulted whenever a worker's
+# own cache misses, and is told about every fresh result.
+#
+# Values must be JSON-serializable; keys are strings, within a namespace
+# (e.g. 'safe', 'jwt', 'cert').
+_shared_cache = None
+_cache_backends = dict()
+_credential_cache_seconds = 300
+
+
+class CacheBackend(object):
+    """Interface for shared cache backends."""
+
+    def get(self, namespace, key):
+        """Returns the value stored for key, or None if there is no
+        unexpired value."""
+        raise NotImplementedError
+
+    def set(self, namespace, key, value, expire_timestamp):
+        """Stores value for key, until expire_timestamp (in seconds since
+        the epoch). Backends may drop entries at any time."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class DictCacheBackend(CacheBackend):
+    """A plain dictionary; only shared within one process. Useful for
+    testing, and as a template for a networked key-value store backend
+    in multi-host setups."""
+
+    def __init__(self, backend_config):
+        self.entries = dict()
+
+    def get(self, namespace, key):
+        value, expire_timestamp = self.entries.get((namespace, key),
+                                                   (None, 0))
+        if time() < expire_timestamp:
+            return value
+        return None
+
+    def set(self, namespace, key, value, expire_timestamp):
+        self.entries[(namespace, key)] = (value, expire_timestamp)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class MmapCacheBackend(CacheBackend):
+    """A fixed-size table of fixed-size slots in a shared memory mapped
+    file, for sharing between the workers on one host.
+
+    Each key maps to two candidate slots. Slots are guarded by a sequence
+    number (odd while being written), so readers never lock; writers
+    lock one of a number of stripes, both within the process (for
+    threads and greenlets) and across processes (with fcntl).
+    """
+
+    # Sequence number, key digest, expiry, value length.
+    _header = struct.Struct('=I16sdH')
+    _num_stripes = 64
+    _read_attempts = 4
+
+    def __init__(self, backend_config):
+        self.num_slots = int(backend_config.get('slots', 65536))
+        self.slot_size = int(backend_config.get('slot_size', 1024))
+        if ((self.num_slots <= 0) or
+                (self.slot_size <= self._header.size)):
+            raise ValueError('Invalid slot count or slot size.')
+        self.max_value_size = self.slot_size - self._header.size
+
+        # Other workers may have the table mapped, so a table file is
+        # never resized once in use (they'd get SIGBUS); each shape of
+        # table gets a file of its own instead.
+        file_prefix = backend_config.get('file', '/dev/shm/presidio-cache')
+        self.file_path = f'{file_prefix}.{self.num_slots}x{self.slot_size}'
+        table_size = self.num_slots * self.slot_size
+        self.fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            file_size = os.fstat(self.fd).st_size
+            if file_size == 0:
+                os.ftruncate(self.fd, table_size)
+                file_size = table_size
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        if file_size != table_size:
+            os.close(self.fd)
+            raise ValueError((f'{self.file_path} is not a table of '
+                              f'{self.num_slots} slots of '
+                              f'{self.slot_size} bytes.'))
+        self.table = mmap.mmap(self.fd, table_size, mmap.MAP_SHARED,
+                               mmap.PROT_READ | mmap.PROT_WRITE)
+        self.stripe_locks = [Lock() for _ in range(self._num_stripes)]
+
+    def _slots(self, namespace, key):
+        key_digest = hashlib.blake2b(f'{namespace}\0{key}'.encode('utf-8'),
+                                     digest_size=16).digest()
+        first_hash = int.from_bytes(key_digest[0:8], 'little')
+        second_hash = int.from_bytes(key_digest[8:16], 'little')
+        return (key_digest, first_hash % self.num_slots,
+                second_hash % self.num_slots)
+
+    def _read_slot(self, slot):
+        offset = slot * self.slot_size
+        for _ in range(self._read_attempts):
+            (seq, key_digest, expire_timestamp,
+             value_length) = self._header.unpack_from(self.table, offset)
+            if seq % 2:
+                continue
+            value_start = offset + self._header.size
+            value_bytes = self.table[value_start:(value_start +
+                                                  value_length)]
+            if self._header.unpack_from(self.table, offset)[0] == seq:
+                return (key_digest, expire_timestamp, value_bytes)
+        # Being written repeatedly; treat it as a miss.
+        return (None, 0, None)
+
+    def get(self, namespace, key):
+        key_digest, first_slot, second_slot = self._slots(namespace, key)
+        now = time()
+        for slot in (first_slot, second_slot):
+            (slot_digest, expire_timestamp,
+             value_bytes) = self._read_slot(slot)
+            if (slot_digest == key_digest) and (now < expire_timestamp):
+                try:
+                    return json_loads(value_bytes)
+                except ValueError:
+                    return None
+        return None
+
+    def _write_slot(self, slot, key_digest, value_bytes, expire_timestamp):
+        offset = slot * self.slot_size
+        stripe = slot % self._num_stripes
+        with self.stripe_locks[stripe]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, stripe, os.SEEK_SET)
+            try:
+                seq = self._header.unpack_from(self.table, offset)[0]
+                if seq % 2:
+                    # A writer died mid-write; the slot's contents are junk.
+                    seq += 1
+                seq &= 0xFFFFFFFF
+                struct.pack_into('=I', self.table, offset, seq + 1)
+                value_start = offset + self._header.size
+                self.table[value_start:(value_start +
+                                        len(value_bytes))] = value_bytes
+                self._header.pack_into(self.table, offset, seq + 1,
+                                       key_digest, expire_timestamp,
+                                       len(value_bytes))
+                struct.pack_into('=I', self.table, offset,
+                                 (seq + 2) & 0xFFFFFFFF)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, stripe, os.SEEK_SET)
+
+    def set(self, namespace, key, value, expire_timestamp):
+        value_bytes = json_dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(value_bytes) > self.max_value_size:
+            return
+        key_digest, first_slot, second_slot = self._slots(namespace, key)
+
+        # Prefer the slot already holding this key; then an expired slot;
+        # then the slot whose entry expires soonest.
+        candidates = []
+        now = time()
+        for slot in (first_slot, second_slot):
+            slot_digest, slot_expire, _ = self._read_slot(slot)
+            if slot_digest == key_digest:
+                candidates = [(-1, slot)]
+                break
+            candidates.append(
+                (0 if slot_expire <= now else slot_expire, slot))
+        self._write_slot(min(candidates)[1], key_digest, value_bytes,
+                         expire_timestamp)
+
+    def clear(self):
+        for slot in range(self.num_slots):
+            self._write_slot(slot, bytes(16), b'', 0)
+
+
+def register_cache_backend(backend_name, backend_class):
+    """Makes a CacheBackend implementation available for use as the
+    shared cache, under backend_name."""
+    _cache_backends[backend_name] = backend_class
+    return backend_class
+
+
+register_cache_backend('dict', DictCacheBackend)
+register_cache_backend('mmap', MmapCacheBackend)
+
+
+def shared_cache_get(namespace, key):
+    shared_cache = _shared_cache
+    if shared_cache is None:
+        return None
+    try:
+        return shared_cache.get(namespace, key)
+    except Exception as e:
+        LOG.warning('Error occurred while reading from shared cache!')
+        LOG.warning('Error message:')
+        LOG.warning(e)
+        return None
+
+
+def shared_cache_set(namespace, key, value, expire_timestamp):
+    shared_cache = _shared_cache
+    if shared_cache is None:
+        return
+    try:
+        shared_cache.set(namespace, key, value, expire_timestamp)
+    except Exception as e:
+        LOG.warning('Error occurred while writing to shared cache!')
+        LOG.warning('Error message:')
+        LOG.warning(e)
+
+
+def shared_cache_clear():
+    """Drops everything from the shared cache. Backends only keep digests
+    of keys, so entries can't be picked out more selectively than this."""
+    shared_cache = _shared_cache
+    if shared_cache is None:
+        return
+    try:
+        shared_cache.clear()
+    except Exception as e:
+        LOG.warning('Error occurred while clearing shared cache!')
+        LOG.warning('Error message:')
+        LOG.warning(e)
+
+
+def shared_credential_expiry(valid_until):
+    """Returns when a shared credential verification result, valid until
+    valid_until (in seconds since the epoch), should expire."""
+    return min(valid_until, time() + _credential_cache_seconds)
+
+
+def configure_shared_cache(presidio_config):
+    global _shared_cache, _credential_cache_seconds
+    _shared_cache = None
+
+    conf_shared_cache = presidio_config.get('shared_cache')
+    if not conf_shared_cache:
+        return
+    if type(conf_shared_cache) is not dict:
+        LOG.warning('\"shared_cache\" incorrectly specified in configuration!')
+        LOG.warning('Shared cache will be disabled.')
+        return
+
+    conf_credential_seconds = conf_shared_cache.get('credential_seconds')
+    if conf_credential_seconds is not None:
+        if (((type(conf_credential_seconds) is int) or
+             (type(conf_credential_seconds) is float)) and
+                (conf_credential_seconds >= 0)):
+            _credential_cache_seconds = conf_credential_seconds
+        else:
+            LOG.warning(('\"credential_seconds\" incorrectly specified ' +
+                         'for shared cache in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_credential_cache_seconds}'))
+
+    backend_name = conf_shared_cache.get('backend', 'mmap')
+    backend_class = _cache_backends.get(backend_name)
+    if backend_class is None:
+        LOG.warning(f'Unknown shared cache backend: {backend_name}')
+        LOG.warning('Shared cache will be disabled.')
+        return
+
+    try:
+        _shared_cache = backend_class(conf_shared_cache)
+    except Exception as e:
+        LOG.warning(f'Unable to set up shared cache backend: {backend_name}')
+        LOG.warning('Error message:')
+        LOG.warning(e)
+        LOG.warning('Shared cache will be disabled.')
+        return
+    LOG.info(f'Using shared cache backend: {backend_name}')
@@ -0,0 +1,107 @@
+import hashlib
+import flask_autoindex
+import flask_silk
+
+from base64 import b64encode
+from flask import request
+from mimetypes import guess_type
+from os.path import basename, dirname, isfile, join
+from urllib.parse import urlparse
+
+from impact_presidio.Logging import LOG
+from impact_presidio.CredentialUtils import exempt_from_credentials
+
+# The stylesheet, sort arrows and icons that listings refer to are the
+# same for everyone, and come from the installed packages; they need
+# neither credentials nor revalidation.
+_autoindex_static_endpoint = f'{flask_autoindex.__autoindex__}.static'
+_silk_icon_endpoint = 'silkicon'
+_autoindex_static_folder = join(dirname(flask_autoindex.__file__), 'static')
+_silk_icon_folder = join(dirname(flask_silk.__file__), 'icons')
+
+_immutable_cache_control = 'public, max-age=31536000, immutable'
+_icon_cache_control = 'public, max-age=604800'
+
+_inline_icons = False
+_asset_hashes = dict()
+_icon_data_uris = dict()
+_icon_directories = []
+
+
+def asset_hash(filename):
+    """Returns a short digest of the contents of an autoindex static
+    asset, for use in its URL; None if there's no such asset."""
+    if filename not in _asset_hashes:
+        asset_path = join(_autoindex_static_folder, filename)
+        asset_digest = None
+        if isfile(asset_path):
+            with open(asset_path, 'rb') as af:
+                asset_digest = hashlib.sha256(af.read()).hexdigest()[:12]
+        _asset_hashes[filename] = asset_digest
+    return _asset_hashes[filename]
+
+
+def _add_asset_hash(endpoint, values):
+    if endpoint == _autoindex_static_endpoint:
+        filename = values.get('filename')
+        if filename and ('v' not in values):
+            filename_hash = asset_hash(filename)
+            if filename_hash:
+                values['v'] = filename_hash
+
+
+def _set_asset_cache_headers(response):
+    if response.status_code != 200:
+        return response
+
+    if request.endpoint == _autoindex_static_endpoint:
+        filename = request.view_args.get('filename')
+        requested_hash = request.args.get('v')
+        # Only a URL naming the current contents may be cached forever.
+        if requested_hash and (requested_hash == asset_hash(filename)):
+            response.headers['Cache-Control'] = _immutable_cache_control
+        else:
+            response.headers['Cache-Control'] = _icon_cache_control
+    elif request.endpoint == _silk_icon_endpoint:
+        response.headers['Cache-Control'] = _icon_cache_control
+    return response
+
+
+def _icon_data_uri(icon_url):
+    icon_name = basename(urlparse(icon_url).path)
+    for icon_directory in (_icon_directories + [_silk_icon_folder]):
+        icon_path = join(icon_directory, icon_name)
+        if isfile(icon_path):
+            with open(icon_path, 'rb') as icon_file:
+                icon_bytes = icon_file.read()
+            icon_type = guess_type(icon_name)[0] or 'image/png'
+            return (f'data:{icon_type};base64,'
+                    f'{b64encode(icon_bytes).decode("ascii")}')
+    return icon_url
+
+
+def listing_icon(icon_url):
+    """Returns what listings should use to refer to an icon: its URL, or
+    (if inline_icons is set) the icon itself, as a data URI."""
+    if not _inline_icons:
+        return icon_url
+    icon_data_uri = _icon_data_uris.get(icon_url)
+    if icon_data_uri is None:
+        icon_data_uri = _icon_data_uri(icon_url)
+        _icon_data_uris[icon_url] = icon_data_uri
+    return icon_data_uri
+
+
+def configure_static_assets(presidio_app, autoindex):
+    global _inline_icons, _icon_directories
+    presidio_config = presidio_app.config['PRESIDIO_CONFIG']
+
+    exempt_from_credentials(_autoindex_static_endpoint)
+    exempt_from_credentials(_silk_icon_endpoint)
+    presidio_app.url_defaults(_add_asset_hash)
+    presidio_app.after_request(_set_asset_cache_headers)
+
+    _icon_directories = list(autoindex.silk.directories)
+    _inline_icons = bool(presidio_config.get('inline_icons'))
+    if _inline_icons:
+        LOG.info('Icons will be inlined into listings.')
@@ -0,0 +1,485 @@
+import fcntl
+import hashlib
+
+from base64 import b64decode
+from binascii import Error as B64Error
+from flask import abort, jsonify, make_response, request
+from os import O_CREAT, O_EXCL, O_RDWR, O_WRONLY
+from os import close, fdopen, fstat, fsync, listdir, makedirs, remove
+from os import open as os_open, replace, stat, write
+from os.path import basename, dirname, isdir, join, normpath
+from re import search as re_search
+from tempfile import NamedTemporaryFile
+from threading import Thread
+from time import sleep, time
+from timeit import default_timer as timer
+from werkzeug.http import parse_content_range_header
+
+from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.Checksums import hash_file, store_checksum
+from impact_presidio.IOPool import fs_call
+from impact_presidio.LabelMechs import copy_label_xattrs, is_label_file
+
+# Uploads are written, as they arrive, to a hidden temporary file in the
+# target directory; once complete (and, optionally, verified against the
+# digest the requester sent), it is renamed over the target. The body is
+# never held in memory, and is not read at all until the requester has
+# been authorized for the target directory.
+#
+# A large upload may be sent in pieces, with Content-Range headers; the
+# partial file is kept (under a name derived from the target and the
+# requester) between pieces, so a failed piece can be resent; each piece
+# holds a lock on it while being written, so pieces of one upload can't
+# interleave.
+#
+# Every partial (and temporary) file is recorded in the upload registry,
+# a directory with one small file (naming it) per upload in progress.
+# Those not written to for "partial_max_age_seconds" are removed by a
+# periodic sweep of the registry, which one worker at a time does.
+_upload_prefix = '.presidio-upload-'
+_upload_registry_dir = '/var/tmp/presidio-uploads'
+
+_uploads_enabled = False
+_upload_max_bytes = 4 * 1024 * 1024 * 1024
+_upload_chunk_bytes = 1024 * 1024
+_upload_partial_max_age_seconds = 24 * 60 * 60
+_upload_sweep_seconds = 60 * 60
+_upload_sweep_lock_file = '/dev/shm/presidio-upload-sweep.lock'
+_upload_sweeper = None
+
+
+def uploads_enabled():
+    return _uploads_enabled
+
+
+def _expected_digest():
+    repr_digest = request.headers.get('Repr-Digest')
+    if not repr_digest:
+        return None
+    digest_match = re_search(r'sha-256=:([A-Za-z0-9+/=]+):', repr_digest)
+    if not digest_match:
+        abort(400, 'Only sha-256 digests are supported in Repr-Digest.')
+    try:
+        return b64decode(digest_match.group(1), validate=True).hex()
+    except B64Error:
+        abort(400, 'Invalid sha-256 digest specified in Repr-Digest.')
+
+
+def _content_range():
+    content_range_header = request.headers.get('Content-Range')
+    if content_range_header is None:
+        return None
+    content_range = parse_content_range_header(content_range_header)
+    if (content_range is None) or (content_range.length is None):
+        abort(400, 'Invalid Content-Range; the total size must be given.')
+    return content_range
+
+
+def _progress_response(body, status, received):
+    # As with other resumable upload protocols, the Range header tells
+    # the requester how much has been received so far (if anything).
+    progress_response = make_response(body, status)
+    if received > 0:
+        progress_response.headers['Range'] = f'bytes=0-{received - 1}'
+    return progress_response
+
+
+def _partial_path(target_path, user_DN):
+    upload_key = hashlib.sha256(
+        f'{target_path}|{user_DN}'.encode('utf-8')).hexdigest()[:24]
+    return join(dirname(target_path), f'{_upload_prefix}{upload_key}')
+
+
+def _partial_size(partial_path):
+    try:
+        return stat(partial_path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _registry_entry(upload_path):
+    entry_name = hashlib.sha256(upload_path.encode('utf-8')).hexdigest()[:24]
+    return join(_upload_registry_dir, entry_name)
+
+
+def _register_upload(upload_path):
+    try:
+        entry_fd = os_open(_registry_entry(upload_path),
+                           O_WRONLY | O_CREAT | O_EXCL, 0o600)
+    except FileExistsError:
+        return
+    try:
+        write(entry_fd, upload_path.encode('utf-8'))
+    finally:
+        close(entry_fd)
+
+
+def _remove_quietly(path):
+    try:
+        remove(path)
+    except EnvironmentError:
+        pass
+
+
+def _remove_upload(upload_path):
+    _remove_quietly(upload_path)
+    _remove_quietly(_registry_entry(upload_path))
+
+
+def _lock_partial(partial_path):
+    """Opens (creating if need be) and locks the partial file at
+    partial_path; returns None if another piece of the same upload is
+    being written to it."""
+    upload_file = fdopen(os_open(partial_path, O_RDWR | O_CREAT, 0o666),
+                         'r+b')
+    try:
+        # flock, rather than lockf: pieces in the same worker must
+        # exclude each other, too.
+        fcntl.flock(upload_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # The upload may have been completed (its file renamed over the
+        # target), or swept, between our open and our lock.
+        file_stat = fstat(upload_file.fileno())
+        path_stat = stat(partial_path)
+        if ((file_stat.st_ino, file_stat.st_dev) !=
+                (path_stat.st_ino, path_stat.st_dev)):
+            raise FileNotFoundError(partial_path)
+    except OSError:
+        upload_file.close()
+        return None
+    _register_upload(partial_path)
+    return upload_file
+
+
+def _position_partial(upload_file, offset):
+    """Returns the size of the (locked) partial file; if the piece at
+    offset may be written, readies the file for it."""
+    partial_size = fstat(upload_file.fileno()).st_size
+    # A piece starting at zero starts the upload over.
+    if (offset == 0) or (offset == partial_size):
+        upload_file.seek(offset)
+        upload_file.truncate()
+    return partial_size
+
+
+def _open_temp(target_dir):
+    upload_file = NamedTemporaryFile('wb', dir=target_dir,
+                                     prefix=_upload_prefix, delete=False)
+    try:
+        _register_upload(upload_file.name)
+    except Exception:
+        upload_file.close()
+        _remove_quietly(upload_file.name)
+        raise
+    return upload_file
+
+
+def _sync_file(upload_file):
+    upload_file.flush()
+    fsync(upload_file.fileno())
+
+
+def _complete_upload(upload_path, target_path):
+    replace(upload_path, target_path)
+    _remove_quietly(_registry_entry(upload_path))
+
+
+def _keep_labels(target_path, upload_path):
+    # The new content must carry the labels of the file it replaces;
+    # otherwise, it would fall back to those of the directory.
+    try:
+        copy_label_xattrs(target_path, upload_path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_if_abandoned(entry_path, now):
+    """Removes the upload file named by the registry entry at entry_path
+    (and the entry) if it hasn't been written to for
+    partial_max_age_seconds; returns whether the file was removed."""
+    try:
+        with open(entry_path, 'rb') as entry_file:
+            upload_path = entry_file.read().decode('utf-8')
+        upload_stat = stat(upload_path)
+    except FileNotFoundError:
+        # Completed, or removed, since it was registered.
+        _remove_quietly(entry_path)
+        return False
+    if now - upload_stat.st_mtime <= _upload_partial_max_age_seconds:
+        return False
+
+    with open(upload_path, 'rb') as upload_file:
+        try:
+            fcntl.flock(upload_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # A piece is being written to it right now.
+            return False
+        _remove_quietly(upload_path)
+    _remove_quietly(entry_path)
+    return True
+
+
+def sweep_uploads():
+    """Removes the partial and temporary upload files in the registry
+    that haven't been written to for partial_max_age_seconds; returns
+    the number removed."""
+    now = time()
+    num_removed = 0
+    for entry_name in fs_call(listdir, _upload_registry_dir):
+        entry_path = join(_upload_registry_dir, entry_name)
+        try:
+            if fs_call(_remove_if_abandoned, entry_path, now):
+                num_removed += 1
+        except EnvironmentError as e:
+            LOG.debug(f'Unable to sweep upload {entry_path}: {e}')
+        # Let requests go first.
+        sleep(0)
+    if num_removed:
+        METRICS_LOG.info(f'Removed {num_removed} abandoned upload files')
+    return num_removed
+
+
+def _sweep_unless_locked():
+    with open(_upload_sweep_lock_file, 'a') as lock_file:
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Another worker is already at it.
+            return
+        sweep_uploads()
+
+
+def _sweep_uploads_periodically():
+    while True:
+        try:
+            _sweep_unless_locked()
+        except Exception as e:
+            LOG.error('Error occurred while removing abandoned uploads!')
+            LOG.error('Error message:')
+            LOG.error(e)
+        sleep(_upload_sweep_seconds)
+
+
+def _start_sweeper():
+    # Started with the first upload a worker receives.
+    global _upload_sweeper
+    if _upload_sweeper is not None:
+        return
+    _upload_sweeper = Thread(target=_sweep_uploads_periodically, daemon=True,
+                             name='presidio-upload-sweeper')
+    _upload_sweeper.start()
+
+
+def _stream_body(upload_file, limit, body_hash):
+    """Copies the request body to upload_file, a chunk at a time; returns
+    the number of bytes written, or None if the body exceeded limit."""
+    body_stream = request.stream
+    written = 0
+    while True:
+        chunk = body_stream.read(_upload_chunk_bytes)
+        if not chunk:
+            return written
+        written += len(chunk)
+        if written > limit:
+            return None
+        if body_hash is not None:
+            body_hash.update(chunk)
+        fs_call(upload_file.write, chunk)
+
+
+def _target_path(autoindex, path):
+    rel_path = normpath(path.strip('/') or '.')
+    if (rel_path == '..') or rel_path.startswith('../'):
+        abort(404)
+    abspath = join(autoindex.rootdir.abspath, rel_path)
+
+    # Uploads to a directory name the new file with the "name" argument.
+    if fs_call(isdir, abspath):
+        upload_name = request.args.get('name', '')
+        if (not upload_name) or ('/' in upload_name) or (
+                upload_name in ('.', '..')):
+            abort(400, 'A file name must be given, with "name".')
+        rel_path = normpath(join(rel_path, upload_name))
+        abspath = join(abspath, upload_name)
+
+    upload_name = basename(abspath)
+    if is_label_file(upload_name) or upload_name.startswith(_upload_prefix):
+        abort(403, 'Files of that name may not be uploaded.')
+    return (rel_path, abspath)
+
+
+def receive_upload(autoindex, path, dataset_SCID, user_DN,
+                   ns_token, project_ID):
+    """Stores the request body (PUT or POST) as the file at path, or as
+    the file given by the "name" argument in the directory at path.
+
+    The requester must be authorized for the target directory, and for
+    the target file (by the labels it has, or would have once created),
+    before any of the body is read."""
+    upload_start = timer()
+    rel_path, target_path = _target_path(autoindex, path)
+    target_dir = dirname(target_path)
+    _start_sweeper()
+
+    if not (fs_call(isdir, target_dir) and
+            autoindex.is_it_safe(target_dir, dataset_SCID, user_DN,
+                                 ns_token, project_ID)):
+        abort(404)
+    if fs_call(isdir, target_path):
+        abort(409, 'A directory of that name already exists.')
+    try:
+        fs_call(stat, target_path)
+        replacing = True
+    except FileNotFoundError:
+        replacing = False
+    # A new file may get labels of its own (e.g. from a SafeLabels
+    # override), which the requester must hold, too.
+    if not autoindex.is_it_safe(target_path, dataset_SCID,
+                                user_DN, ns_token, project_ID):
+        abort(404)
+
+    expected_digest = _expected_digest()
+    content_range = _content_range()
+    if (request.content_length or 0) > _upload_max_bytes or (
+            content_range and (content_range.length > _upload_max_bytes)):
+        abort(413)
+
+    if content_range is None:
+        upload_file = fs_call(_open_temp, target_dir)
+        upload_path = upload_file.name
+        total_size = None
+        offset = 0
+    else:
+        upload_path = _partial_path(target_path, user_DN)
+        total_size = content_range.length
+
+        # "bytes */<total>", with no body, asks how much has been received.
+        if content_range.start is None:
+            return _progress_response('', 202,
+                                      fs_call(_partial_size, upload_path))
+
+        offset = content_range.start
+        upload_file = fs_call(_lock_partial, upload_path)
+        if upload_file is None:
+            return _progress_response(
+                'Another piece of this upload is being received.',
+                409, fs_call(_partial_size, upload_path))
+        partial_size = fs_call(_position_partial, upload_file, offset)
+        if (offset > 0) and (offset != partial_size):
+            fs_call(upload_file.close)
+            return _progress_response(
+                'Upload must continue from the end of what was received.',
+                409, partial_size)
+
+    # When the whole body arrives at once, hash it on the way through.
+    body_hash = None
+    if expected_digest and (offset == 0) and (
+            (content_range is None) or (content_range.stop == total_size)):
+        body_hash = hashlib.sha256()
+
+    limit = _upload_max_bytes
+    if content_range is not None:
+        limit = content_range.stop - offset
+    # The file stays open until the upload is complete (or this piece
+    # received); for a partial file, that's what holds the lock.
+    try:
+        try:
+            written = _stream_body(upload_file, limit, body_hash)
+            fs_call(_sync_file, upload_file)
+        except Exception:
+            if content_range is None:
+                fs_call(_remove_upload, upload_path)
+            raise
+        if written is None:
+            if content_range is not None:
+                abort(400, 'Upload piece is longer than its Content-Range.')
+            fs_call(_remove_upload, upload_path)
+            abort(413)
+
+        received = offset + written
+        if (content_range is not None) and (received < total_size):
+            if received != content_range.stop:
+                LOG.debug((f'Upload piece for {rel_path} ended early, '
+                           f'at {received} bytes'))
+            return _progress_response('', 202, received)
+
+        digest = None
+        if body_hash is not None:
+            digest = body_hash.hexdigest()
+        elif expected_digest:
+            digest = hash_file(upload_path)
+        if expected_digest and (digest != expected_digest):
+            fs_call(_remove_upload, upload_path)
+            abort(400, 'Uploaded content does not match the given digest.')
+
+        try:
+            fs_call(_keep_labels, target_path, upload_path)
+        except Exception:
+            fs_call(_remove_upload, upload_path)
+            raise
+        fs_call(_complete_upload, upload_path, target_path)
+    finally:
+        fs_call(upload_file.close)
+    if digest:
+        store_checksum(target_path, digest)
+
+    upload_end = timer()
+    METRICS_LOG.info((f'Upload for request {request.uuid} of {rel_path} '
+                      f'({received} bytes) completed in '
+                      f'{upload_end - upload_start} seconds'))
+
+    upload_result = {'path': rel_path, 'size': received}
+    if digest:
+        upload_result['sha256'] = digest
+    return make_response(jsonify(upload_result), (200 if replacing else 201))
+
+
+def configure_uploads(presidio_config):
+    global _uploads_enabled, _upload_max_bytes
+    global _upload_partial_max_age_seconds, _upload_registry_dir
+    _uploads_enabled = False
+
+    conf_uploads = presidio_config.get('uploads')
+    if not conf_uploads:
+        return
+
+    conf_max_bytes = conf_uploads.get('max_bytes')
+    if conf_max_bytes is not None:
+        if (type(conf_max_bytes) is int) and (conf_max_bytes > 0):
+            _upload_max_bytes = conf_max_bytes
+        else:
+            LOG.warning(('\"max_bytes\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning(f'Proceeding with default value: {_upload_max_bytes}')
+
+    conf_max_age = conf_uploads.get('partial_max_age_seconds')
+    if conf_max_age is not None:
+        if (type(conf_max_age) in (int, float)) and (conf_max_age > 0):
+            _upload_partial_max_age_seconds = conf_max_age
+        else:
+            LOG.warning(('\"partial_max_age_seconds\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_upload_partial_max_age_seconds}'))
+
+    conf_registry_dir = conf_uploads.get('registry_dir')
+    if conf_registry_dir is not None:
+        if type(conf_registry_dir) is str:
+            _upload_registry_dir = conf_registry_dir
+        else:
+            LOG.warning(('\"registry_dir\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning((f'Proceeding with default value: '
+                         f'{_upload_registry_dir}'))
+
+    _uploads_enabled = bool(conf_uploads.get('enabled', True))
+    if _uploads_enabled:
+        try:
+            makedirs(_upload_registry_dir, mode=0o700, exist_ok=True)
+        except OSError as e:
+            LOG.error((f'Unable to create the upload registry '
+                       f'{_upload_registry_dir}: {e}'))
+            LOG.warning('Uploads will be disabled.')
+            _uploads_enabled = False
+            return
+        LOG.info((f'Uploads of up to {_upload_max_bytes} bytes '
+                  f'will be accepted.'))
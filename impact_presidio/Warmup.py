@@ -0,0 +1,451 @@
+import asyncio
+import OpenSSL.crypto as crypto
+import sys
+import urllib.parse
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from datetime import datetime, timedelta
+from jwcrypto import jwk
+from ns_jwt import NSJWT
+from os import makedirs
+from os.path import join
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer as timer
+from xattr import xattr
+
+from flask_autoindex import RootDirectory
+from importlib import import_module
+
+from impact_presidio import CredentialUtils
+from impact_presidio import DirectoryScan
+from impact_presidio import LabelMechs
+from impact_presidio import Prefetch
+from impact_presidio import SharedCache
+from impact_presidio.Logging import LOG, METRICS_LOG
+from impact_presidio.Lifecycle import register_worker_ready_hook
+
+# The package re-exports the SafeAutoIndex class under the same name as
+# its module, so fetch the module itself this way.
+SafeAutoIndexModule = import_module('impact_presidio.SafeAutoIndex')
+
+_warmup_app = None
+_warmup_autoindex = None
+_warmup_requests = 0
+_warmup_seconds = 10
+_warmup_keys = None
+
+_warmup_issuer = 'presidio-warmup.invalid'
+_warmup_safe_server = 'presidio-warmup.invalid:0'
+_warmup_SCID = 'presidio-warmup-dataset'
+_warmup_other_SCID = 'presidio-warmup-other-dataset'
+_warmup_CA_generation = 'presidio-warmup'
+
+
+class _StubResponse(object):
+    """Minimal stand-in for a requests.Response object."""
+
+    def __init__(self, json_value, status_code=200):
+        self.status_code = status_code
+        self._json_value = json_value
+
+    def __bool__(self):
+        return (self.status_code < 400)
+
+    def json(self):
+        return self._json_value
+
+    def close(self):
+        pass
+
+
+class _StubAsyncClient(object):
+    """Minimal stand-in for the httpx.AsyncClient used by AsyncPresidio."""
+
+    def __init__(self, jwks):
+        self._jwks = jwks
+
+    async def get(self, url, *args, **kwargs):
+        return _StubResponse(self._jwks)
+
+    async def post(self, url, *args, **kwargs):
+        return _StubResponse({'result': 'succeed'})
+
+
+def _generate_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def _generate_cert(common_name, key, issuer_name=None,
+                   issuer_key=None, is_ca=False):
+    subject = x509.Name([
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, 'Presidio Warmup'),
+        x509.NameAttribute(NameOID.COMMON_NAME, common_name)
+    ])
+    if issuer_name is None:
+        issuer_name = subject
+        issuer_key = key
+
+    now = datetime.utcnow()
+    cert = (x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(issuer_name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - timedelta(minutes=5))
+            .not_valid_after(now + timedelta(hours=1))
+            .add_extension(x509.BasicConstraints(ca=is_ca, path_length=None),
+                           critical=True)
+            .sign(issuer_key, hashes.SHA256()))
+    return cert
+
+
+def generate_stub_keys():
+    """Generates the throwaway CA, client and Notary Service keys used by
+    generate_stub_credentials."""
+    return {'ca': _generate_key(),
+            'client': _generate_key(),
+            'ns': _generate_key()}
+
+
+def generate_stub_credentials(dataset_SCID=_warmup_SCID,
+                              issuer=_warmup_issuer, keys=None):
+    """Generates a throwaway set of credentials, suitable for pushing
+    requests through process_credentials without any outside services.
+    Keys from generate_stub_keys may be passed in, to skip generating
+    new ones.
+
+    Returns a dictionary containing: a CA store with the throwaway CA,
+    the client certificate (URL-encoded, as nginx would provide it),
+    a signed Notary Service JWT, and the matching JWKS."""
+    if keys is None:
+        keys = generate_stub_keys()
+
+    ca_key = keys['ca']
+    ca_cert = _generate_cert('Presidio Warmup CA', ca_key, is_ca=True)
+
+    client_key = keys['client']
+    client_cert = _generate_cert('Presidio Warmup User', client_key,
+                                 issuer_name=ca_cert.subject,
+                                 issuer_key=ca_key)
+    client_cert_pem = client_cert.public_bytes(serialization.Encoding.PEM)
+
+    ca_store = crypto.X509Store()
+    ca_store.add_cert(crypto.X509.from_cryptography(ca_cert))
+    # Sessions issued against this store are bound to its generation, and
+    # so won't be accepted once the real CA store is back in place.
+    ca_store.presidio_generation = _warmup_CA_generation
+
+    client_x509 = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                          client_cert_pem)
+    user_DN = ''
+    for k, v in client_x509.get_subject().get_components():
+        user_DN = (f'{user_DN}/{k.decode()}={v.decode()}')
+
+    ns_key = keys['ns']
+    ns_key_pem = ns_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+    ns_pubkey_pem = ns_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo)
+    ns_pubkey = crypto.load_publickey(crypto.FILETYPE_PEM, ns_pubkey_pem)
+    ns_token = CredentialUtils.generate_safe_principal_id(ns_pubkey)
+
+    ns_jwt = NSJWT()
+    ns_jwt.setClaims(projectId='presidio-warmup-project',
+                     dataSet=dataset_SCID,
+                     nsToken=ns_token.decode('utf-8'),
+                     iss=issuer,
+                     nsName='Presidio Warmup Notary Service',
+                     sub=user_DN,
+                     name='Presidio Warmup User')
+    jwt = ns_jwt.encode(ns_key_pem.decode('utf-8'), timedelta(hours=1))
+
+    jwks = {'keys': [jwk.JWK.from_pem(ns_pubkey_pem).export_public(
+        as_dict=True)]}
+
+    return {
+        'ca_store': ca_store,
+        'ca_cert_pem': ca_cert.public_bytes(serialization.Encoding.PEM),
+        'client_cert_pem': client_cert_pem,
+        'client_key': client_key,
+        'url_encoded_cert': urllib.parse.quote(client_cert_pem),
+        'user_DN': user_DN,
+        'jwt': jwt,
+        'jwks': jwks
+    }
+
+
+def _create_label_tree(label_mech_fn):
+    """Creates a small, throwaway tree of labeled directories and files.
+
+    Returns the root of the tree, along with the list of paths (relative
+    to that root) to be requested during warm-up."""
+    tree_root = mkdtemp(prefix='presidio-warmup-')
+    try:
+        request_paths = _populate_label_tree(tree_root, label_mech_fn)
+    except Exception:
+        rmtree(tree_root, ignore_errors=True)
+        raise
+
+    return tree_root, request_paths
+
+
+def _populate_label_tree(tree_root, label_mech_fn):
+    request_paths = ['']
+
+    for top in ['alpha', 'beta']:
+        for sub in ['one', 'two', 'three']:
+            dir_path = join(tree_root, top, sub)
+            makedirs(dir_path)
+            request_paths.append(f'{top}/{sub}/')
+            for i in range(8):
+                file_name = f'data-{i}.csv'
+                with open(join(dir_path, file_name), 'w') as f:
+                    f.write('id,value\n')
+                    for j in range(16):
+                        f.write(f'{j},{i * j}\n')
+                request_paths.append(f'{top}/{sub}/{file_name}')
+        request_paths.append(f'{top}/')
+
+    if label_mech_fn == LabelMechs.ExtendedAttributeLabelCheck:
+        label_key = f'{LabelMechs._xattr_label_base}.0'
+        xattr(tree_root)[label_key] = _warmup_SCID.encode('utf-8')
+        xattr(join(tree_root, 'beta', 'two'))[label_key] = (
+            _warmup_other_SCID.encode('utf-8'))
+    else:
+        with open(join(tree_root, LabelMechs._safelabels_filename), 'w') as f:
+            f.write('version: 1.0\n')
+            f.write(f'default: [ {_warmup_SCID} ]\n')
+            f.write('overrides:\n')
+            f.write(f'  "data-7\\\\.csv$": {_warmup_other_SCID}\n')
+        with open(join(tree_root, 'beta', 'two',
+                       LabelMechs._safelabels_filename), 'w') as f:
+            f.write('version: 1.0\n')
+            f.write(f'default: [ {_warmup_other_SCID}, {_warmup_SCID} ]\n')
+
+    return request_paths
+
+
+def _make_stub_get(jwks):
+    def _stub_get(url, *args, **kwargs):
+        return _StubResponse(jwks)
+    return _stub_get
+
+
+def _stub_post(url, *args, **kwargs):
+    return _StubResponse({'result': 'succeed'})
+
+
+def _wsgi_requester(presidio_app, headers):
+    client = presidio_app.test_client(use_cookies=False)
+
+    def _request(url, query):
+        resp = client.get(f'{url}{query}', headers=headers)
+        resp.close()
+        return resp.status_code
+    return _request
+
+
+async def _asgi_get(asgi_app, url, query, headers):
+    scope = {'type': 'http',
+             'http_version': '1.1',
+             'method': 'GET',
+             'scheme': 'https',
+             'path': url,
+             'root_path': '',
+             'query_string': query.lstrip('?').encode('latin-1'),
+             'headers': [(name.lower().encode('latin-1'),
+                          value.encode('latin-1'))
+                         for (name, value) in headers.items()],
+             'client': ('127.0.0.1', 0),
+             'server': ('localhost', 443)}
+    response = {}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+
+    await asgi_app(scope, receive, send)
+    return response.get('status', 500)
+
+
+def _asgi_requester(async_presidio, headers, loop):
+    def _request(url, query):
+        return loop.run_until_complete(
+            _asgi_get(async_presidio.application, url, query, headers))
+    return _request
+
+
+def run_warmup(presidio_app, autoindex, num_requests, max_seconds):
+    """Pushes synthetic requests through the real request handling path,
+    using a throwaway set of credentials and label tree. When serving
+    with the ASGI entry point, the requests are made through it.
+
+    Everything swapped out for the duration of the warm-up (CA store,
+    JWKS and SAFE clients, project path) is put back afterward, and any
+    cache entries that the warm-up created are discarded."""
+    warmup_start = timer()
+    credentials = generate_stub_credentials(keys=_warmup_keys)
+    web_root = presidio_app.config['WEB_ROOT']
+    # Only imported when it is what's being served.
+    async_presidio = sys.modules.get('impact_presidio.AsyncPresidio')
+
+    saved_ca_store = CredentialUtils._CAStore
+    saved_get = CredentialUtils.get
+    saved_post = SafeAutoIndexModule.post
+    saved_project_path = LabelMechs._project_path
+    saved_rootdir = autoindex.rootdir
+    saved_safe_server_list = presidio_app.config['SAFE_SERVER_LIST']
+    saved_metrics_disabled = METRICS_LOG.disabled
+    saved_shared_cache = SharedCache._shared_cache
+    saved_prefetch_queue = Prefetch._prefetch_queue
+    if async_presidio is not None:
+        saved_http_client = async_presidio._http_client
+
+    tree_root, request_paths = _create_label_tree(LabelMechs._label_mech_fn)
+
+    completed = 0
+    failed = 0
+    loop = None
+    try:
+        CredentialUtils._CAStore = credentials['ca_store']
+        CredentialUtils.get = _make_stub_get(credentials['jwks'])
+        SafeAutoIndexModule.post = _stub_post
+        LabelMechs._project_path = Path(tree_root)
+        autoindex.rootdir = RootDirectory(tree_root, autoindex=autoindex)
+        presidio_app.config['SAFE_SERVER_LIST'] = [_warmup_safe_server]
+        METRICS_LOG.disabled = True
+        # Nothing from the warm-up belongs in other workers' caches.
+        SharedCache._shared_cache = None
+        # Nor should the throwaway tree be prefetched; the prefetcher
+        # would still be at it after the project path is put back.
+        Prefetch._prefetch_queue = None
+
+        headers = {'X-SSL-Cert': credentials['url_encoded_cert'],
+                   'Cookie': f'ImPACT-JWT={credentials["jwt"]}'}
+        if async_presidio is not None:
+            async_presidio._http_client = _StubAsyncClient(
+                credentials['jwks'])
+            loop = asyncio.new_event_loop()
+            request = _asgi_requester(async_presidio, headers, loop)
+        else:
+            request = _wsgi_requester(presidio_app, headers)
+        sort_args = ['', '?sort_by=size', '?sort_by=-modified']
+
+        while completed < num_requests:
+            path = request_paths[completed % len(request_paths)]
+            query = ''
+            if path.endswith('/') or path == '':
+                query = sort_args[completed % len(sort_args)]
+            status_code = request(f'{web_root}/{path}', query)
+            # Some of the paths are deliberately labeled to be denied
+            # (404); anything else outside of 2xx and 3xx suggests that
+            # the warm-up isn't exercising the paths we expect it to.
+            if ((status_code >= 400) and (status_code != 404)):
+                failed += 1
+                LOG.debug((f'Warm-up request for {path} returned '
+                           f'status {status_code}'))
+            completed += 1
+            if (timer() - warmup_start) > max_seconds:
+                LOG.info('Warm-up time limit reached; stopping early.')
+                break
+    finally:
+        if loop is not None:
+            loop.close()
+        if async_presidio is not None:
+            async_presidio._http_client = saved_http_client
+        CredentialUtils._CAStore = saved_ca_store
+        CredentialUtils.get = saved_get
+        SafeAutoIndexModule.post = saved_post
+        LabelMechs._project_path = saved_project_path
+        autoindex.rootdir = saved_rootdir
+        presidio_app.config['SAFE_SERVER_LIST'] = saved_safe_server_list
+        METRICS_LOG.disabled = saved_metrics_disabled
+        SharedCache._shared_cache = saved_shared_cache
+        Prefetch._prefetch_queue = saved_prefetch_queue
+
+        _discard_warmup_state(tree_root, autoindex)
+
+    warmup_end = timer()
+    LOG.info((f'Warm-up completed {completed} requests in '
+              f'{warmup_end - warmup_start} seconds'))
+    if failed > 0:
+        LOG.warning((f'{failed} of the warm-up requests failed unexpectedly; '
+                     f'set log_level to DEBUG for details.'))
+    return completed
+
+
+def _discard_warmup_state(tree_root, autoindex):
+    safe_result_cache = SafeAutoIndexModule.SafeAutoIndex.safe_result_cache
+    for key in list(safe_result_cache.keys()):
+        if _warmup_safe_server in key:
+            safe_result_cache.pop(key, None)
+
+    with autoindex.decision_cache_lock:
+        for decision_key in list(autoindex.decision_cache.keys()):
+            if decision_key[0].startswith(tree_root):
+                autoindex.decision_cache.pop(decision_key, None)
+
+    for sl_path in list(LabelMechs._safelabels_cache.keys()):
+        if str(sl_path).startswith(tree_root):
+            LabelMechs._safelabels_cache.pop(sl_path, None)
+
+    DirectoryScan._invalidate_scans({'path_prefix': tree_root})
+
+    RootDirectory._rootdirs.pop((tree_root, autoindex), None)
+    rmtree(tree_root, ignore_errors=True)
+
+
+def _warmup_worker():
+    if _warmup_requests > 0:
+        LOG.info(f'Warming up worker with {_warmup_requests} requests...')
+        run_warmup(_warmup_app, _warmup_autoindex,
+                   _warmup_requests, _warmup_seconds)
+
+
+def configure_warmup(presidio_app, autoindex):
+    global _warmup_app, _warmup_autoindex, _warmup_keys
+    global _warmup_requests, _warmup_seconds
+    _warmup_app = presidio_app
+    _warmup_autoindex = autoindex
+
+    presidio_config = presidio_app.config['PRESIDIO_CONFIG']
+    conf_warmup_requests = presidio_config.get('warmup_requests')
+    if conf_warmup_requests is not None:
+        if ((type(conf_warmup_requests) is int) and
+                (conf_warmup_requests >= 0)):
+            _warmup_requests = conf_warmup_requests
+        else:
+            LOG.warning(('\"warmup_requests\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning('Worker warm-up will be disabled.')
+
+    conf_warmup_seconds = presidio_config.get('warmup_seconds')
+    if conf_warmup_seconds is not None:
+        if (((type(conf_warmup_seconds) is int) or
+             (type(conf_warmup_seconds) is float)) and
+                (conf_warmup_seconds > 0)):
+            _warmup_seconds = conf_warmup_seconds
+        else:
+            LOG.warning(('\"warmup_seconds\" incorrectly ' +
+                         'specified in configuration!'))
+            LOG.warning(f'Proceeding with default value: {_warmup_seconds}')
+
+    if _warmup_requests > 0:
+        LOG.info((f'Workers will be warmed up with {_warmup_requests} '
+                  f'requests (for at most {_warmup_seconds} seconds) '
+                  f'before accepting traffic.'))
+        # Generated here, so that (when preloading) the key generation is
+        # done once, in the master, rather than in every worker.
+        _warmup_keys = generate_stub_keys()
+        register_worker_ready_hook(_warmup_worker)
@@ -9,11 +9,29 @@ from flask_autoindex import AutoIndex
 from timeit import default_timer as timer
 
 from impact_presidio import Config
+from impact_presidio.Admin import configure_admin
+from impact_presidio.Admission import configure_admission
+from impact_presidio.Authorize import authorize_paths, configure_authorize
+from impact_presidio.Checksums import checksum_response, configure_checksums
+from impact_presidio.DirectoryScan import configure_scan_cache
 from impact_presidio.Logging import configure_logging
 from impact_presidio.Logging import create_metrics_logger, METRICS_LOG
+from impact_presidio.IOPool import configure_fs_pool
 from impact_presidio.LabelMechs import configure_label_mech
+from impact_presidio.Memory import configure_memory_diagnostics
+from impact_presidio.Precompressed import configure_precompressed
+from impact_presidio.Prefetch import configure_prefetch
 from impact_presidio.CredentialUtils import process_credentials
+from impact_presidio.FileIndex import configure_file_index
 from impact_presidio.SafeAutoIndex import SafeAutoIndex
+from impact_presidio.Search import configure_search, search_files
+from impact_presidio.Session import configure_sessions
+from impact_presidio.StaticAssets import configure_static_assets
+from impact_presidio.Uploads import configure_uploads
+from impact_presidio.SharedCache import configure_shared_cache
+from impact_presidio.CacheSnapshot import configure_cache_snapshot
+from impact_presidio.Reload import configure_reload
+from impact_presidio.Warmup import configure_warmup
 
 
 # Perform required monkey-patching
@@ -34,16 +52,51 @@ web_root = Config.get_web_root(presidio_config)
 app.config['PRESIDIO_CONFIG'] = presidio_config
 app.config['PRESIDIO_PRINCIPAL'] = presidio_principal
 app.config['SAFE_SERVER_LIST'] = safe_server_list
+app.config['WEB_ROOT'] = web_root
 
 Config.configure_ca_store(presidio_config)
+configure_sessions(presidio_config)
+configure_shared_cache(presidio_config)
+configure_admission(presidio_config)
 Config.configure_safe_result_cache_seconds(app)
+Config.configure_decision_cache_size(app)
 configure_label_mech(presidio_config, project_path)
+configure_fs_pool(presidio_config)
+configure_file_index(presidio_config, project_path)
+configure_search(presidio_config)
+configure_authorize(presidio_config)
+configure_scan_cache(presidio_config)
+configure_checksums(presidio_config)
+configure_uploads(presidio_config)
+configure_precompressed(presidio_config, project_path)
 
 # Sigh. Do we *have* to...?
 Config.configure_bad_ideas(presidio_config)
 
 autoIndex = AutoIndex(app, browse_root=project_path, add_url_rules=False)
 
+# Stylesheets and icons need neither credentials nor revalidation.
+configure_static_assets(app, autoIndex)
+
+# Optionally report on, and invalidate, caches (locally only).
+configure_admin(app, project_path)
+
+# Optionally warm up each worker (and the PyPy JIT) before it serves traffic.
+configure_warmup(app, autoIndex)
+
+# Optionally prefetch the directories listings show; only once warmed up,
+# since the warm-up's own listings are of a throwaway tree.
+configure_prefetch(presidio_config)
+
+# Allow configuration changes to be applied without a restart.
+configure_reload(app, autoIndex)
+
+# Optionally carry cache contents across worker restarts.
+configure_cache_snapshot(app, autoIndex)
+
+# Optionally sample memory use, once each worker is warmed up.
+configure_memory_diagnostics(presidio_config)
+
 # Ensure that process_credentials is run before any request.
 app.before_request(process_credentials)
 
@@ -63,6 +116,22 @@ def autoindex(path='.'):
     return route_result
 
 
+@app.route((web_root + '/__search__'), methods=['GET'])
+@app.route((web_root + '/__search__/<path:path>'), methods=['GET'])
+def search(path=''):
+    return search_files(autoIndex, path)
+
+
+@app.route((web_root + '/__checksum__/<path:path>'), methods=['GET'])
+def checksum(path):
+    return checksum_response(autoIndex, path)
+
+
+@app.route((web_root + '/__authorize__'), methods=['POST'])
+def authorize():
+    return authorize_paths(autoIndex)
+
+
 @app.errorhandler(401)
 def handle_unauthorized(error):
     return (render_template('unauthorized.html', reason=error.description),
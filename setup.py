@@ -21,6 +21,8 @@ setup(
         'requests >= 2.22.0',
         'xattr >= 0.9.6',
         'ns_jwt >= 0.1.2',
-        'jwcrypto >= 1.0'
+        'jwcrypto >= 1.0',
+        'httpx >= 0.23.0',
+        'uvicorn >= 0.20.0'
     ]
 )
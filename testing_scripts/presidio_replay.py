@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+
+# Summarizes Presidio's metrics log (and gunicorn's access log) into
+# per-phase latency distributions, and replays a recorded request mix
+# against a local Presidio, with stand-in SAFE and JWKS services.
+#
+# The replay runs Presidio in-process, behind a local threaded WSGI server;
+# like the warm-up, it swaps in a throwaway CA, client certificate and
+# Notary Service JWT (see impact_presidio.Warmup), and answers SAFE and
+# JWKS calls locally, after a configurable delay. It needs the same
+# environment as Presidio itself (in particular, its configuration file),
+# so run it inside the Presidio container, from the top of the repository.
+#
+# ** USAGE:
+# $ python3 testing_scripts/presidio_replay.py summarize \
+#       --metrics-log metrics.log --access-log access_log
+# $ PYTHONPATH=. python3 testing_scripts/presidio_replay.py replay \
+#       --access-log access_log --speed 2 --json release-a.json
+# $ python3 testing_scripts/presidio_replay.py compare \
+#       release-a.json release-b.json
+#
+# Without --project-path, replay builds a throwaway tree containing the
+# recorded paths (files are sparse, and sized as recorded); with it, the
+# given tree is used as-is, and --dataset-scid should name a data-set its
+# labels grant access to.
+
+import argparse
+import io
+import json
+import logging
+import re
+import sys
+import threading
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os import makedirs
+from os.path import dirname, exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep
+from timeit import default_timer as timer
+from urllib.parse import unquote, urlsplit
+
+_metrics_line = re.compile(
+    r'^\[(?P<time>[^\]]+)\] \[(?P<pid>\d+)\] \[(?P<source>[^\]]+)\] '
+    r'\[(?P<level>\w+)\] (?P<message>.*)$')
+
+_seconds = r'(?P<seconds>[0-9.eE+-]+) seconds'
+_phase_patterns = [
+    ('credentials', re.compile(
+        rf'^Credential processing for request (?P<uuid>\S+) '
+        rf'completed in {_seconds}')),
+    ('entries', re.compile(
+        rf'^Processing entries for request (?P<uuid>\S+) on directory '
+        rf'(?P<path>.+) completed in {_seconds}')),
+    ('request', re.compile(
+        rf'^Request (?P<uuid>\S+) processing completed in {_seconds}')),
+    ('search', re.compile(
+        rf'^Search for request (?P<uuid>\S+) on directory (?P<path>.+) '
+        rf'returned .* in {_seconds}')),
+    ('authorize', re.compile(
+        rf'^Authorization for request (?P<uuid>\S+) of \d+ paths '
+        rf'allowed \d+ in {_seconds}')),
+    ('upload', re.compile(
+        rf'^Upload for request (?P<uuid>\S+) of (?P<path>.+) '
+        rf'\(\d+ bytes\) completed in {_seconds}')),
+    ('admission_wait', re.compile(
+        rf'^Admission for (?P<path>.+) granted after waiting {_seconds}')),
+    ('slow_fs_op', re.compile(
+        rf'^Slow filesystem operation (?P<path>\S+) completed in {_seconds}')),
+]
+_admission_rejected = re.compile(r'^Admission for (?P<path>.+) rejected')
+
+# gunicorn's default access log format.
+_access_line = re.compile(
+    r'^(?P<host>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+    r'"(?P<method>[A-Z]+) (?P<target>\S+)[^"]*" '
+    r'(?P<status>\d{3}) (?P<bytes>\S+)')
+_access_time_format = '%d/%b/%Y:%H:%M:%S %z'
+
+_static_prefixes = ('/__autoindex__/', '/__icons__/')
+
+
+def parse_metrics_log(metrics_file):
+    """Returns a dictionary mapping each phase to the list of durations
+    (in seconds) recorded for it, along with a count of admission
+    rejections (under "admission_rejected")."""
+    phases = defaultdict(list)
+    rejected = 0
+    for line in metrics_file:
+        line_match = _metrics_line.match(line.rstrip('\n'))
+        if not line_match:
+            continue
+        message = line_match.group('message')
+        if _admission_rejected.match(message):
+            rejected += 1
+            continue
+        for phase, phase_pattern in _phase_patterns:
+            phase_match = phase_pattern.match(message)
+            if phase_match:
+                phases[phase].append(float(phase_match.group('seconds')))
+                break
+    phases = dict(phases)
+    if rejected:
+        phases['admission_rejected'] = rejected
+    return phases
+
+
+def classify_request(method, path, web_root):
+    if path.startswith(_static_prefixes):
+        return 'static'
+    if not (path == web_root or path.startswith(f'{web_root}/')):
+        return 'other'
+    rel_path = path[len(web_root):].lstrip('/')
+    if rel_path.startswith('__search__'):
+        return 'search'
+    if rel_path.startswith('__checksum__'):
+        return 'checksum'
+    if rel_path.startswith('__authorize__'):
+        return 'authorize'
+    if method in ('PUT', 'POST'):
+        return 'upload'
+    if (rel_path == '') or rel_path.endswith('/'):
+        return 'listing'
+    return 'file'
+
+
+def parse_access_log(access_file, web_root):
+    """Returns the requests recorded in a gunicorn access log, in order,
+    as dictionaries of: time (seconds since the epoch), method, target,
+    path, kind, status and bytes."""
+    requests = []
+    for line in access_file:
+        line_match = _access_line.match(line)
+        if not line_match:
+            continue
+        target = line_match.group('target')
+        path = unquote(urlsplit(target).path)
+        method = line_match.group('method')
+        response_bytes = line_match.group('bytes')
+        requests.append({
+            'time': datetime.strptime(line_match.group('time'),
+                                      _access_time_format).timestamp(),
+            'method': method,
+            'target': target,
+            'path': path,
+            'kind': classify_request(method, path, web_root),
+            'status': int(line_match.group('status')),
+            'bytes': int(response_bytes) if response_bytes.isdigit() else 0,
+        })
+
+    # Paths that other recorded paths lie beneath are directories, even
+    # if requested without a trailing slash.
+    parents = set()
+    for recorded in requests:
+        parent = dirname(recorded['path'].rstrip('/'))
+        while parent and (parent not in parents):
+            parents.add(parent)
+            parent = dirname(parent)
+    for recorded in requests:
+        if (recorded['kind'] == 'file') and (recorded['path'] in parents):
+            recorded['kind'] = 'listing'
+    return requests
+
+
+def distribution(durations):
+    """Summarizes a list of durations (in seconds)."""
+    if not durations:
+        return {'count': 0}
+    ordered = sorted(durations)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    return {'count': len(ordered),
+            'mean': sum(ordered) / len(ordered),
+            'p50': percentile(0.5), 'p90': percentile(0.9),
+            'p99': percentile(0.99), 'max': ordered[-1]}
+
+
+def request_mix(requests):
+    """Summarizes the shape of a recorded request stream: the share of
+    each kind of request, the response statuses, and the arrival rate."""
+    kinds = defaultdict(int)
+    statuses = defaultdict(int)
+    for recorded in requests:
+        kinds[recorded['kind']] += 1
+        statuses[str(recorded['status'])] += 1
+    mix = {'requests': len(requests), 'kinds': dict(kinds),
+           'statuses': dict(statuses)}
+    if len(requests) > 1:
+        duration = requests[-1]['time'] - requests[0]['time']
+        gaps = [b['time'] - a['time'] for a, b in zip(requests, requests[1:])]
+        mix['duration_seconds'] = duration
+        mix['requests_per_second'] = (len(requests) / duration
+                                      if duration > 0 else None)
+        mix['interarrival'] = distribution(gaps)
+    return mix
+
+
+def _print_distributions(title, distributions):
+    print(title)
+    print(f'  {"phase":<20}{"count":>8}{"mean":>10}{"p50":>10}'
+          f'{"p90":>10}{"p99":>10}{"max":>10}')
+    for phase, dist in sorted(distributions.items()):
+        if not isinstance(dist, dict):
+            print(f'  {phase:<20}{dist:>8}')
+            continue
+        if not dist['count']:
+            continue
+        print(f'  {phase:<20}{dist["count"]:>8}' +
+              ''.join(f'{dist[k]:>10.4f}'
+                      for k in ('mean', 'p50', 'p90', 'p99', 'max')))
+
+
+def _print_mix(mix):
+    print(f'Request mix: {mix["requests"]} requests')
+    for kind, count in sorted(mix['kinds'].items()):
+        print(f'  {kind:<20}{count:>8}  '
+              f'({100.0 * count / mix["requests"]:.1f}%)')
+    print(f'  statuses: {dict(sorted(mix["statuses"].items()))}')
+    if mix.get('requests_per_second'):
+        print(f'  {mix["requests_per_second"]:.2f} requests/second over '
+              f'{mix["duration_seconds"]:.0f} seconds')
+
+
+def _summarize_phases(phases):
+    return {phase: (distribution(durations)
+                    if isinstance(durations, list) else durations)
+            for phase, durations in phases.items()}
+
+
+def summarize(args):
+    summary = {}
+    if args.metrics_log:
+        with open(args.metrics_log, 'r', errors='replace') as mf:
+            summary['phases'] = _summarize_phases(parse_metrics_log(mf))
+        _print_distributions('Recorded phase latencies (seconds):',
+                             summary['phases'])
+    if args.access_log:
+        with open(args.access_log, 'r', errors='replace') as af:
+            requests = parse_access_log(af, args.web_root)
+        summary['mix'] = request_mix(requests)
+        _print_mix(summary['mix'])
+    if args.json:
+        with open(args.json, 'w') as jf:
+            json.dump(summary, jf, indent=2)
+
+
+def _build_replay_tree(requests, web_root, dataset_SCID):
+    from impact_presidio import LabelMechs
+
+    tree_root = mkdtemp(prefix='presidio-replay-')
+    for recorded in requests:
+        if recorded['kind'] not in ('listing', 'file'):
+            continue
+        rel_path = recorded['path'][len(web_root):].strip('/')
+        abs_path = join(tree_root, rel_path)
+        if recorded['kind'] == 'listing':
+            makedirs(abs_path, exist_ok=True)
+        elif not exists(abs_path):
+            makedirs(dirname(abs_path), exist_ok=True)
+            with open(abs_path, 'wb') as rf:
+                rf.truncate(recorded['bytes'])
+
+    with open(join(tree_root, LabelMechs._safelabels_filename), 'w') as lf:
+        lf.write('version: 1.0\n')
+        lf.write(f'default: [ {dataset_SCID} ]\n')
+    return tree_root
+
+
+def _stand_in(stand_in_fn, latency):
+    def _delayed_stand_in(*args, **kwargs):
+        if latency > 0:
+            sleep(latency)
+        return stand_in_fn(*args, **kwargs)
+    return _delayed_stand_in
+
+
+def _start_presidio(args, credentials, tree_root):
+    from importlib import import_module
+    from pathlib import Path
+    from flask_autoindex import RootDirectory
+    from werkzeug.serving import make_server
+
+    import impact_presidio
+    from impact_presidio import CredentialUtils, LabelMechs, Warmup
+    from impact_presidio.Logging import LOG_FORMAT, LOG_DATE_FORMAT
+    from impact_presidio.Logging import METRICS_LOG
+
+    CredentialUtils._CAStore = credentials['ca_store']
+    CredentialUtils.get = _stand_in(
+        Warmup._make_stub_get(credentials['jwks']), args.jwks_latency)
+    import_module('impact_presidio.SafeAutoIndex').post = _stand_in(
+        Warmup._stub_post, args.safe_latency)
+    LabelMechs._project_path = Path(tree_root)
+    impact_presidio.autoIndex.rootdir = RootDirectory(
+        tree_root, autoindex=impact_presidio.autoIndex)
+    impact_presidio.app.config['SAFE_SERVER_LIST'] = [
+        Warmup._warmup_safe_server]
+
+    # Collect the replay's own metrics, to be summarized the same way.
+    metrics_capture = io.StringIO()
+    capture_handler = logging.StreamHandler(metrics_capture)
+    capture_handler.setFormatter(
+        logging.Formatter(fmt=LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    METRICS_LOG.handlers = [capture_handler]
+    METRICS_LOG.disabled = False
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', args.port, impact_presidio.app,
+                         threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     name='presidio-replay-server',
+                                     daemon=True)
+    server_thread.start()
+    return (server, metrics_capture)
+
+
+def _replay_schedule(requests, speed):
+    # Access log times only have one-second resolution; spread requests
+    # recorded in the same second evenly across it.
+    schedule = []
+    by_second = defaultdict(list)
+    for recorded in requests:
+        by_second[recorded['time']].append(recorded)
+    start = min(by_second) if by_second else 0
+    for second in sorted(by_second):
+        in_second = by_second[second]
+        for i, recorded in enumerate(in_second):
+            offset = (second - start) + (i / len(in_second))
+            schedule.append((offset / speed, recorded))
+    return schedule
+
+
+def replay(args):
+    import requests as http
+
+    from impact_presidio import Warmup
+
+    with open(args.access_log, 'r', errors='replace') as af:
+        recorded_requests = parse_access_log(af, args.web_root)
+    skipped = [r for r in recorded_requests
+               if r['kind'] in ('upload', 'authorize', 'other')]
+    recorded_requests = [r for r in recorded_requests
+                         if r['kind'] not in ('upload', 'authorize', 'other')]
+    if args.limit:
+        recorded_requests = recorded_requests[:args.limit]
+    if not recorded_requests:
+        print('No replayable requests found.')
+        return 1
+
+    dataset_SCID = args.dataset_scid or Warmup._warmup_SCID
+    credentials = Warmup.generate_stub_credentials(dataset_SCID=dataset_SCID)
+    tree_root = args.project_path
+    if not tree_root:
+        tree_root = _build_replay_tree(recorded_requests, args.web_root,
+                                       dataset_SCID)
+
+    server, metrics_capture = _start_presidio(args, credentials, tree_root)
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    headers = {'X-SSL-Cert': credentials['url_encoded_cert'],
+               'Cookie': f'ImPACT-JWT={credentials["jwt"]}'}
+    thread_state = threading.local()
+
+    def send(recorded, due):
+        if not hasattr(thread_state, 'session'):
+            thread_state.session = http.Session()
+        send_start = timer()
+        try:
+            resp = thread_state.session.request(
+                recorded['method'], f'{base_url}{recorded["target"]}',
+                headers=headers, allow_redirects=False)
+            resp.content
+            status = resp.status_code
+        except http.RequestException:
+            status = 0
+        return (recorded['kind'], status, timer() - send_start,
+                send_start - due)
+
+    schedule = _replay_schedule(recorded_requests, args.speed)
+    print(f'Replaying {len(schedule)} requests ({len(skipped)} skipped) '
+          f'over {schedule[-1][0]:.1f} seconds...')
+    results = []
+    replay_start = timer()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = []
+            for offset, recorded in schedule:
+                due = replay_start + offset
+                delay = due - timer()
+                if delay > 0:
+                    sleep(delay)
+                futures.append(executor.submit(send, recorded, due))
+            results = [f.result() for f in futures]
+    finally:
+        server.shutdown()
+        if not args.project_path:
+            rmtree(tree_root, ignore_errors=True)
+    replay_end = timer()
+
+    latencies = defaultdict(list)
+    statuses = defaultdict(int)
+    lateness = []
+    for kind, status, latency, late_by in results:
+        latencies[kind].append(latency)
+        statuses[str(status)] += 1
+        lateness.append(max(0.0, late_by))
+
+    metrics_capture.seek(0)
+    summary = {
+        'replay': {'requests': len(results), 'skipped': len(skipped),
+                   'seconds': replay_end - replay_start,
+                   'speed': args.speed, 'statuses': dict(statuses),
+                   'dispatch_lateness': distribution(lateness)},
+        'latency': {kind: distribution(kind_latencies)
+                    for kind, kind_latencies in latencies.items()},
+        'phases': _summarize_phases(parse_metrics_log(metrics_capture)),
+        'mix': request_mix(recorded_requests),
+    }
+
+    _print_mix(summary['mix'])
+    _print_distributions('Replayed latency by request kind (seconds):',
+                         summary['latency'])
+    _print_distributions('Replayed phase latencies (seconds):',
+                         summary['phases'])
+    print(f'Replay statuses: {dict(sorted(statuses.items()))}; dispatch '
+          f'p99 lateness {summary["replay"]["dispatch_lateness"]["p99"]:.4f}'
+          f' seconds')
+    if args.json:
+        with open(args.json, 'w') as jf:
+            json.dump(summary, jf, indent=2)
+    return 0
+
+
+def compare(args):
+    with open(args.baseline, 'r') as bf:
+        baseline = json.load(bf)
+    with open(args.candidate, 'r') as cf:
+        candidate = json.load(cf)
+
+    for section in ('latency', 'phases'):
+        base_section = baseline.get(section, {})
+        cand_section = candidate.get(section, {})
+        print(f'{section} (p50 / p99 seconds, baseline -> candidate):')
+        for name in sorted(set(base_section) & set(cand_section)):
+            base_dist = base_section[name]
+            cand_dist = cand_section[name]
+            if not (isinstance(base_dist, dict) and
+                    isinstance(cand_dist, dict) and
+                    base_dist.get('count') and cand_dist.get('count')):
+                continue
+            changes = []
+            for key in ('p50', 'p99'):
+                change = ((cand_dist[key] - base_dist[key]) / base_dist[key]
+                          if base_dist[key] else 0.0)
+                changes.append(f'{base_dist[key]:.4f} -> {cand_dist[key]:.4f}'
+                               f' ({100.0 * change:+.1f}%)')
+            print(f'  {name:<20}' + '   '.join(changes))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Summarize Presidio metrics and access logs, and replay recorded '
+        'traffic against a local Presidio.'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    summarize_parser = subparsers.add_parser(
+        'summarize', help='per-phase latency distributions, request mix')
+    summarize_parser.add_argument('--metrics-log')
+    summarize_parser.add_argument('--access-log')
+    summarize_parser.add_argument('--web-root', default='/datasets')
+    summarize_parser.add_argument('--json', help='also write results here')
+
+    replay_parser = subparsers.add_parser(
+        'replay', help='replay an access log against a local Presidio')
+    replay_parser.add_argument('--access-log', required=True)
+    replay_parser.add_argument('--web-root', default='/datasets',
+                               help='web_root in the recorded traffic')
+    replay_parser.add_argument('--project-path',
+                               help='tree to serve (default: synthesized)')
+    replay_parser.add_argument('--dataset-scid',
+                               help='data-set to request access as')
+    replay_parser.add_argument('--speed', type=float, default=1.0,
+                               help='replay faster (>1) or slower (<1)')
+    replay_parser.add_argument('--concurrency', type=int, default=32)
+    replay_parser.add_argument('--limit', type=int, default=0)
+    replay_parser.add_argument('--safe-latency', type=float, default=0.005,
+                               help='stand-in SAFE delay, in seconds')
+    replay_parser.add_argument('--jwks-latency', type=float, default=0.02,
+                               help='stand-in JWKS delay, in seconds')
+    replay_parser.add_argument('--port', type=int, default=0)
+    replay_parser.add_argument('--json', help='also write results here')
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare two replay (or summarize) JSON results')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+
+    args = parser.parse_args()
+    if args.command == 'summarize':
+        return summarize(args)
+    if args.command == 'replay':
+        return replay(args)
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import sys
+
+from types import SimpleNamespace
+
+import pytest
+from flask_autoindex import RootDirectory
+
+import impact_presidio
+from impact_presidio import Admin, CredentialUtils, LabelMechs, Warmup
+
+SafeAutoIndexModule = sys.modules['impact_presidio.SafeAutoIndex']
+
+# The tests run with the deployment's configuration in place (it is read
+# at import time, from /etc/impact_presidio/config.yaml), serving a fresh
+# project tree. Credentials are generated, and the Notary Service and
+# SAFE are stubbed out, at the points where presidio calls them.
+SCID = 'presidio-test-dataset'
+OTHER_SCID = 'presidio-test-other-dataset'
+SAFE_SERVER = 'safe.invalid:7777'
+
+_stub_keys = Warmup.generate_stub_keys()
+
+
+def _enable_admin(presidio_app):
+    # The deployment's configuration may leave the admin interface off;
+    # its routes must be added before the app handles any request.
+    if Admin._admin_enabled:
+        return
+    presidio_config = presidio_app.config['PRESIDIO_CONFIG']
+    presidio_app.config['PRESIDIO_CONFIG'] = dict(presidio_config,
+                                                  admin={'enabled': True})
+    try:
+        Admin.configure_admin(presidio_app, Admin._project_path)
+    finally:
+        presidio_app.config['PRESIDIO_CONFIG'] = presidio_config
+
+
+_enable_admin(impact_presidio.app)
+
+
+class StubResponse(object):
+    """Minimal stand-in for a requests.Response object."""
+
+    def __init__(self, json_value, status_code=200):
+        self.status_code = status_code
+        self._json_value = json_value
+
+    def __bool__(self):
+        return (self.status_code < 400)
+
+    def json(self):
+        return self._json_value
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def presidio(tmp_path, monkeypatch):
+    app = impact_presidio.app
+    autoindex = impact_presidio.autoIndex
+    credentials = Warmup.generate_stub_credentials(dataset_SCID=SCID,
+                                                   keys=_stub_keys)
+    state = SimpleNamespace(app=app, autoindex=autoindex,
+                            credentials=credentials, scid=SCID,
+                            other_scid=OTHER_SCID, tree=tmp_path,
+                            web_root=app.config['WEB_ROOT'],
+                            safe_result='succeed', safe_posts=[])
+
+    def stub_get(url, *args, **kwargs):
+        return StubResponse(credentials['jwks'])
+
+    def stub_post(url, *args, **kwargs):
+        state.safe_posts.append(url)
+        return StubResponse({'result': state.safe_result})
+
+    monkeypatch.setattr(CredentialUtils, '_CAStore', credentials['ca_store'])
+    monkeypatch.setattr(CredentialUtils, 'get', stub_get)
+    monkeypatch.setattr(SafeAutoIndexModule, 'post', stub_post)
+    monkeypatch.setitem(app.config, 'SAFE_SERVER_LIST', [SAFE_SERVER])
+    monkeypatch.setattr(LabelMechs, '_project_path', tmp_path)
+    monkeypatch.setattr(autoindex, 'rootdir',
+                        RootDirectory(str(tmp_path), autoindex=autoindex))
+    (tmp_path / '.safelabels').write_text(f'version: 1\n'
+                                          f'default: [{SCID}]\n')
+    autoindex.clear_decision_cache()
+    autoindex.safe_result_cache.clear()
+
+    state.client = app.test_client(use_cookies=False)
+    state.headers = {'X-SSL-Cert': credentials['url_encoded_cert'],
+                     'Cookie': f'ImPACT-JWT={credentials["jwt"]}'}
+    yield state
+    autoindex.clear_decision_cache()
+    autoindex.safe_result_cache.clear()
@@ -0,0 +1,124 @@
+import pytest
+
+from impact_presidio import Admin, CacheSnapshot
+
+ADMIN_URL = '/__presidio_admin__/caches'
+
+
+@pytest.fixture
+def admin(presidio, monkeypatch):
+    monkeypatch.setattr(Admin, '_invalidation_file',
+                        str(presidio.tree / '.invalidations'))
+    monkeypatch.setattr(Admin, '_project_path', str(presidio.tree))
+    monkeypatch.setattr(CacheSnapshot, '_snapshot_file',
+                        str(presidio.tree / '.cache-snapshot'))
+    monkeypatch.setattr(CacheSnapshot, '_snapshot_key',
+                        CacheSnapshot._derive_snapshot_key(b'test key'))
+    (presidio.tree / 'data.csv').write_text('a,1\n')
+    return presidio
+
+
+def _fetch(presidio, name='data.csv'):
+    return presidio.client.get(f'{presidio.web_root}/{name}',
+                               headers=presidio.headers)
+
+
+def _write_snapshot(presidio):
+    CacheSnapshot.write_snapshot(presidio.app, presidio.autoindex,
+                                 CacheSnapshot._snapshot_file)
+
+
+def _restore_snapshot(presidio):
+    # As a newly started worker does.
+    presidio.autoindex.safe_result_cache.clear()
+    presidio.autoindex.clear_decision_cache()
+    CacheSnapshot.load_snapshot(presidio.app, presidio.autoindex,
+                                CacheSnapshot._snapshot_file)
+
+
+def test_admin_is_loopback_only(admin):
+    response = admin.client.get(ADMIN_URL)
+    assert response.status_code == 200
+    assert 'safe_results' in response.get_json()['caches']
+
+    response = admin.client.get(
+        ADMIN_URL, environ_base={'REMOTE_ADDR': '192.0.2.10'})
+    assert response.status_code == 404
+    response = admin.client.post(
+        f'{ADMIN_URL}/invalidate', json={'all': True},
+        environ_base={'REMOTE_ADDR': '192.0.2.10'})
+    assert response.status_code == 404
+
+    # Requests relayed by nginx come from loopback, too.
+    response = admin.client.get(
+        ADMIN_URL, headers={'X-Forwarded-For': '192.0.2.10'})
+    assert response.status_code == 404
+
+
+def test_invalidate_requires_a_selector(admin):
+    response = admin.client.post(f'{ADMIN_URL}/invalidate', json={})
+    assert response.status_code == 400
+    response = admin.client.post(f'{ADMIN_URL}/invalidate',
+                                 json={'path_prefix': '../elsewhere'})
+    assert response.status_code == 400
+
+
+def test_invalidate_drops_cached_safe_results(admin):
+    assert _fetch(admin).status_code == 200
+    assert _fetch(admin).status_code == 200
+    assert len(admin.safe_posts) == 1
+
+    response = admin.client.post(f'{ADMIN_URL}/invalidate',
+                                 json={'scid': admin.scid})
+    assert response.status_code == 200
+    assert response.get_json()['dropped']['safe_results'] == 1
+
+    # SAFE has since revoked access.
+    admin.safe_result = 'fail'
+    assert _fetch(admin).status_code == 404
+    assert len(admin.safe_posts) == 2
+
+
+def test_snapshot_restores_safe_results(admin):
+    assert _fetch(admin).status_code == 200
+    _write_snapshot(admin)
+    _restore_snapshot(admin)
+    assert len(admin.autoindex.safe_result_cache) == 1
+
+    assert _fetch(admin).status_code == 200
+    assert len(admin.safe_posts) == 1
+
+
+def test_invalidate_then_restore_snapshot(admin):
+    assert _fetch(admin).status_code == 200
+    _write_snapshot(admin)
+    # A worker that hasn't yet applied the invalidation still holds the
+    # result, and writes its snapshot afterwards.
+    lagging_results = dict(admin.autoindex.safe_result_cache)
+
+    response = admin.client.post(f'{ADMIN_URL}/invalidate',
+                                 json={'scid': admin.scid})
+    assert response.status_code == 200
+    assert response.get_json()['dropped']['snapshot'] == 1
+
+    admin.autoindex.safe_result_cache.update(lagging_results)
+    _write_snapshot(admin)
+
+    _restore_snapshot(admin)
+    assert len(admin.autoindex.safe_result_cache) == 0
+    admin.safe_result = 'fail'
+    assert _fetch(admin).status_code == 404
+    assert len(admin.safe_posts) == 2
+
+
+def test_invalidate_keeps_unmatched_snapshot_entries(admin):
+    assert _fetch(admin).status_code == 200
+    _write_snapshot(admin)
+
+    response = admin.client.post(f'{ADMIN_URL}/invalidate',
+                                 json={'dn': 'someone else'})
+    assert response.status_code == 200
+    assert response.get_json()['dropped']['snapshot'] == 0
+
+    _restore_snapshot(admin)
+    assert len(admin.autoindex.safe_result_cache) == 1
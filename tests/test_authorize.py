@@ -0,0 +1,100 @@
+import gzip
+
+import pytest
+
+from impact_presidio import Authorize, Precompressed
+
+
+@pytest.fixture
+def labelled_tree(presidio):
+    tree = presidio.tree
+    (tree / 'public').mkdir()
+    (tree / 'public' / 'a.csv').write_text('a,1\n')
+    (tree / 'public' / 'nested').mkdir()
+    (tree / 'restricted').mkdir()
+    (tree / 'restricted' / '.safelabels').write_text(
+        f'version: 1\ndefault: [{presidio.other_scid}]\n')
+    (tree / 'restricted' / 'b.csv').write_text('b,2\n')
+    (tree / 'public' / '.safelabels').write_text(
+        f'version: 1\n'
+        f'default: [{presidio.scid}]\n'
+        f'overrides:\n'
+        f'  "secret\\\\.csv$": [{presidio.other_scid}]\n')
+    (tree / 'public' / 'secret.csv').write_text('s,3\n')
+    return presidio
+
+
+def _authorize(presidio, paths):
+    return presidio.client.post(f'{presidio.web_root}/__authorize__',
+                                json={'paths': paths},
+                                headers=presidio.headers)
+
+
+def _allowed(response):
+    return [path_result['allowed']
+            for path_result in response.get_json()['results']]
+
+
+def test_results_are_per_path_and_in_order(labelled_tree):
+    paths = ['public/a.csv', 'restricted/b.csv', 'public/nested/',
+             'public/missing.csv', 'public/secret.csv', '../outside',
+             'restricted', 'public/a.csv']
+    response = _authorize(labelled_tree, paths)
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [path_result['path'] for path_result in results] == paths
+    assert _allowed(response) == [True, False, True, False, False, False,
+                                  False, True]
+
+    file_stat = (labelled_tree.tree / 'public' / 'a.csv').stat()
+    assert results[0] == {'path': 'public/a.csv', 'allowed': True,
+                          'type': 'file', 'size': file_stat.st_size,
+                          'modified': file_stat.st_mtime}
+    assert results[2]['type'] == 'directory'
+    assert results[2]['size'] is None
+    # Denied and missing paths look alike.
+    assert results[1] == {'path': 'restricted/b.csv', 'allowed': False}
+    assert results[3] == {'path': 'public/missing.csv', 'allowed': False}
+
+
+def test_safe_is_asked_once(labelled_tree, monkeypatch):
+    monkeypatch.setattr(Authorize, '_authorize_stat_chunk', 2)
+    names = ('a.csv', 'nested', 'a.csv', 'secret.csv', 'nested/')
+    paths = [f'public/{name}' for name in names]
+    response = _authorize(labelled_tree, paths)
+    assert _allowed(response) == [True, True, True, False, True]
+    assert len(labelled_tree.safe_posts) == 1
+
+
+def test_safe_denial_denies_every_path(labelled_tree):
+    labelled_tree.safe_result = 'fail'
+    response = _authorize(labelled_tree, ['public/a.csv', 'public'])
+    assert response.status_code == 200
+    assert _allowed(response) == [False, False]
+
+
+def test_precompressed_siblings_follow_their_originals(labelled_tree,
+                                                       monkeypatch):
+    monkeypatch.setattr(Precompressed, '_precompressed_enabled', True)
+    public = labelled_tree.tree / 'public'
+    (public / 'secret.csv.gz').write_bytes(gzip.compress(b's,3\n'))
+    (public / 'a.csv.gz').write_bytes(gzip.compress(b'a,1\n'))
+    response = _authorize(labelled_tree, ['public/secret.csv.gz',
+                                          'public/a.csv.gz'])
+    assert _allowed(response) == [False, True]
+
+
+def test_invalid_requests(labelled_tree, monkeypatch):
+    url = f'{labelled_tree.web_root}/__authorize__'
+    response = labelled_tree.client.post(url, data='not json',
+                                         headers=labelled_tree.headers)
+    assert response.status_code == 400
+    assert _authorize(labelled_tree, 'public/a.csv').status_code == 400
+    assert _authorize(labelled_tree, [1, 2]).status_code == 400
+
+    monkeypatch.setattr(Authorize, '_authorize_max_paths', 2)
+    assert _authorize(labelled_tree, ['a', 'b', 'c']).status_code == 413
+
+    # Credentials are required, as for any other request.
+    response = labelled_tree.client.post(url, json={'paths': ['public']})
+    assert response.status_code == 401
@@ -0,0 +1,95 @@
+import gzip
+import os
+
+from pathlib import Path
+
+import pytest
+from xattr import xattr
+
+from impact_presidio import LabelMechs, Precompressed
+
+
+def _write_with_sibling(tree, name, content):
+    original = tree / name
+    original.write_bytes(content)
+    sibling = tree / f'{name}.gz'
+    sibling.write_bytes(gzip.compress(content))
+    original_stat = original.stat()
+    os.utime(sibling, ns=(original_stat.st_atime_ns,
+                          original_stat.st_mtime_ns))
+
+
+@pytest.fixture
+def precompressed(presidio, monkeypatch):
+    monkeypatch.setattr(Precompressed, '_precompressed_enabled', True)
+    presidio.headers['Accept-Encoding'] = 'gzip'
+    return presidio
+
+
+@pytest.fixture
+def override_tree(precompressed):
+    tree = precompressed.tree
+    (tree / '.safelabels').write_text(
+        f'version: 1\n'
+        f'default: [{precompressed.scid}]\n'
+        f'overrides:\n'
+        f'  "secret\\\\.csv$": [{precompressed.other_scid}]\n')
+    _write_with_sibling(tree, 'secret.csv', b'classified,1\n' * 200)
+    _write_with_sibling(tree, 'public.csv', b'public,1\n' * 200)
+    return precompressed
+
+
+def test_override_protects_sibling(override_tree):
+    client, headers = override_tree.client, override_tree.headers
+    web_root, tree = override_tree.web_root, override_tree.tree
+    # The sibling's own path escapes the override; its original's doesn't.
+    assert not LabelMechs.check_labels(str(tree / 'secret.csv'),
+                                       override_tree.scid)
+    assert LabelMechs.check_labels(str(tree / 'secret.csv.gz'),
+                                   override_tree.scid)
+
+    for name in ('secret.csv', 'secret.csv.gz'):
+        response = client.get(f'{web_root}/{name}', headers=headers)
+        assert response.status_code == 404
+
+    response = client.get(f'{web_root}/public.csv.gz', headers=headers)
+    assert response.status_code == 200
+    response = client.get(f'{web_root}/public.csv', headers=headers)
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+
+def test_override_protects_sibling_in_listing(override_tree):
+    response = override_tree.client.get(f'{override_tree.web_root}/',
+                                        headers=override_tree.headers)
+    assert response.status_code == 200
+    listing = response.get_data(as_text=True)
+    assert 'public.csv.gz' in listing
+    assert 'secret.csv' not in listing
+
+
+def test_compressor_copies_label_xattrs(precompressed, monkeypatch):
+    tree = precompressed.tree
+    monkeypatch.setattr(LabelMechs, '_label_mech_fn',
+                        LabelMechs.ExtendedAttributeLabelCheck)
+    label_attr = f'{LabelMechs._xattr_label_base}.0'
+    xattr(str(tree)).set(label_attr, precompressed.scid.encode('utf-8'))
+
+    original = tree / 'secret.csv'
+    original.write_bytes(b'classified,1\n' * 200)
+    other_label = precompressed.other_scid.encode('utf-8')
+    xattr(str(original)).set(label_attr, other_label)
+
+    # As the background compressor does, for each eligible file.
+    original_path = str(original)
+    assert Precompressed.compress_file(original_path, 'gzip',
+                                       os.stat(original_path))
+    sibling_path = f'{original_path}.gz'
+    assert xattr(sibling_path).get(label_attr) == other_label
+    assert not LabelMechs.check_labels(sibling_path, precompressed.scid)
+    assert Path(sibling_path).stat().st_mtime_ns == (
+        original.stat().st_mtime_ns)
+
+    response = precompressed.client.get(
+        f'{precompressed.web_root}/secret.csv', headers=precompressed.headers)
+    assert response.status_code == 404
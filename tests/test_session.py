@@ -0,0 +1,136 @@
+import urllib.parse
+
+from time import time
+
+import pytest
+
+from impact_presidio import CredentialUtils, Session, Warmup
+from impact_presidio.Session import SESSION_COOKIE
+
+
+@pytest.fixture
+def sessions(presidio, monkeypatch):
+    monkeypatch.setattr(Session, '_session_key',
+                        Session._derive_session_key(b'test key'))
+    full_verifications = []
+    verify_client_cert = CredentialUtils._verify_client_cert
+
+    def counting_verify(cert_x509, ca_store):
+        full_verifications.append(cert_x509)
+        return verify_client_cert(cert_x509, ca_store)
+
+    monkeypatch.setattr(CredentialUtils, '_verify_client_cert',
+                        counting_verify)
+    presidio.full_verifications = full_verifications
+    presidio.cert_pem = urllib.parse.unquote(
+        presidio.credentials['url_encoded_cert'])
+    presidio.claims = Session.unverified_jwt_claims(
+        presidio.credentials['jwt'])
+    return presidio
+
+
+def _fetch(presidio, session_cookie=None, headers=None):
+    headers = dict(headers or presidio.headers)
+    if session_cookie is not None:
+        headers['Cookie'] = (f'{headers["Cookie"]}; '
+                             f'{SESSION_COOKIE}={session_cookie}')
+    return presidio.client.get(f'{presidio.web_root}/', headers=headers)
+
+
+def _session_cookie(response):
+    for set_cookie in response.headers.getlist('Set-Cookie'):
+        if set_cookie.startswith(f'{SESSION_COOKIE}='):
+            return set_cookie.split(';')[0].split('=', 1)[1]
+    return None
+
+
+def _generation(presidio):
+    return CredentialUtils.CA_store_generation(
+        presidio.credentials['ca_store'])
+
+
+def test_session_skips_full_verification(sessions):
+    response = _fetch(sessions)
+    assert response.status_code == 200
+    session_cookie = _session_cookie(response)
+    assert session_cookie
+    assert len(sessions.full_verifications) == 1
+
+    response = _fetch(sessions, session_cookie)
+    assert response.status_code == 200
+    assert len(sessions.full_verifications) == 1
+
+
+def test_no_session_without_session_key(presidio):
+    response = _fetch(presidio)
+    assert response.status_code == 200
+    assert _session_cookie(response) is None
+
+
+def test_forged_session_is_ignored(sessions, monkeypatch):
+    session_cookie = _session_cookie(_fetch(sessions))
+    session_exp, session_mac = session_cookie.split('.')
+
+    # A later expiry doesn't match the MAC.
+    extended_cookie = f'{int(session_exp) + 3600}.{session_mac}'
+    assert _fetch(sessions, extended_cookie).status_code == 200
+    assert len(sessions.full_verifications) == 2
+
+    # Nor does a MAC under another key.
+    forged_cookie = Session.issue_session(sessions.cert_pem, sessions.claims,
+                                          session_exp, _generation(sessions))
+    monkeypatch.setattr(Session, '_session_key',
+                        Session._derive_session_key(b'another key'))
+    assert _fetch(sessions, forged_cookie).status_code == 200
+    assert len(sessions.full_verifications) == 3
+
+
+def test_session_is_bound_to_certificate(sessions):
+    session_cookie = _session_cookie(_fetch(sessions))
+
+    # A certificate from a CA this instance doesn't trust, presented with
+    # the session of one it does.
+    untrusted = Warmup.generate_stub_credentials(dataset_SCID=sessions.scid)
+    untrusted_headers = {
+        'X-SSL-Cert': untrusted['url_encoded_cert'],
+        'Cookie': f'ImPACT-JWT={sessions.credentials["jwt"]}'}
+    response = _fetch(sessions, session_cookie, untrusted_headers)
+    assert response.status_code == 401
+
+
+def test_session_is_bound_to_claims(sessions):
+    session_cookie = _session_cookie(_fetch(sessions))
+
+    other = Warmup.generate_stub_credentials(
+        dataset_SCID=sessions.other_scid, keys=Warmup.generate_stub_keys())
+    other_headers = dict(sessions.headers,
+                         Cookie=f'ImPACT-JWT={other["jwt"]}')
+    # The JWT's claims don't match the session; it gets verified in full
+    # (and fails: it's signed by an unknown Notary Service key).
+    response = _fetch(sessions, session_cookie, other_headers)
+    assert response.status_code == 401
+    assert len(sessions.full_verifications) == 2
+
+
+def test_expired_session_is_ignored(sessions):
+    expired_cookie = Session.issue_session(sessions.cert_pem, sessions.claims,
+                                           time() - 1, _generation(sessions))
+    assert Session.check_session(sessions.cert_pem,
+                                 sessions.credentials['jwt'], expired_cookie,
+                                 _generation(sessions)) is None
+
+    response = _fetch(sessions, expired_cookie)
+    assert response.status_code == 200
+    assert len(sessions.full_verifications) == 1
+    assert _session_cookie(response) != expired_cookie
+
+
+def test_session_ends_with_ca_bundle(sessions, monkeypatch):
+    session_cookie = _session_cookie(_fetch(sessions))
+
+    # As when a reload swaps in a rebuilt CA store.
+    monkeypatch.setattr(sessions.credentials['ca_store'],
+                        'presidio_generation', 'a-new-ca-bundle',
+                        raising=False)
+    assert _fetch(sessions, session_cookie).status_code == 200
+    assert len(sessions.full_verifications) == 2
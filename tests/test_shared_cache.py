@@ -0,0 +1,126 @@
+import multiprocessing
+import struct
+
+from time import time
+
+import pytest
+
+from impact_presidio import SharedCache
+from impact_presidio.SharedCache import MmapCacheBackend
+
+
+@pytest.fixture
+def table_config(tmp_path):
+    return {'backend': 'mmap', 'file': str(tmp_path / 'presidio-cache'),
+            'slots': 64, 'slot_size': 256}
+
+
+@pytest.fixture
+def shared(presidio, table_config, monkeypatch):
+    monkeypatch.setattr(SharedCache, '_shared_cache', None)
+    SharedCache.configure_shared_cache({'shared_cache': table_config})
+    assert SharedCache._shared_cache is not None
+    (presidio.tree / 'data.csv').write_text('a,1\n')
+    return presidio
+
+
+def _fetch(presidio):
+    return presidio.client.get(f'{presidio.web_root}/data.csv',
+                               headers=presidio.headers)
+
+
+def _forget_local_results(presidio):
+    # As another worker, with its own (empty) caches, would be.
+    presidio.autoindex.safe_result_cache.clear()
+    presidio.autoindex.clear_decision_cache()
+
+
+def test_workers_share_safe_results(shared):
+    assert _fetch(shared).status_code == 200
+    assert len(shared.safe_posts) == 1
+
+    _forget_local_results(shared)
+    assert _fetch(shared).status_code == 200
+    assert len(shared.safe_posts) == 1
+
+
+def test_invalidation_clears_shared_results(shared):
+    assert _fetch(shared).status_code == 200
+    response = shared.client.post('/__presidio_admin__/caches/invalidate',
+                                  json={'all': True})
+    assert response.status_code == 200
+
+    _forget_local_results(shared)
+    shared.safe_result = 'fail'
+    assert _fetch(shared).status_code == 404
+    assert len(shared.safe_posts) == 2
+
+
+def test_tables_are_shared_between_mappings(table_config):
+    first = MmapCacheBackend(table_config)
+    second = MmapCacheBackend(table_config)
+    first.set('safe', 'key', {'result': True}, time() + 60)
+    assert second.get('safe', 'key') == {'result': True}
+    assert second.get('jwt', 'key') is None
+
+    first.set('safe', 'expired', True, time() - 1)
+    assert second.get('safe', 'expired') is None
+    first.set('safe', 'too big', 'x' * 1024, time() + 60)
+    assert second.get('safe', 'too big') is None
+
+    second.clear()
+    assert first.get('safe', 'key') is None
+
+
+def test_torn_slot_reads_as_miss(table_config):
+    cache = MmapCacheBackend(table_config)
+    cache.set('safe', 'key', 'value', time() + 60)
+    _, first_slot, second_slot = cache._slots('safe', 'key')
+    for slot in (first_slot, second_slot):
+        # As if a writer died partway through.
+        offset = slot * cache.slot_size
+        seq = cache._header.unpack_from(cache.table, offset)[0]
+        if seq:
+            struct.pack_into('=I', cache.table, offset, seq | 1)
+    assert cache.get('safe', 'key') is None
+
+    cache.set('safe', 'key', 'rewritten', time() + 60)
+    assert cache.get('safe', 'key') == 'rewritten'
+
+
+def _write_repeatedly(table_config, writer_num, num_writes):
+    cache = MmapCacheBackend(table_config)
+    expire_timestamp = time() + 60
+    for write_num in range(num_writes):
+        value = [writer_num, write_num, f'{writer_num}' * 150]
+        cache.set('safe', f'key-{write_num % 8}', value, expire_timestamp)
+
+
+def test_concurrent_writers_never_tear_values(table_config):
+    num_writes = 3000
+    cache = MmapCacheBackend(table_config)
+    fork = multiprocessing.get_context('fork')
+    writers = [fork.Process(target=_write_repeatedly,
+                            args=(table_config, writer_num, num_writes))
+               for writer_num in range(2)]
+    for writer in writers:
+        writer.start()
+
+    # Readers never lock; every value read must be one that was written
+    # whole, or a miss.
+    num_read = 0
+    while any(writer.is_alive() for writer in writers):
+        for key_num in range(8):
+            value = cache.get('safe', f'key-{key_num}')
+            if value is not None:
+                writer_num, write_num, padding = value
+                assert padding == f'{writer_num}' * 150
+                assert write_num % 8 == key_num
+                num_read += 1
+    for writer in writers:
+        writer.join()
+        assert writer.exitcode == 0
+    assert num_read > 0
+
+    for key_num in range(8):
+        assert cache.get('safe', f'key-{key_num}')[1] % 8 == key_num
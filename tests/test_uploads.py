@@ -0,0 +1,175 @@
+import fcntl
+import hashlib
+import os
+
+from base64 import b64encode
+from time import time
+
+import pytest
+
+from impact_presidio import Uploads
+from impact_presidio.Uploads import sweep_uploads
+
+
+@pytest.fixture
+def uploads(presidio, tmp_path_factory, monkeypatch):
+    registry_dir = tmp_path_factory.mktemp('upload-registry')
+    monkeypatch.setattr(Uploads, '_uploads_enabled', True)
+    monkeypatch.setattr(Uploads, '_upload_registry_dir', str(registry_dir))
+    # The sweeper thread isn't wanted here; sweeps are run directly.
+    monkeypatch.setattr(Uploads, '_upload_sweeper', object())
+    presidio.registry_dir = registry_dir
+    (presidio.tree / 'incoming').mkdir()
+    return presidio
+
+
+def _put(presidio, path, body, **headers):
+    return presidio.client.put(f'{presidio.web_root}/{path}', data=body,
+                               headers=dict(presidio.headers, **headers))
+
+
+def _piece(presidio, path, body, first, total):
+    content_range = f'bytes {first}-{first + len(body) - 1}/{total}'
+    return _put(presidio, path, body, **{'Content-Range': content_range})
+
+
+def _upload_files(directory):
+    return [name for name in os.listdir(directory)
+            if name.startswith('.presidio-upload-')]
+
+
+def test_upload_creates_and_replaces(uploads):
+    target = uploads.tree / 'incoming' / 'data.csv'
+    response = _put(uploads, 'incoming/data.csv', b'a,1\n')
+    assert response.status_code == 201
+    assert response.get_json() == {'path': 'incoming/data.csv', 'size': 4}
+    assert target.read_bytes() == b'a,1\n'
+
+    response = _put(uploads, 'incoming/?name=data.csv', b'b,2\n')
+    assert response.status_code == 200
+    assert target.read_bytes() == b'b,2\n'
+    assert _upload_files(uploads.tree / 'incoming') == []
+    assert os.listdir(uploads.registry_dir) == []
+
+
+def test_upload_checks_digest(uploads):
+    body = b'a,1\n' * 100
+    digest = b64encode(hashlib.sha256(body).digest()).decode('ascii')
+    response = _put(uploads, 'incoming/data.csv', body,
+                    **{'Repr-Digest': f'sha-256=:{digest}:'})
+    assert response.status_code == 201
+    assert response.get_json()['sha256'] == hashlib.sha256(body).hexdigest()
+
+    response = _put(uploads, 'incoming/other.csv', body + b'x',
+                    **{'Repr-Digest': f'sha-256=:{digest}:'})
+    assert response.status_code == 400
+    assert not (uploads.tree / 'incoming' / 'other.csv').exists()
+    assert _upload_files(uploads.tree / 'incoming') == []
+
+
+def test_upload_requires_authorization(uploads):
+    restricted = uploads.tree / 'restricted'
+    restricted.mkdir()
+    (restricted / '.safelabels').write_text(
+        f'version: 1\ndefault: [{uploads.other_scid}]\n')
+    response = _put(uploads, 'restricted/data.csv', b'a,1\n')
+    assert response.status_code == 404
+    assert os.listdir(restricted) == ['.safelabels']
+
+    # Nor may a file be created that would get labels the requester
+    # doesn't hold.
+    (uploads.tree / 'incoming' / '.safelabels').write_text(
+        f'version: 1\n'
+        f'default: [{uploads.scid}]\n'
+        f'overrides:\n'
+        f'  "secret\\\\.csv$": [{uploads.other_scid}]\n')
+    response = _put(uploads, 'incoming/secret.csv', b'a,1\n')
+    assert response.status_code == 404
+    assert not (uploads.tree / 'incoming' / 'secret.csv').exists()
+
+    uploads.safe_result = 'fail'
+    uploads.autoindex.clear_decision_cache()
+    uploads.autoindex.safe_result_cache.clear()
+    response = _put(uploads, 'incoming/data.csv', b'a,1\n')
+    assert response.status_code == 404
+    assert not (uploads.tree / 'incoming' / 'data.csv').exists()
+
+
+def test_upload_refuses_reserved_names(uploads):
+    assert _put(uploads, 'incoming/.safelabels', b'').status_code == 403
+    assert _put(uploads, 'incoming/.presidio-upload-x',
+                b'').status_code == 403
+    assert _put(uploads, '../escape.csv', b'').status_code == 404
+    assert _put(uploads, 'incoming', b'').status_code == 400
+
+
+def test_upload_in_pieces(uploads):
+    path = 'incoming/big.bin'
+    response = _piece(uploads, path, b'a' * 10, 0, 30)
+    assert response.status_code == 202
+    assert response.headers['Range'] == 'bytes=0-9'
+    assert len(os.listdir(uploads.registry_dir)) == 1
+
+    # A piece that doesn't continue from what was received is refused.
+    response = _piece(uploads, path, b'c' * 10, 20, 30)
+    assert response.status_code == 409
+    assert response.headers['Range'] == 'bytes=0-9'
+
+    response = _put(uploads, path, b'',
+                    **{'Content-Range': 'bytes */30'})
+    assert response.status_code == 202
+    assert response.headers['Range'] == 'bytes=0-9'
+
+    assert _piece(uploads, path, b'b' * 10, 10, 30).status_code == 202
+    assert not (uploads.tree / 'incoming' / 'big.bin').exists()
+    response = _piece(uploads, path, b'c' * 10, 20, 30)
+    assert response.status_code == 201
+    assert (uploads.tree / 'incoming' / 'big.bin').read_bytes() == (
+        b'a' * 10 + b'b' * 10 + b'c' * 10)
+    assert _upload_files(uploads.tree / 'incoming') == []
+    assert os.listdir(uploads.registry_dir) == []
+
+
+def test_concurrent_pieces_are_refused(uploads):
+    path = 'incoming/big.bin'
+    assert _piece(uploads, path, b'a' * 10, 0, 30).status_code == 202
+    partial_name, = _upload_files(uploads.tree / 'incoming')
+
+    # As another piece being received does.
+    with open(uploads.tree / 'incoming' / partial_name, 'rb') as partial:
+        fcntl.flock(partial, fcntl.LOCK_EX)
+        response = _piece(uploads, path, b'b' * 10, 10, 30)
+        assert response.status_code == 409
+        assert response.headers['Range'] == 'bytes=0-9'
+        # Nor does a piece starting over get in.
+        assert _piece(uploads, path, b'x' * 10, 0, 30).status_code == 409
+
+    assert _piece(uploads, path, b'b' * 10, 10, 30).status_code == 202
+    assert (uploads.tree / 'incoming' / partial_name).read_bytes() == (
+        b'a' * 10 + b'b' * 10)
+
+
+def test_sweep_removes_only_abandoned_uploads(uploads):
+    response = _piece(uploads, 'incoming/old.bin', b'a' * 10, 0, 30)
+    assert response.status_code == 202
+    old_partial, = _upload_files(uploads.tree / 'incoming')
+    long_ago = time() - 2 * Uploads._upload_partial_max_age_seconds
+    os.utime(uploads.tree / 'incoming' / old_partial, (long_ago, long_ago))
+
+    response = _piece(uploads, 'incoming/new.bin', b'a' * 10, 0, 30)
+    assert response.status_code == 202
+    # Files that merely look like uploads aren't the sweep's business.
+    stray = uploads.tree / 'incoming' / '.presidio-upload-stray'
+    stray.write_bytes(b'')
+    os.utime(stray, (long_ago, long_ago))
+
+    assert sweep_uploads() == 1
+    remaining = _upload_files(uploads.tree / 'incoming')
+    assert old_partial not in remaining
+    assert len(remaining) == 2
+    assert len(os.listdir(uploads.registry_dir)) == 1
+
+    # The abandoned upload starts over.
+    response = _put(uploads, 'incoming/old.bin', b'',
+                    **{'Content-Range': 'bytes */30'})
+    assert 'Range' not in response.headers